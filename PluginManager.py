@@ -1,8 +1,44 @@
 import sys
 import os
 import importlib.util
+import hashlib
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 # assist with type hinting
 from hamChatPlugin import hamChatPlugin
+from hamChatFrame import Frame
+from hamChatDispatch import PluginQueue, DEFAULT_QUEUE_SIZE, POLICY_DROP_OLDEST
+from hamChatProfiler import LatencyHistogram
+
+# the hooks that PluginManager fans out to plugins, see hamChatPlugin for what each one does
+HOOKS = (
+    'on_connect',
+    'on_payload_recieved',
+    'on_command_received',
+    'append_bytes_to_buffer',
+    'on_transmit_buffer',
+    'on_clear_buffer',
+    'on_ui_transport_status_frame',
+    'on_key_transmitter',
+    'on_unkey_transmitter',
+    'on_transport_state_changed',
+    'create_plugin_frame',
+    'update_plugin_frame',
+    'on_get_data',
+    'is_ready',
+    'on_settings_update',
+    'on_shutdown',
+)
+
+# remembers what is in each plugin file, so unchanged files do not have to be imported to find out
+MANIFEST_FILENAME = 'plugin_manifest.json'
+MANIFEST_VERSION = 1
+# seconds a plugin gets to connect, if its definition does not say
+DEFAULT_CONNECT_TIMEOUT = 5
+# ARDOP expects the radio to be keyed within about 50ms of asking for PTT
+PTT_LATENCY_BUDGET = 0.050
 
 class PluginManager:
     def __init__(self, host_interface, plugin_folder='plugins'):
@@ -12,6 +48,35 @@ class PluginManager:
         # currently there is no load order except whatever os.listdir gives us
         self.plugins = [] # type: list[hamChatPlugin]
         self.transports = [] # type: list[str]
+        # handlers whose payloads may be compressed before they are sent
+        self.compressed_handlers = set() # type: set[str]
+        # routing index for received frames, see build_routing_table
+        self.handler_routes = {} # type: dict[str, list[tuple[hamChatPlugin, bool]]]
+        self.all_handler_routes = [] # type: list[tuple[hamChatPlugin, bool]]
+        # each plugin that receives data gets its own queue and worker thread, keyed by plugin object
+        self.dispatch_queues = {} # type: dict[hamChatPlugin, PluginQueue]
+        # the plugins that actually implement each hook, see build_hook_index
+        self.hook_subscribers = {hook: [] for hook in HOOKS} # type: dict[str, list[hamChatPlugin]]
+        # imported plugin modules by filename, and how long importing and starting each plugin took in seconds
+        self.plugin_modules = {}
+        self.load_times = {} # type: dict[str, dict[str, float]]
+        self.plugin_folder = plugin_folder
+        self.manifest = {'version': MANIFEST_VERSION, 'plugins': {}}
+        # plugins connect in the background, see connect_plugins
+        self.connect_executor = None # type: ThreadPoolExecutor
+        self.connect_futures = {} # type: dict[str, Future]
+        self.connect_times = {} # type: dict[str, float]
+        # plugins with 'rig_control': True key the radio, PTT goes to them first, everyone else hears about it after
+        self.rig_controls = [] # type: list[hamChatPlugin]
+        self.ptt_listeners = [] # type: list[hamChatPlugin]
+        self.ptt_listener_queue = None # type: PluginQueue
+        # transport state changes are announced on their own thread, so the transport's reader never waits on a plugin
+        self.state_listener_queue = None # type: PluginQueue
+        # from when the transport asked for PTT to when the rig control plugins were told
+        self.ptt_latency = {
+            'key': LatencyHistogram('key', PTT_LATENCY_BUDGET),
+            'unkey': LatencyHistogram('unkey', PTT_LATENCY_BUDGET),
+        }
         self.host_interface = host_interface
 
         if not os.path.exists(plugin_folder):
@@ -31,24 +96,223 @@ class PluginManager:
 
         self.list_plugins()
         self.register_transports()
+        self.register_compressed_handlers()
+        self.build_hook_index()
+        self.build_routing_table()
+        self.start_dispatch_queues()
 
     def __load_plugins(self, plugin_folder):
-        # These variables could use some renaming to make it more clear
         # What we're doing is looking for .py files in the plugin folder, finding out if they are a subclass of hamChatPlugin
         # and if they are, we instantiate them and add them to the list of plugins.
-        # we also filter out the hamChatPlugin class itself, as it is not a plugin, but a base class.
+        # Importing every file is the slowest part of starting up on a Raspberry Pi, so the classes and definitions
+        # found in each file are remembered in a manifest. A file that has not changed since is only imported
+        # if it has a plugin that is enabled in the settings, and is not scanned again.
+        self.plugin_folder = plugin_folder
+        self.manifest = self.__read_manifest(plugin_folder)
+        disabled = set(self.host_interface.settings.get('disabled_plugins', []))
+        manifest_changed = False
         filename: str
         for filename in os.listdir(plugin_folder):
-            if filename.endswith('.py'):
-                spec = importlib.util.spec_from_file_location(filename[:-3], os.path.join(plugin_folder, filename))
-                module = importlib.util.module_from_spec(spec)
-                spec.loader.exec_module(module)
+            # files starting with _ are helper modules for plugins, not plugins
+            if not filename.endswith('.py') or filename.startswith('_'):
+                continue
+            path = os.path.join(plugin_folder, filename)
+            entry = self.manifest['plugins'].get(filename)
+            if self.__is_manifest_entry_current(entry, path):
+                # only import what we need, files without any enabled plugin are skipped entirely
+                wanted = [c for c in entry['classes'] if c['definition'].get('name') not in disabled]
+                if not wanted:
+                    continue
+                module = self.__import_plugin_module(filename)
+                classes = [getattr(module, c['class']) for c in wanted]
+            else:
+                # new or changed file, we have to look inside it
+                module = self.__import_plugin_module(filename)
+                classes = []
                 for attr_name in dir(module):
                     if attr_name != 'hamChatPlugin':
                         attr = getattr(module, attr_name)
                         if isinstance(attr, type) and issubclass(attr, hamChatPlugin):
-                            valid_plugin_object = attr(host_interface=self.host_interface)
-                            self.plugins.append(valid_plugin_object)
+                            classes.append(attr)
+                # a changed file keeps what we knew about its classes, so disabled plugins stay disabled
+                known = {c['class']: c['definition'] for c in (entry or {}).get('classes', [])}
+                entry = self.__new_manifest_entry(path)
+                for cls in classes:
+                    entry['classes'].append({'class': cls.__name__, 'definition': known.get(cls.__name__, {})})
+                self.manifest['plugins'][filename] = entry
+                manifest_changed = True
+                classes = [cls for cls in classes if known.get(cls.__name__, {}).get('name') not in disabled]
+            for cls in classes:
+                plugin = self.__instantiate_plugin(filename, cls)
+                manifest_changed |= self.__remember_definition(filename, plugin)
+
+        # forget files that are gone
+        for filename in list(self.manifest['plugins']):
+            if not os.path.exists(os.path.join(plugin_folder, filename)):
+                del self.manifest['plugins'][filename]
+                manifest_changed = True
+        if manifest_changed:
+            self.__write_manifest(plugin_folder)
+        if self.host_interface.debug.get():
+            for filename, times in self.load_times.items():
+                print(f"Loaded {filename} in {sum(times.values()) * 1000:.1f}ms {times}")
+
+    def __import_plugin_module(self, filename: str):
+        if filename in self.plugin_modules:
+            return self.plugin_modules[filename]
+        start = time.perf_counter()
+        spec = importlib.util.spec_from_file_location(filename[:-3], os.path.join(self.plugin_folder, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        self.load_times.setdefault(filename, {})['import'] = time.perf_counter() - start
+        self.plugin_modules[filename] = module
+        return module
+
+    def __instantiate_plugin(self, filename: str, cls: type) -> hamChatPlugin:
+        start = time.perf_counter()
+        plugin = cls(host_interface=self.host_interface)
+        self.load_times.setdefault(filename, {})[cls.__name__] = time.perf_counter() - start
+        self.plugins.append(plugin)
+        return plugin
+
+    def __remember_definition(self, filename: str, plugin: hamChatPlugin) -> bool:
+        '''Store the plugin's definition in the manifest, returns True if it changed'''
+        # round trip through json, so we compare what would actually be saved
+        definition = json.loads(json.dumps(plugin.definition, default=str))
+        for known in self.manifest['plugins'][filename]['classes']:
+            if known['class'] == type(plugin).__name__:
+                if known['definition'] == definition:
+                    return False
+                known['definition'] = definition
+                return True
+        return False
+
+    def __read_manifest(self, plugin_folder) -> dict:
+        try:
+            with open(os.path.join(plugin_folder, MANIFEST_FILENAME), 'r') as f:
+                manifest = json.loads(f.read())
+            if manifest.get('version') == MANIFEST_VERSION:
+                return manifest
+        except (FileNotFoundError, ValueError):
+            # if the file doesn't exist or is damaged, every plugin will just be scanned again
+            pass
+        return {'version': MANIFEST_VERSION, 'plugins': {}}
+
+    def __write_manifest(self, plugin_folder):
+        try:
+            with open(os.path.join(plugin_folder, MANIFEST_FILENAME), 'w') as f:
+                f.write(json.dumps(self.manifest, indent=1))
+        except OSError as e:
+            print(f"Could not save the plugin manifest: {e}")
+
+    def __new_manifest_entry(self, path) -> dict:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return {'mtime': os.path.getmtime(path), 'sha256': digest, 'classes': []}
+
+    def __is_manifest_entry_current(self, entry: dict, path) -> bool:
+        if not entry:
+            return False
+        mtime = os.path.getmtime(path)
+        if entry.get('mtime') == mtime:
+            return True
+        # the file was touched, but may not have changed, like after a git checkout
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() != entry.get('sha256'):
+                return False
+        entry['mtime'] = mtime
+        return True
+
+    def get_available_plugins(self) -> list:
+        '''Returns [(name, enabled)] for every plugin in the plugin folder, loaded or not, from the manifest.'''
+        disabled = set(self.host_interface.settings.get('disabled_plugins', []))
+        available = []
+        for entry in self.manifest['plugins'].values():
+            for known in entry['classes']:
+                name = known['definition'].get('name')
+                if name:
+                    available.append((name, name not in disabled))
+        return available
+
+    def load_plugin(self, name: str) -> hamChatPlugin:
+        '''Import and start a plugin that was not loaded at startup, by the name in its definition.
+        Returns the plugin, or None if the manifest does not know it.'''
+        for plugin in self.plugins:
+            if plugin.definition.get('name') == name:
+                return plugin
+        for filename, entry in self.manifest['plugins'].items():
+            for known in entry['classes']:
+                if known['definition'].get('name') == name:
+                    module = self.__import_plugin_module(filename)
+                    plugin = self.__instantiate_plugin(filename, getattr(module, known['class']))
+                    if plugin.definition.get('transport'):
+                        self.transports.append(plugin.definition.get('transport'))
+                    if plugin.definition.get('compress'):
+                        self.compressed_handlers.update(plugin.definition.get('handlers', []))
+                        self.compressed_handlers.discard('ALL')
+                    self.build_hook_index()
+                    self.build_routing_table()
+                    self.start_dispatch_queues()
+                    if self.implements_hook(plugin, 'on_connect'):
+                        # everything it could depend on is already running
+                        threading.Thread(target=self.__connect_plugin, args=(plugin, []), daemon=True).start()
+                    return plugin
+        return None
+
+    def connect_plugins(self):
+        '''Call on_connect for every plugin at the same time on a thread pool, and return right away.
+        A plugin waits for the plugins it depends on to finish connecting (or give up) before it starts.'''
+        subscribers = self.__dependency_order(self.hook_subscribers['on_connect'])
+        if not subscribers:
+            return
+        # one thread each, so a plugin waiting on its dependencies never starves the ones it waits for
+        self.connect_executor = ThreadPoolExecutor(max_workers=len(subscribers), thread_name_prefix='plugin connect')
+        for plugin in subscribers:
+            dependencies = [self.connect_futures[dependency.get('plugin')] for dependency in plugin.definition.get('depends_on', [])
+                            if dependency.get('plugin') in self.connect_futures]
+            future = self.connect_executor.submit(self.__connect_plugin, plugin, dependencies)
+            self.connect_futures[plugin.definition.get('name')] = future
+        # the threads finish on their own, we do not wait for them here
+        self.connect_executor.shutdown(wait=False)
+
+    def __connect_plugin(self, plugin: hamChatPlugin, dependencies: list):
+        name = plugin.definition.get('name')
+        timeout = plugin.definition.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+        if dependencies:
+            # dependencies have their own deadlines, so this is only a backstop
+            done, not_done = wait(dependencies, timeout=timeout * 2)
+            if not_done:
+                print(f"Plugin {name} is connecting without waiting for its dependencies any longer")
+        start = time.perf_counter()
+        try:
+            plugin.on_connect(timeout)
+        except Exception as e:
+            print(f"Plugin {name} had an exception: {e} in on_connect")
+        elapsed = time.perf_counter() - start
+        self.connect_times[name] = elapsed
+        if elapsed > timeout:
+            print(f"Plugin {name} took {elapsed:.1f}s to connect, longer than its {timeout}s connect_timeout")
+        elif self.host_interface.debug.get():
+            print(f"Plugin {name} connected in {elapsed * 1000:.0f}ms")
+
+    def __dependency_order(self, plugins: list) -> list:
+        # plugins come after the plugins they depend on, otherwise the order is kept
+        by_name = {plugin.definition.get('name'): plugin for plugin in plugins}
+        ordered = []
+        visiting = set()
+        def visit(plugin):
+            if plugin in ordered or plugin in visiting:
+                # already placed, or a dependency loop, which we just ignore
+                return
+            visiting.add(plugin)
+            for dependency in plugin.definition.get('depends_on', []):
+                if dependency.get('plugin') in by_name:
+                    visit(by_name[dependency.get('plugin')])
+            visiting.discard(plugin)
+            ordered.append(plugin)
+        for plugin in plugins:
+            visit(plugin)
+        return ordered
 
     def are_dependencies_satisfied(self):
         plugin: hamChatPlugin
@@ -75,6 +339,13 @@ class PluginManager:
                 self.transports.append(plugin.definition.get('transport'))
         print(f"{len(self.transports)} Loaded transports: {self.transports}")
 
+    def register_compressed_handlers(self):
+        # plugins opt in to payload compression for their handlers with 'compress': True in their definition
+        for plugin in self.plugins:
+            if plugin.definition.get('compress'):
+                self.compressed_handlers.update(plugin.definition.get('handlers', []))
+        self.compressed_handlers.discard('ALL')
+
     def list_plugins(self):
         print(f"{len(self.plugins)} Loaded plugins:")
         for plugin in self.plugins:
@@ -93,39 +364,118 @@ class PluginManager:
             raise
 
 
-    def on_payload_recieved(self, header, payload):
-        '''Only plugins that declare a handler for the data will receive it.'''
+    def build_hook_index(self):
+        '''Find out which hooks each plugin overrides, so the no-op stubs in hamChatPlugin are never called.
+        Things like update_plugin_frames run several times a second, so calling every hook
+        on every plugin adds up on a Raspberry Pi. This must be rebuilt whenever self.plugins changes.'''
+        self.hook_subscribers = {hook: [] for hook in HOOKS}
         for plugin in self.plugins:
-            send_to_plugin = False
-            if not plugin.definition.get('handlers'):
-                continue
-            for handler in plugin.definition.get('handlers'):
+            for hook in HOOKS:
+                if self.implements_hook(plugin, hook):
+                    self.hook_subscribers[hook].append(plugin)
+            if self.host_interface.debug.get():
+                implemented = [hook for hook in HOOKS if plugin in self.hook_subscribers[hook]]
+                print(f"{plugin.definition.get('name')} implements {implemented}")
+        ptt_subscribers = self.hook_subscribers['on_key_transmitter'] + self.hook_subscribers['on_unkey_transmitter']
+        self.rig_controls = [plugin for plugin in self.plugins if plugin.definition.get('rig_control') and plugin in ptt_subscribers]
+        self.ptt_listeners = [plugin for plugin in self.plugins if plugin not in self.rig_controls and plugin in ptt_subscribers]
+        if self.ptt_listeners and self.ptt_listener_queue is None:
+            # the order matters, a listener must never hear unkey before key
+            self.ptt_listener_queue = PluginQueue('PTT listeners', self.__notify_ptt_listeners)
+        if self.hook_subscribers['on_transport_state_changed'] and self.state_listener_queue is None:
+            self.state_listener_queue = PluginQueue('transport state listeners', self.__notify_state_listeners)
+
+    def implements_hook(self, plugin: hamChatPlugin, hook: str) -> bool:
+        # a plugin may also set a hook on itself in __init__, rather than defining a method
+        if hook in vars(plugin):
+            return True
+        return getattr(type(plugin), hook, None) is not getattr(hamChatPlugin, hook)
+
+    def build_routing_table(self):
+        '''Index which plugins receive which handler IDs, so a received frame costs one dict lookup
+        no matter how many plugins are loaded. This must be rebuilt whenever self.plugins changes.'''
+        # each route is a list of (plugin, exact), where exact is False for plugins that only get it through 'ALL'
+        all_plugins = []
+        routes = {} # type: dict[str, list[hamChatPlugin]]
+        # a plugin that lists handlers but never overrides on_payload_recieved has nothing to do with the data
+        for plugin in self.hook_subscribers['on_payload_recieved']:
+            for handler in plugin.definition.get('handlers') or []:
                 # some plugins want to listen to all incoming data
                 if handler == 'ALL':
-                    send_to_plugin = True
-                # also if there is no header, we will send it to any plugin that wants all received data
-                # this might be if the plugin us not using hamChat's standard data format, like
-                # if someone wrote an IRC plugin where the header was not desired to be encoded in another user's reply.
-                if not header:
-                    break
-                elif handler in header.split(b':')[1].decode():
-                    remote_plugin_version = header.split(b':')[2].decode()
-                    if plugin.definition['version'] != remote_plugin_version:
-                        self.host_interface.display_warning_box(f'''Local plugin {plugin.definition.get("name")} has version mismatch
-                                                with remote plugin {remote_plugin_version}.\n 
-                                                Data may not be handled correctly.''')
-                    # we have a plugin that can handle this data, it will do
-                    # whatever in this interface it needs to do without further handling here.
-                    send_to_plugin = True
-            if send_to_plugin:
-                try:
-                    plugin.on_payload_recieved({'header': header, 'payload': payload})
-                except Exception as e:
-                    print(f"Plugin {plugin.definition.get('name')} failed to handle payload: '{header + payload}' with error {e}")
-                    self.host_interface.display_warning_box(f"Plugin {plugin.definition.get('name')} failed to handle a payload. Check the console for more information.")
+                    if plugin not in all_plugins:
+                        all_plugins.append(plugin)
+                elif handler:
+                    subscribers = routes.setdefault(handler, [])
+                    if plugin not in subscribers:
+                        subscribers.append(plugin)
+        self.all_handler_routes = [(plugin, False) for plugin in all_plugins]
+        self.handler_routes = {}
+        for handler, subscribers in routes.items():
+            self.handler_routes[handler] = [(plugin, True) for plugin in subscribers]
+            self.handler_routes[handler] += [(plugin, False) for plugin in all_plugins if plugin not in subscribers]
+
+    def on_payload_recieved(self, frame: Frame = None, payload: bytes = None):
+        '''Only plugins that declare a handler for the data will receive it.
+        frame is the parsed hamChat frame, or None for nonstandard data, which is passed in as payload.'''
+        # every plugin gets the same dictionary, the frame is not parsed again per plugin
+        if frame is not None:
+            data = {'header': frame.header, 'payload': frame.payload_bytes, 'frame': frame}
+            # handler IDs are matched exactly, plugins that want everything also get it
+            routes = self.handler_routes.get(frame.handler, self.all_handler_routes)
+        else:
+            data = {'header': None, 'payload': payload, 'frame': None}
+            # if there is no header, we will send it to any plugin that wants all received data
+            # this might be if the plugin us not using hamChat's standard data format, like
+            # if someone wrote an IRC plugin where the header was not desired to be encoded in another user's reply.
+            routes = self.all_handler_routes
+        for plugin, exact in routes:
+            if exact and plugin.definition['version'] != frame.version:
+                self.host_interface.display_warning_box(f'''Local plugin {plugin.definition.get("name")} has version mismatch
+                                        with remote plugin {frame.version}.\n 
+                                        Data may not be handled correctly.''')
+            # we have a plugin that can handle this data, it will do
+            # whatever in this interface it needs to do on its own worker thread, so we can get back to receiving.
+            dispatch_queue = self.dispatch_queues.get(plugin)
+            if dispatch_queue is None:
+                self.__deliver_payload(plugin, data)
+            else:
+                dispatch_queue.put(data)
+
+    def __deliver_payload(self, plugin: hamChatPlugin, data: dict):
+        try:
+            plugin.on_payload_recieved(data)
+        except Exception as e:
+            print(f"Plugin {plugin.definition.get('name')} failed to handle payload: '{data['frame'] or data['payload']}' with error {e}")
+            self.host_interface.display_warning_box(f"Plugin {plugin.definition.get('name')} failed to handle a payload. Check the console for more information.")
+
+    def start_dispatch_queues(self):
+        '''Give every plugin that receives data its own queue and worker, see hamChatDispatch.
+        Safe to call again after the plugin list changes, queues of plugins that are gone are stopped.'''
+        routed = {plugin for plugin, exact in self.all_handler_routes}
+        for routes in self.handler_routes.values():
+            routed.update(plugin for plugin, exact in routes)
+        for plugin in list(self.dispatch_queues):
+            if plugin not in routed:
+                self.dispatch_queues.pop(plugin).stop()
+        for plugin in self.plugins:
+            if plugin in routed and plugin not in self.dispatch_queues:
+                self.dispatch_queues[plugin] = PluginQueue(
+                    plugin.definition.get('name', type(plugin).__name__),
+                    lambda data, plugin=plugin: self.__deliver_payload(plugin, data),
+                    maxsize=plugin.definition.get('queue_size', DEFAULT_QUEUE_SIZE),
+                    policy=plugin.definition.get('queue_policy', POLICY_DROP_OLDEST))
+
+    def stop_dispatch_queues(self):
+        for dispatch_queue in self.dispatch_queues.values():
+            dispatch_queue.stop()
+        self.dispatch_queues = {}
+
+    def get_dispatch_metrics(self) -> dict:
+        '''Returns {plugin name: queue metrics}, see PluginQueue.metrics'''
+        return {dispatch_queue.name: dispatch_queue.metrics() for dispatch_queue in self.dispatch_queues.values()}
     
     def on_command_received(self, command: str):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['on_command_received']:
             try:
                 plugin.on_command_received(command)
             except Exception as e:
@@ -133,7 +483,7 @@ class PluginManager:
 
     def append_bytes_to_buffer(self, data: bytes):
         # only send to the current selected transport by the host application
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['append_bytes_to_buffer']:
             if plugin.definition.get('transport') == self.host_interface.settings.get('transport'):
                 try:
                     plugin.append_bytes_to_buffer(data)
@@ -141,77 +491,122 @@ class PluginManager:
                     self.__plugin_exception('append_bytes_to_buffer', plugin, e, f"Data: {data}")
 
     def on_transmit_buffer(self):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['on_transmit_buffer']:
             try:
                 plugin.on_transmit_buffer()
             except Exception as e:
                 self.__plugin_exception('on_transmit_buffer', plugin, e)
     
     def on_clear_buffer(self):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['on_clear_buffer']:
             try:
                 plugin.on_clear_buffer()
             except Exception as e:
                 self.__plugin_exception('on_clear_buffer', plugin, e)
     
     def on_ui_transport_status_frame(self, tkParent):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['on_ui_transport_status_frame']:
             try:
                 plugin.on_ui_transport_status_frame(tkParent)
             except Exception as e:
                 self.__plugin_exception('on_ui_transport_status_frame', plugin, e)
 
-    def on_key_transmitter(self):
-        for plugin in self.plugins:
-            try:
-                plugin.on_key_transmitter()
-            except Exception as e:
-                self.__plugin_exception('on_key_transmitter', plugin, e)
-    
-    def on_unkey_transmitter(self):
-        for plugin in self.plugins:
+    def on_key_transmitter(self, requested_at: float = None):
+        '''PTT fast path. The rig control plugins are keyed right here, on the caller's thread,
+        and the other plugins are told afterwards on their own thread, so they can never hold up the radio.
+        requested_at is the time.perf_counter() when the transport was asked for PTT, to measure how long keying took.'''
+        self.__set_ptt('on_key_transmitter', self.ptt_latency['key'], requested_at)
+
+    def on_unkey_transmitter(self, requested_at: float = None):
+        self.__set_ptt('on_unkey_transmitter', self.ptt_latency['unkey'], requested_at)
+
+    def __set_ptt(self, hook: str, latency: LatencyHistogram, requested_at: float):
+        for plugin in self.rig_controls:
+            if plugin in self.hook_subscribers[hook]:
+                try:
+                    getattr(plugin, hook)()
+                except Exception as e:
+                    self.__plugin_exception(hook, plugin, e)
+        if requested_at is not None:
+            latency.record(time.perf_counter() - requested_at)
+        if self.ptt_listener_queue is not None:
+            self.ptt_listener_queue.put(hook)
+
+    def __notify_ptt_listeners(self, hook: str):
+        for plugin in self.ptt_listeners:
+            if plugin in self.hook_subscribers[hook]:
+                try:
+                    getattr(plugin, hook)()
+                except Exception as e:
+                    self.__plugin_exception(hook, plugin, e)
+
+    def on_transport_state_changed(self, transport: hamChatPlugin, changes: dict):
+        '''Called by a transport when its state changes, every plugin with the hook is told on the listener thread.
+        Never waits, so transports can call it from the thread that reads their TNC.'''
+        if self.state_listener_queue is not None and changes:
+            self.state_listener_queue.put((transport, changes))
+
+    def __notify_state_listeners(self, item: tuple):
+        transport, changes = item
+        for plugin in self.hook_subscribers['on_transport_state_changed']:
             try:
-                plugin.on_unkey_transmitter()
+                plugin.on_transport_state_changed(transport, dict(changes))
             except Exception as e:
-                self.__plugin_exception('on_unkey_transmitter', plugin, e)
+                self.__plugin_exception('on_transport_state_changed', plugin, e)
+
+    def get_ptt_latency(self) -> dict:
+        '''Returns {'key': histogram, 'unkey': histogram}, see LatencyHistogram.snapshot'''
+        return {name: histogram.snapshot() for name, histogram in self.ptt_latency.items()}
 
     def create_plugin_frames(self, tkParent):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['create_plugin_frame']:
             try:
                 plugin.create_plugin_frame(tkParent)
             except Exception as e:
                 self.__plugin_exception('create_plugin_frame', plugin, e)
     
     def update_plugin_frames(self):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['update_plugin_frame']:
             try:
                 plugin.update_plugin_frame()
             except Exception as e:
                 self.__plugin_exception('update_plugin_frame', plugin, e)
 
     def on_get_data(self) -> bytes:
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['on_get_data']:
             try:
                 plugin.on_get_data()
             except Exception as e:
                 self.__plugin_exception('on_get_data', plugin, e)
     
     def is_ready(self) -> bool:
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['is_ready']:
             try:
                 plugin.is_ready()
             except Exception as e:
                 self.__plugin_exception('is_ready', plugin, e)
     
     def on_settings_update(self):
-        for plugin in self.plugins:
+        for plugin in self.hook_subscribers['on_settings_update']:
             try:
                 plugin.on_settings_update()
             except Exception as e:
                 self.__plugin_exception('on_settings_update', plugin, e)
     
     def on_shutdown(self):
-        for plugin in self.plugins:
+        if self.host_interface.debug.get():
+            for name, metrics in self.get_dispatch_metrics().items():
+                print(f"{name} dispatch queue: {metrics}")
+            for name, latency in self.get_ptt_latency().items():
+                print(f"PTT {name} latency: {latency}")
+        self.stop_dispatch_queues()
+        if self.ptt_listener_queue is not None:
+            self.ptt_listener_queue.stop()
+        if self.state_listener_queue is not None:
+            self.state_listener_queue.stop()
+        if self.connect_executor is not None:
+            self.connect_executor.shutdown(wait=False, cancel_futures=True)
+        for plugin in self.hook_subscribers['on_shutdown']:
             try:
                 plugin.on_shutdown()
             except Exception as e:
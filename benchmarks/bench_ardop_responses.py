@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import socket
+# run from anywhere, the ARDOP helpers live in the plugins folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'plugins'))
+from _ardop_host import CommandLineReader, apply_response, response_verb, NOTIFICATIONS
+
+"""
+Feeds recorded ardopcf command socket output through the same path the ARDOPCF plugin uses:
+CommandLineReader splits it into lines, notifications are picked out by NOTIFICATIONS,
+and apply_response fills in the TNC state. No ardopcf is needed.
+The cost per line should stay flat as bursts get bigger, if it grows, something is quadratic again.
+Usage: python benchmarks/bench_ardop_responses.py [runs]
+"""
+
+# ardopcf's answers to query_tnc_settings as they come in on the command socket, with notifications mixed in
+RECORDED_QUERY_BURST = (
+    b'STATE DISC\r'
+    b'PROTOCOLMODE FEC\r'
+    b'BUFFER 0\r'
+    b'MYCALL K7OTR\r'
+    b'MYAUX\r'
+    b'GRIDSQUARE DN17\r'
+    b'BUSYDET 5\r'
+    b'DRIVELEVEL 100\r'
+    b'CWID FALSE\r'
+    b'ENABLEPINGACK TRUE\r'
+    b'EXTRADELAY 0\r'
+    b'LEADER 120\r'
+    b'LISTEN TRUE\r'
+    b'LOGLEVEL 6\r'
+    b'MONITOR TRUE\r'
+    b'CAPTURE pulse\r'
+    b'PLAYBACK pulse\r'
+    b'NEWSTATE FECRcv\r'
+    b'SQUELCH 5\r'
+    b'TRAILER 20\r'
+    b'TUNINGRANGE 100\r'
+    b'USE600MODES FALSE\r'
+    b'VERSION 1.0.4.1.2\r'
+    b'PTT TRUE\r'
+    b'BUFFER 244\r'
+    b'PTT FALSE\r'
+    b'NEWSTATE DISC\r'
+)
+# how the TCP stack tends to hand it to us
+CHUNK_SIZE = 200
+
+
+def run(bursts: int) -> tuple:
+    '''Returns (seconds, lines) for this many query bursts sent back to back'''
+    sender, receiver = socket.socketpair()
+    reader = CommandLineReader(receiver)
+    state = {}
+    notifications = []
+    # like ARDOPCF.handle_notification and handle_command_response
+    reader.subscribe(lambda line: response_verb(line) in NOTIFICATIONS and notifications.append(line))
+    reader.subscribe(lambda line: apply_response(state, line))
+    data = RECORDED_QUERY_BURST * bursts
+    lines = 0
+    start = time.perf_counter()
+    for pos in range(0, len(data), CHUNK_SIZE):
+        sender.sendall(data[pos:pos + CHUNK_SIZE])
+        for line in reader.read_available():
+            reader.publish(line)
+            lines += 1
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    assert len(notifications) == 4 * bursts, "notifications went missing"
+    assert state['mycall'] == 'K7OTR' and state['use600modes'] is False
+    return elapsed, lines
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f"best of {runs} runs")
+    print(f"{'bursts':>8} {'lines':>8} {'total ms':>10} {'us/line':>10}")
+    for bursts in (1, 10, 100, 1000):
+        best, lines = min(run(bursts) for _ in range(runs))
+        print(f"{bursts:>8} {lines:>8} {best * 1000:>10.2f} {best / lines * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+# run from anywhere, the hamChat modules live one folder up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from hamChatCompression import COMPRESSORS, CODEC_NAMES, PRESET_DICTIONARY_VERSION, compress_payload, decompress_payload
+
+"""
+Reports how well each codec compresses short chat traffic, like what send_chat_message,
+autoACK and Beacon put on the air.
+Usage: python benchmarks/bench_chat_dictionary.py [corpus.txt]
+A corpus file has one message per line. Without one, the sample below is used.
+"""
+
+SAMPLE_CORPUS = [
+    "CQ CQ CQ de K7OTR K7OTR K",
+    "K7OTR de KJ7ABC, good morning! ur RST 599 599, name here is Dave, QTH near Seattle CN87",
+    "tnx fer QSO Dave, 73 de K7OTR SK",
+    "autoACKed 42 bytes",
+    "autoACKed 117 bytes",
+    "Beacon from hamChat!",
+    "Good evening everyone, checking in to the net, no traffic",
+    "QSL, solid copy. Band conditions are pretty good tonight on 40m",
+    "pse QSY 7.105 MHz, too much QRM here",
+    "Running 10 watts into a dipole, Raspberry Pi and a Digirig",
+    "How copy? I have some QSB on your signal",
+    "roger that, will try again tomorrow morning, 73!",
+    "Weather here is rain and wind, temperature 45 degrees",
+    "Testing ARDOP FEC mode 4PSK.500.100, do you copy?",
+    "QRZ? You are weak, say again your callsign please",
+    "Field day setup is done, we are QRV on 20m and 40m",
+    "K7OTR: thanks for the contact, nice to meet you, have a great day",
+    "fb OM, rig here is an FT-991A, ant is a vertical",
+    "QRT for tonight, catch you on the next one. 73 de KJ7ABC",
+    "Net control, KE7XYZ checking in, portable from a POTA park",
+]
+
+
+def load_corpus():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            return [line.rstrip(b'\r\n') for line in f if line.strip()]
+    return [line.encode() for line in SAMPLE_CORPUS]
+
+
+def main():
+    corpus = load_corpus()
+    raw_total = sum(len(message) for message in corpus)
+    print(f"{len(corpus)} messages, {raw_total} bytes, preset dictionary version {PRESET_DICTIONARY_VERSION}")
+    print(f"{'codec':<10} {'bytes':>7} {'ratio':>6} {'smaller':>8} {'us/msg':>7}")
+    for codec, compressor in COMPRESSORS.items():
+        total = 0
+        smaller = 0
+        start = time.perf_counter()
+        for message in corpus:
+            compressed = compressor(message)
+            total += len(compressed)
+            if len(compressed) < len(message):
+                smaller += 1
+        elapsed = (time.perf_counter() - start) / len(corpus) * 1e6
+        print(f"{CODEC_NAMES[codec]:<10} {total:>7} {total / raw_total:>6.2f} {smaller:>4}/{len(corpus):<3} {elapsed:>7.0f}")
+
+    # what actually goes on air, the best codec per message or none at all
+    total = 0
+    picked = {}
+    for message in corpus:
+        codec, compressed = compress_payload(message)
+        assert decompress_payload(codec, compressed) == message
+        total += len(compressed)
+        picked[CODEC_NAMES[codec]] = picked.get(CODEC_NAMES[codec], 0) + 1
+    print(f"{'selected':<10} {total:>7} {total / raw_total:>6.2f}  codecs picked: {picked}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import time
+import subprocess
+# run from anywhere, the hamChat modules live one folder up
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from PluginManager import MANIFEST_FILENAME
+
+"""
+Reports how long each plugin file takes to import, which is what hamChat pays at startup
+for every plugin that is enabled, or that is new or changed since the manifest was saved.
+Each file is imported in a fresh interpreter, so shared imports like tkinter are counted
+against every plugin, the way the first one pays for them on a cold start.
+Plugins are only imported here, not started, so no display or modem is needed.
+Usage: python benchmarks/bench_plugin_import.py [plugin_folder] [runs]
+"""
+
+IMPORT_ONE = '''
+import sys, time, importlib.util
+sys.path.insert(0, {root!r})
+sys.path.append({folder!r})
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location({name!r}, {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(time.perf_counter() - start)
+'''
+
+
+def time_import(folder, filename):
+    path = os.path.join(folder, filename)
+    code = IMPORT_ONE.format(root=ROOT, folder=folder, name=filename[:-3], path=path)
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def time_manifest_check(folder, filenames):
+    '''what an unchanged file costs instead: reading the manifest and one stat per file'''
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(folder, MANIFEST_FILENAME), 'r') as f:
+            json.loads(f.read())
+    except FileNotFoundError:
+        pass
+    for filename in filenames:
+        os.path.getmtime(os.path.join(folder, filename))
+    return time.perf_counter() - start
+
+
+def main():
+    folder = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else os.path.join(ROOT, 'plugins'))
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    filenames = sorted(f for f in os.listdir(folder) if f.endswith('.py') and not f.startswith('_'))
+    print(f"{len(filenames)} plugin files in {folder}, best of {runs} cold imports each")
+    print(f"{'plugin':<20} {'import ms':>10}")
+    total = 0
+    for filename in filenames:
+        times = [time_import(folder, filename) for _ in range(runs)]
+        if None in times:
+            print(f"{filename:<20} {'failed':>10}")
+            continue
+        best = min(times)
+        total += best
+        print(f"{filename:<20} {best * 1000:>10.1f}")
+    print(f"{'all files':<20} {total * 1000:>10.1f}")
+    check = min(time_manifest_check(folder, filenames) for _ in range(runs))
+    print(f"{'manifest check':<20} {check * 1000:>10.1f}  (cost of all files when none are enabled or changed)")
+
+
+if __name__ == '__main__':
+    main()
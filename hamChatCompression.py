@@ -0,0 +1,170 @@
+"""
+Payload compression for hamChat frames.
+
+Before a frame goes to the transport, its payload is compressed with every codec here
+(only the fast ones for big payloads), and whichever result takes the least airtime is kept. If nothing actually saves airtime,
+the payload goes out as is. The codec used is recorded in the binary frame header flags,
+and the receiver decompresses it before any plugin sees the payload.
+"""
+
+import zlib
+import bz2
+import lzma
+
+# these values go over the air, never renumber them, only add to the end.
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_LZMA = 3
+# raw deflate with a preset dictionary, the first byte of the data is the dictionary version
+CODEC_ZLIB_DICT = 4
+
+CODEC_NAMES = {
+    CODEC_NONE: 'none',
+    CODEC_ZLIB: 'zlib',
+    CODEC_BZ2: 'bz2',
+    CODEC_LZMA: 'lzma',
+    CODEC_ZLIB_DICT: 'zlib+dict',
+}
+
+# General purpose compressors make 20-80 byte chat lines bigger, they have nothing to refer back to.
+# A preset dictionary of typical ham chat gives deflate that history up front.
+# Once a dictionary version has been released it must never change, or older stations
+# will decode garbage. Add a new version instead, and keep the old ones for decoding.
+# deflate finds matches nearer the end of the dictionary more cheaply, so the most common text goes last.
+PRESET_DICTIONARIES = {
+    1: (
+        b"ARDOP FEC ARQ PSK FSK QAM VARA JS8 FT8 WSPR Winlink APRS packet digipeater "
+        b"antenna dipole vertical yagi beam loop wire feedline tuner SWR amplifier watts "
+        b"battery solar portable mobile base station field day POTA SOTA park summit "
+        b"Raspberry Pi laptop sound card Signalink Digirig rigctld hamlib ardopcf "
+        b"weather WX rain snow sunny cloudy wind temperature degrees "
+        b"band conditions propagation noise QRM QRN QSB fading skip opening "
+        b"20m 40m 80m 2m 70cm 10m 15m 17m 6m MHz kHz frequency "
+        b"QTH QRZ? QRV QRT QSY QSL QSO QRP QRO QRX QSK "
+        b"599 5NN 579 559 RST report readable strength "
+        b"CN87 CN85 DM79 EM10 FN31 FN42 IO91 JO62 grid square locator "
+        b"Monday Tuesday Wednesday Thursday Friday Saturday Sunday tonight tomorrow "
+        b"morning afternoon evening night UTC local time "
+        b"please again repeat slow down say agn pse fb ur rig ant pwr wx hr es "
+        b"name is my name here is op how copy? solid copy good copy "
+        b"thanks for the contact tnx fer QSO nice to meet you "
+        b"hello everyone good morning good evening good night have a great day "
+        b"roger that ok sounds good will do see you later catch you on the next one "
+        b"net check in checking in net control any traffic for the net no traffic "
+        b"testing test test 1 2 3 can you hear me? do you copy? yes no "
+        b"CQ CQ CQ de  K  KN  SK  BK  73 de  73! 73s 88 "
+        b"N0CALL K7OTR KJ7 KE7 KF7 KG7 W7 N7 AA0 "
+        b"Beacon from hamChat! hamChat "
+        b"autoACKed  bytes"
+    ),
+}
+PRESET_DICTIONARY_VERSION = 1
+
+# raw LZMA2, without the .xz container, which would cost more than it saves on short payloads.
+# a 1MB window is plenty for anything we would send over radio, and preset 9's default 64MB
+# window costs ~40ms per call just to allocate, which adds up on a Raspberry Pi.
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 9, 'dict_size': 1 << 20}]
+
+# refuse to inflate a received payload past this, a few bytes on air should not eat all our memory
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+# bz2 and lzma at their best settings take seconds on a big file on a Raspberry Pi,
+# and compress_payload may be running on the UI thread, so above this only zlib is tried
+SLOW_CODEC_MAX_SIZE = 64 * 1024
+
+
+def _compress_zlib(payload: bytes) -> bytes:
+    return zlib.compress(payload, 9)
+
+
+def _compress_bz2(payload: bytes) -> bytes:
+    return bz2.compress(payload, 9)
+
+
+def _compress_lzma(payload: bytes) -> bytes:
+    return lzma.compress(payload, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+
+
+def _compress_zlib_dict(payload: bytes) -> bytes:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=PRESET_DICTIONARIES[PRESET_DICTIONARY_VERSION])
+    return bytes((PRESET_DICTIONARY_VERSION,)) + compressor.compress(payload) + compressor.flush()
+
+
+def _decompress_all(decompressor, data: bytes) -> bytes:
+    # max_length on its own just stops early without saying so, and a cut short payload looks complete.
+    # Asking for one byte more than we allow tells the two apart.
+    out = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE + 1)
+    if len(out) > MAX_DECOMPRESSED_SIZE:
+        raise ValueError(f"payload decompresses to more than {MAX_DECOMPRESSED_SIZE} bytes")
+    if not decompressor.eof:
+        raise ValueError("compressed payload is truncated")
+    return out
+
+
+def _decompress_zlib(data: bytes) -> bytes:
+    return _decompress_all(zlib.decompressobj(), data)
+
+
+def _decompress_bz2(data: bytes) -> bytes:
+    return _decompress_all(bz2.BZ2Decompressor(), data)
+
+
+def _decompress_lzma(data: bytes) -> bytes:
+    return _decompress_all(lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=LZMA_FILTERS), data)
+
+
+def _decompress_zlib_dict(data: bytes) -> bytes:
+    # the sender tells us which dictionary it used
+    dictionary = PRESET_DICTIONARIES.get(data[0])
+    if dictionary is None:
+        raise ValueError(f"unknown preset dictionary version {data[0]}")
+    return _decompress_all(zlib.decompressobj(-15, zdict=dictionary), data[1:])
+
+
+COMPRESSORS = {
+    CODEC_ZLIB: _compress_zlib,
+    CODEC_BZ2: _compress_bz2,
+    CODEC_LZMA: _compress_lzma,
+    CODEC_ZLIB_DICT: _compress_zlib_dict,
+}
+# too slow for big payloads, see SLOW_CODEC_MAX_SIZE
+SLOW_CODECS = {CODEC_BZ2, CODEC_LZMA}
+
+DECOMPRESSORS = {
+    CODEC_ZLIB: _decompress_zlib,
+    CODEC_BZ2: _decompress_bz2,
+    CODEC_LZMA: _decompress_lzma,
+    CODEC_ZLIB_DICT: _decompress_zlib_dict,
+}
+
+
+def compress_payload(payload: bytes, airtime=None):
+    '''Returns (codec, data) for whichever codec sends payload in the least airtime.
+    airtime is a callable taking a byte count and returning seconds (or None if it does not know),
+    usually the selected transport's estimate_airtime. Without one, fewer bytes wins.
+    CODEC_NONE and the original payload are returned unless a codec actually saves airtime.
+    Payloads over SLOW_CODEC_MAX_SIZE are only tried with the fast codecs.'''
+    def cost(length):
+        seconds = airtime(length) if airtime else None
+        return length if seconds is None else seconds
+
+    best_codec, best_data, best_cost = CODEC_NONE, payload, cost(len(payload))
+    for codec, compressor in COMPRESSORS.items():
+        if codec in SLOW_CODECS and len(payload) > SLOW_CODEC_MAX_SIZE:
+            continue
+        data = compressor(payload)
+        data_cost = cost(len(data))
+        # ties go to what we already have, so the receiver does not decompress for nothing
+        if data_cost < best_cost:
+            best_codec, best_data, best_cost = codec, data, data_cost
+    return best_codec, best_data
+
+
+def decompress_payload(codec: int, data: bytes) -> bytes:
+    '''Raises ValueError for an unknown codec, and the codec's own error for corrupt data.'''
+    if codec == CODEC_NONE:
+        return data
+    decompressor = DECOMPRESSORS.get(codec)
+    if decompressor is None:
+        raise ValueError(f"unknown compression codec {codec}")
+    return decompressor(data)
@@ -0,0 +1,100 @@
+import threading
+from collections import deque
+
+"""
+Received data is handed to each plugin through its own bounded queue, and a worker thread per plugin
+calls its on_payload_recieved. That way a plugin that sleeps, or pops up a dialog, only holds up itself,
+and the thread reading from the transport goes straight back to draining the modem.
+
+What happens when a plugin falls behind and its queue fills up is up to the plugin's definition:
+    'queue_policy': 'drop_oldest' (the default), the oldest waiting item is thrown away to make room.
+    'queue_policy': 'block', the receive thread waits for room, nothing is lost. Use this if every frame matters.
+    'queue_size': how many items may wait, 64 by default.
+"""
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_BLOCK = 'block'
+QUEUE_POLICIES = (POLICY_DROP_OLDEST, POLICY_BLOCK)
+DEFAULT_QUEUE_SIZE = 64
+
+
+class PluginQueue:
+    def __init__(self, name: str, deliver, maxsize: int = DEFAULT_QUEUE_SIZE, policy: str = POLICY_DROP_OLDEST):
+        '''deliver is called on the worker thread with each item, in the order they were put.
+        It should catch its own exceptions, anything it raises is printed and the worker carries on.'''
+        if policy not in QUEUE_POLICIES:
+            print(f"Plugin {name} has unknown queue policy '{policy}', using '{POLICY_DROP_OLDEST}'")
+            policy = POLICY_DROP_OLDEST
+        self.name = name
+        self.deliver = deliver
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.running = True
+
+        # metrics, only changed while holding the condition
+        self.max_depth = 0
+        self.dropped = 0
+        self.delivered = 0
+        self.blocked = 0
+
+        self.worker = threading.Thread(target=self.__work, name=f"{name} dispatch", daemon=True)
+        self.worker.start()
+
+    def put(self, item):
+        '''Queue an item for the plugin. Never waits with the drop_oldest policy.'''
+        with self.condition:
+            if not self.running:
+                return
+            if len(self.items) >= self.maxsize:
+                if self.policy == POLICY_BLOCK:
+                    self.blocked += 1
+                    while self.running and len(self.items) >= self.maxsize:
+                        self.condition.wait()
+                    if not self.running:
+                        return
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            self.items.append(item)
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.condition.notify_all()
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while self.running and not self.items:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                item = self.items.popleft()
+                # let a blocked receive thread know there is room again
+                self.condition.notify_all()
+            try:
+                self.deliver(item)
+            except Exception as e:
+                print(f"Plugin {self.name} dispatch worker error: {e}")
+            with self.condition:
+                self.delivered += 1
+
+    def stop(self, timeout: float = 1.0):
+        '''Stop the worker. Anything still waiting in the queue is discarded.'''
+        with self.condition:
+            self.running = False
+            self.items.clear()
+            self.condition.notify_all()
+        if self.worker is not threading.current_thread():
+            self.worker.join(timeout)
+
+    def metrics(self) -> dict:
+        with self.condition:
+            return {
+                'depth': len(self.items),
+                'max_depth': self.max_depth,
+                'maxsize': self.maxsize,
+                'policy': self.policy,
+                'dropped': self.dropped,
+                'blocked': self.blocked,
+                'delivered': self.delivered,
+            }
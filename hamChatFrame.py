@@ -0,0 +1,484 @@
+"""
+hamChat features a standard header format. This module turns received bytes into a
+Frame object in a single pass, so the host application and every plugin that handles
+the data can share one parsed copy instead of splitting and decoding it again.
+
+Standard hamChat header format:
+0       1    2      3        4          5         6 (-1)
+N0CALL:chat:0.1:RECIPIENTS:BEGIN:Hello, YOURCALL!:END:
+
+The text header costs 20-40 bytes of airtime per frame, and breaks if a binary payload
+contains :END:, so there is also a compact binary envelope. Receivers accept both,
+and tell them apart by the first byte, which can never start a callsign.
+
+Binary hamChat frame format:
+magic      1 byte, BINARY_MAGIC
+flags      1 byte, the low 4 bits are the payload compression codec (see hamChatCompression), the rest are reserved
+handler    varint handler ID from HANDLER_IDS, or 0 followed by a varint length and the handler name
+version    varint MAJOR, then varint PATCH
+sender     packed callsign, see pack_callsign
+recipients varint count (0 means ALL), then that many packed callsigns
+fields     varint count, then each field as a varint length and its bytes
+payload    varint length, then the payload
+Everything is length prefixed, so a receiver knows where the frame ends without scanning for markers.
+
+Stations only send binary frames to stations they know can read them. A station that can ends the
+header fields of its text frames with BINARY_CAPABLE_FIELD, which parse_frame takes off again,
+so plugins see the same fields as before. Older stations just see one more field they do not use.
+"""
+
+from hamChatCompression import CODEC_NONE, compress_payload, decompress_payload
+
+BEGIN_MARKER = b':BEGIN:'
+END_MARKER = b':END:'
+BINARY_MAGIC = 0xC5
+FLAG_CODEC_MASK = 0x0F
+# a header longer than this is not one, so a reader never waits on garbage to turn into one
+MAX_HEADER_LENGTH = 512
+# the last text header field, from a station that can read binary frames. ~ never starts a plugin field we know of
+BINARY_CAPABLE_FIELD = '~B'
+
+# numeric IDs for well known handlers, so they cost one byte in a binary header.
+# never renumber these, only add to the end. Unknown handlers are sent by name.
+HANDLER_IDS = {
+    'chat': 1,
+    'FileXfr': 2,
+    'ALE': 3,
+}
+HANDLER_NAMES = {handler_id: name for name, handler_id in HANDLER_IDS.items()}
+
+# callsigns are packed base 40, like AX.25 packs its addresses. Index 0 is padding.
+CALLSIGN_ALPHABET = ' ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-/.'
+CALLSIGN_INDEX = {char: index for index, char in enumerate(CALLSIGN_ALPHABET)}
+PACKED_CALLSIGN_LENGTH = 6
+PACKED_CALLSIGN_MAX_CHARS = 9
+# 40**9 is less than 0xEF0000000000, so a packed callsign never starts with this byte
+UNPACKED_CALLSIGN_ESCAPE = 0xFF
+
+
+class Frame:
+    '''A parsed hamChat frame.
+
+    sender, handler and version are strings, recipients is a tuple of callsigns (or ('ALL',)),
+    and fields holds any extra plugin header fields between the recipients and BEGIN.
+    header is the raw header bytes (everything before :BEGIN:), and payload is a memoryview
+    into the received data, so large payloads are not copied until someone asks for bytes.
+    binary_capable is True if the sender can read binary frames, always so for a binary frame.'''
+    __slots__ = ('sender', 'handler', 'version', 'recipients', 'fields', 'header', 'payload', 'raw', 'binary', 'binary_capable', '_payload_bytes')
+
+    def __init__(self, raw, sender, handler, version, recipients, fields, header, payload, binary=False, binary_capable=False):
+        self.raw = raw
+        self.binary = binary # type: bool
+        self.binary_capable = binary or binary_capable # type: bool
+        self.sender = sender # type: str
+        self.handler = handler # type: str
+        self.version = version # type: str
+        self.recipients = recipients # type: tuple[str]
+        self.fields = fields # type: tuple[str]
+        self.header = header # type: bytes
+        self.payload = payload # type: memoryview
+        self._payload_bytes = None
+
+    @property
+    def payload_bytes(self) -> bytes:
+        # made once, the first time a plugin asks for it, then shared
+        if self._payload_bytes is None:
+            self._payload_bytes = self.payload.tobytes()
+        return self._payload_bytes
+
+    def is_addressed_to(self, callsign: str) -> bool:
+        # binary frames carry callsigns upper case, and the operator may have typed theirs in lower case
+        return 'ALL' in self.recipients or self.names(callsign)
+
+    def names(self, callsign: str) -> bool:
+        '''True if callsign is one of the recipients by name, ignoring case, rather than through ALL'''
+        callsign = (callsign or '').upper()
+        return any(recipient.upper() == callsign for recipient in self.recipients)
+
+    def __repr__(self):
+        return f"Frame({self.sender}->{','.join(self.recipients)} {self.handler}:{self.version} fields={self.fields} payload={len(self.payload)} bytes)"
+
+
+def is_callsign(callsign: str) -> bool:
+    # callsigns are 4-9 characters, plus an optional SSID which may be a - followed by a two digit number
+    # minimum length is 4, maximum is 9, and only the characters a callsign can have
+    return 4 <= len(callsign) <= 9 and all(CALLSIGN_INDEX.get(char) for char in callsign.upper())
+
+
+def is_version(version: str) -> bool:
+    # a single decimal point version number, like 0.1
+    major, dot, patch = version.partition('.')
+    return bool(dot) and major.isdigit() and patch.isdigit()
+
+
+def encode_varint(value: int) -> bytes:
+    # 7 bits per byte, least significant group first, high bit set on all but the last byte
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data, pos: int):
+    '''Returns (value, position after the varint). Raises IndexError if data ends first.'''
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode_bytes(value: bytes) -> bytes:
+    return encode_varint(len(value)) + value
+
+
+def _decode_bytes(data, pos: int):
+    length, pos = decode_varint(data, pos)
+    end = pos + length
+    if end > len(data):
+        raise IndexError("field runs past the end of the frame")
+    return data[pos:end], end
+
+
+def pack_callsign(callsign: str) -> bytes:
+    '''Pack a callsign with its SSID (up to 9 characters of A-Z, 0-9, -, / and .) into 6 bytes.
+    Anything that does not fit is sent as an escape byte followed by a varint length and the ASCII text.'''
+    callsign = callsign.upper()
+    value = 0
+    if len(callsign) <= PACKED_CALLSIGN_MAX_CHARS:
+        # the first character is the least significant digit, so trailing padding is free
+        for char in reversed(callsign):
+            index = CALLSIGN_INDEX.get(char)
+            if not index:
+                value = 0
+                break
+            value = value * 40 + index
+    if not value:
+        return bytes((UNPACKED_CALLSIGN_ESCAPE,)) + _encode_bytes(callsign.encode())
+    return value.to_bytes(PACKED_CALLSIGN_LENGTH, 'big')
+
+
+def unpack_callsign(data, pos: int = 0):
+    '''Returns (callsign, position after it).'''
+    if data[pos] == UNPACKED_CALLSIGN_ESCAPE:
+        callsign, pos = _decode_bytes(data, pos + 1)
+        return bytes(callsign).decode(), pos
+    end = pos + PACKED_CALLSIGN_LENGTH
+    if end > len(data):
+        raise IndexError("packed callsign runs past the end of the frame")
+    value = int.from_bytes(data[pos:end], 'big')
+    chars = []
+    while value:
+        value, index = divmod(value, 40)
+        if not index:
+            raise ValueError("padding inside a packed callsign")
+        chars.append(CALLSIGN_ALPHABET[index])
+    return ''.join(chars), end
+
+
+def _split_recipients(recipients) -> tuple:
+    if isinstance(recipients, str):
+        recipients = recipients.split(',')
+    return tuple(recipient.strip() for recipient in recipients if recipient.strip()) or ('ALL',)
+
+
+def build_frame(sender: str, handler: str, version: str, recipients, payload: bytes, fields=(), binary=False, compress=False, airtime=None, advertise_binary=False) -> bytes:
+    '''Build a frame ready to hand to a transport.
+    recipients may be a comma separated string or a list of callsigns, fields are any extra
+    plugin header fields. With binary=True the compact binary envelope is used.
+    With compress=True, a binary frame's payload is compressed if that saves airtime,
+    as judged by the airtime callable (see hamChatCompression.compress_payload).
+    Text frames have nowhere to mark a codec, so they are never compressed.
+    With advertise_binary=True, a text frame tells its receivers we can read binary frames.
+    Raises ValueError if version is not MAJOR.PATCH.'''
+    codec = CODEC_NONE
+    if binary and compress and is_version(version):
+        codec, payload = compress_payload(payload, airtime)
+    head, tail = frame_envelope(sender, handler, version, recipients, len(payload), fields=fields,
+                                binary=binary, codec=codec, advertise_binary=advertise_binary)
+    return head + payload + tail
+
+
+def frame_envelope(sender: str, handler: str, version: str, recipients, payload_length: int, fields=(), binary=False, codec=CODEC_NONE, advertise_binary=False) -> tuple:
+    '''The (head, tail) bytes that go before and after a payload of payload_length bytes, see build_frame.
+    For payloads too big to hold in memory, which can be sent between the two as they are read.
+    Raises ValueError if version is not MAJOR.PATCH.'''
+    if not is_version(version):
+        raise ValueError(f"{handler} version '{version}' is not a MAJOR.PATCH version number")
+    recipients = _split_recipients(recipients)
+    fields = [str(field) for field in fields]
+    if not binary:
+        if advertise_binary:
+            fields.append(BINARY_CAPABLE_FIELD)
+        header = ':'.join([sender, handler, version, ','.join(recipients)] + fields)
+        return header.encode() + BEGIN_MARKER, END_MARKER
+
+    major, _, patch = version.partition('.')
+    out = bytearray((BINARY_MAGIC, codec))
+    handler_id = HANDLER_IDS.get(handler, 0)
+    out += encode_varint(handler_id)
+    if not handler_id:
+        out += _encode_bytes(handler.encode())
+    out += encode_varint(int(major))
+    out += encode_varint(int(patch))
+    out += pack_callsign(sender)
+    if recipients == ('ALL',):
+        out += encode_varint(0)
+    else:
+        out += encode_varint(len(recipients))
+        for recipient in recipients:
+            out += pack_callsign(recipient)
+    out += encode_varint(len(fields))
+    for field in fields:
+        out += _encode_bytes(field.encode())
+    out += encode_varint(payload_length)
+    return bytes(out), b''
+
+
+def _parse_binary_header(data):
+    '''Returns (sender, handler, version, recipients, fields, payload_start, payload_end) for a binary frame.'''
+    pos = 2 # skip magic and flags
+    handler_id, pos = decode_varint(data, pos)
+    if handler_id:
+        handler = HANDLER_NAMES.get(handler_id)
+        if handler is None:
+            raise ValueError(f"unknown handler ID {handler_id}")
+    else:
+        handler, pos = _decode_bytes(data, pos)
+        handler = bytes(handler).decode()
+    major, pos = decode_varint(data, pos)
+    patch, pos = decode_varint(data, pos)
+    version = f"{major}.{patch}"
+    sender, pos = unpack_callsign(data, pos)
+    count, pos = decode_varint(data, pos)
+    if not count:
+        recipients = ('ALL',)
+    else:
+        recipients = []
+        for _ in range(count):
+            recipient, pos = unpack_callsign(data, pos)
+            recipients.append(recipient)
+        recipients = tuple(recipients)
+    count, pos = decode_varint(data, pos)
+    fields = []
+    for _ in range(count):
+        field, pos = _decode_bytes(data, pos)
+        fields.append(bytes(field).decode())
+    length, pos = decode_varint(data, pos)
+    return sender, handler, version, recipients, tuple(fields), pos, pos + length
+
+
+def frame_length(data):
+    '''For a binary frame, return its total length in bytes once enough of the header has
+    arrived to know it, or None if more of it is needed.
+    Raises ValueError if data cannot be the start of a binary frame, like a text frame,
+    a corrupt header, or a handler ID from a newer version than ours.'''
+    if not data:
+        return None
+    if data[0] != BINARY_MAGIC:
+        raise ValueError("not a binary frame")
+    try:
+        sender, handler, version, recipients, fields, payload_start, payload_end = _parse_binary_header(data)
+    except IndexError:
+        if len(data) >= MAX_HEADER_LENGTH:
+            raise ValueError("binary header is too long")
+        return None
+    # UnicodeDecodeError is a ValueError too
+    if not is_callsign(sender) or not handler:
+        raise ValueError("binary header has no valid sender or handler")
+    if recipients != ('ALL',) and not all(is_callsign(recipient) for recipient in recipients):
+        raise ValueError("binary header has an invalid recipient")
+    return payload_end
+
+
+def _parse_binary_frame(data):
+    try:
+        sender, handler, version, recipients, fields, payload_start, payload_end = _parse_binary_header(data)
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return None
+    if payload_end > len(data):
+        return None
+    if not is_callsign(sender) or not handler:
+        return None
+    for recipient in recipients:
+        if recipient != 'ALL' and not is_callsign(recipient):
+            return None
+    payload = memoryview(data)[payload_start:payload_end]
+    codec = data[1] & FLAG_CODEC_MASK
+    if codec != CODEC_NONE:
+        # plugins only ever see the plain payload
+        try:
+            payload = memoryview(decompress_payload(codec, payload))
+        except Exception:
+            return None
+    # plugins written against the text header can still split this the old way
+    header = ':'.join((sender, handler, version, ','.join(recipients)) + fields).encode()
+    return Frame(data, sender, handler, version, recipients, fields, header, payload, binary=True)
+
+
+def parse_frame(data: bytes):
+    '''Parse received bytes into a Frame, or return None if they do not carry a valid hamChat header.
+
+    Binary frames are read by their length fields. For text frames, the payload is everything between
+    :BEGIN: and the :END: footer. If the data ends with the footer, that one is used, so a binary
+    payload that happens to contain :END: is kept whole.'''
+    if data and data[0] == BINARY_MAGIC:
+        return _parse_binary_frame(data)
+    begin = data.find(BEGIN_MARKER)
+    if begin < 0:
+        return None
+    payload_start = begin + len(BEGIN_MARKER)
+    if data.endswith(END_MARKER):
+        end = len(data) - len(END_MARKER)
+    else:
+        end = data.find(END_MARKER, payload_start)
+    if end < payload_start:
+        return None
+
+    header = bytes(data[:begin])
+    elements = _parse_text_header(header)
+    if elements is None:
+        return None
+    sender, handler, version, recipients = elements[:4]
+    fields = elements[4:]
+    binary_capable = bool(fields) and fields[-1] == BINARY_CAPABLE_FIELD
+    if binary_capable:
+        # that one is ours, not the plugin's
+        fields = fields[:-1]
+        header = ':'.join(elements[:-1]).encode()
+    return Frame(data, sender, handler, version, tuple(recipients.split(',')), tuple(fields), header, memoryview(data)[payload_start:end],
+                 binary_capable=binary_capable)
+
+
+def _parse_text_header(header: bytes):
+    '''Returns the header split into its fields, or None if it is not a valid text header.'''
+    try:
+        # only the header is decoded, the payload may be anything
+        elements = header.decode().split(':')
+    except UnicodeDecodeError:
+        return None
+    if len(elements) < 4:
+        return None
+    sender, handler, version, recipients = elements[:4]
+    if not is_callsign(sender):
+        return None
+    if not handler:
+        return None
+    if not is_version(version):
+        return None
+    if _parse_recipients(recipients) is None:
+        return None
+    return elements
+
+
+def _could_start_text_header(data: bytes) -> bool:
+    # the first part of a text header that has not all arrived yet. The fields we have all of
+    # must be valid, and the one still arriving must only have characters it could have.
+    try:
+        elements = data.decode().split(':')
+    except UnicodeDecodeError:
+        return False
+    for index, element in enumerate(elements):
+        complete = index < len(elements) - 1
+        if not element.isprintable() or ' ' in element:
+            return False
+        if index == 0 and (len(element) > PACKED_CALLSIGN_MAX_CHARS or not all(char in CALLSIGN_INDEX for char in element.upper())
+                           or (complete and not is_callsign(element))):
+            return False
+        if index == 1 and complete and not element:
+            return False
+        if index == 2 and (not all(char in '0123456789.' for char in element) or (complete and not is_version(element))):
+            return False
+        if index == 3 and complete and _parse_recipients(element) is None:
+            return False
+    return True
+
+
+def _parse_recipients(recipients: str):
+    recipients = recipients.split(',')
+    for recipient in recipients:
+        if recipient != 'ALL' and not is_callsign(recipient):
+            return None
+    return recipients
+
+
+def frame_start(data, pos: int = 0):
+    '''Whether a text or binary frame starts at data[pos]: True if one does, False if one cannot,
+    and None if what has arrived so far could be the start of one, but there is not enough to tell.'''
+    if pos >= len(data):
+        return None
+    header = bytes(data[pos:pos + MAX_HEADER_LENGTH + len(BEGIN_MARKER)])
+    if header[0] == BINARY_MAGIC:
+        try:
+            return None if frame_length(header[:MAX_HEADER_LENGTH]) is None else True
+        except ValueError:
+            return False
+    begin = header.find(BEGIN_MARKER)
+    if begin >= 0:
+        return _parse_text_header(header[:begin]) is not None
+    if len(header) > MAX_HEADER_LENGTH:
+        return False
+    return None if _could_start_text_header(header) else False
+
+
+def frame_starts_at(data, pos: int) -> bool:
+    '''True if a text or binary frame starts at data[pos]'''
+    return frame_start(data, pos) is True
+
+
+def next_frame_start(data, pos: int = 0, whole_header: bool = False):
+    '''The first position from pos where a frame starts, or might once more arrives (see frame_start),
+    or None if there is none. With whole_header=True, only where a whole header has arrived.
+    Readers use this to find their way back after garbage.'''
+    for candidate in range(pos, len(data)):
+        start = frame_start(data, candidate)
+        if start or (start is None and not whole_header):
+            return candidate
+    return None
+
+
+def _text_frame_end(data, pos: int):
+    # a text frame ends at an :END: that is followed by nothing, or by the start of another frame.
+    # any other :END: is part of the payload.
+    begin = data.find(BEGIN_MARKER, pos)
+    if begin < 0:
+        return None
+    end = data.find(END_MARKER, begin + len(BEGIN_MARKER))
+    while end >= 0:
+        after = end + len(END_MARKER)
+        if after == len(data) or frame_starts_at(data, after):
+            return after
+        end = data.find(END_MARKER, end + 1)
+    return None
+
+
+def split_frames(data: bytes):
+    '''Split data holding one or more frames sent back to back, as when a transport sends
+    several queued messages in one transmission.
+    Returns (frames, leftover): a list of byte strings with one frame each, and whatever is left
+    at the end that is not a complete frame (an unfinished frame, or nonstandard data).'''
+    frames = []
+    pos = 0
+    while pos < len(data):
+        if data[pos] == BINARY_MAGIC:
+            try:
+                length = frame_length(memoryview(data)[pos:])
+            except ValueError:
+                # not a frame after all, it goes with the leftover
+                break
+            if length is None or pos + length > len(data):
+                break
+            end = pos + length
+        else:
+            end = _text_frame_end(data, pos)
+            if end is None:
+                break
+        frames.append(data[pos:end])
+        pos = end
+    return frames, data[pos:]
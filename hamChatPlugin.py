@@ -56,6 +56,17 @@ class hamChatPlugin:
             # this list is what tells the plugin manager to route data to this plugin.
             # if you want to parse all incoming data, include 'ALL'
             'handlers': [self.header_id],
+            # set this to True to let hamChat compress the payloads you send with build_frame,
+            # when that saves airtime. The receiving hamChat decompresses them before you see them.
+            'compress': False,
+            # received data is handed to on_payload_recieved on this plugin's own worker thread, through a queue.
+            # if the queue is full, 'drop_oldest' throws away the oldest waiting data, 'block' makes the receiver wait for you.
+            'queue_policy': 'drop_oldest',
+            'queue_size': 64,
+            # the most seconds on_connect should take, see on_connect
+            'connect_timeout': 5,
+            # True if this plugin keys the radio, it then gets PTT before any other plugin, see on_key_transmitter
+            'rig_control': False,
             # if you talk to other plugins, you should specify them here, and their version as their behavior may change
             'depends_on': [{'plugin': 'Core', 'version': '0.1'}],
         }
@@ -85,17 +96,33 @@ class hamChatPlugin:
         # This is the actual transport object, exposing the methods and variables of the transport.
         # use with caution! This gives you great power, but it's up to you to use it wisely.
 
-        # If we want to send data to the current transport, we can use this:
-        # self.host_interface.plugMgr.append_bytes_to_buffer(b'DATA')
-        # or
-        # self.host_interface.transport.append_bytes_to_buffer(b'DATA')
-        # This will append the data to the current transport's buffer, and it will be sent when the transport is commanded to send it.
+        # To wrap our data in a hamChat header, we can use this:
+        # data = self.host_interface.build_frame(self.header_id, self.definition['version'], b'DATA', fields=('OPTIONAL', 'FIELDS'))
+        # It uses the text or binary header format, whichever the recipients can read.
+
+        # If we want to send data on the current transport, we can use this:
+        # self.host_interface.transmit(data, 'chat')
+        # The priority is 'ack', 'chat', 'beacon' or 'bulk'. Everything is sent in priority order,
+        # and big 'bulk' data is sent in pieces, so it does not hold up anything more urgent. See hamChatScheduler.
+        # Please do not load the transport's buffer yourself, that would jump the queue.
+        # Something too big to hold in memory, like a big file, can be sent straight from disk as it goes out:
+        # self.host_interface.transmit_stream(self.header_id, self.definition['version'], open_file_chunks, file_size)
+        # See SimpleFileTransfer for an example.
 
         # if we want to to key or unkey the transmitter (if there is sufficent rig control), we can use this:
         # self.host_interface.transport.on_key_transmitter()
         # self.host_interface.transport.on_unkey_transmitter()
 
 
+    def on_connect(self, timeout: float):
+        '''This method is called once after every plugin has been created, on a background thread,
+        while the main window is already up. Connect to your modem, rig, or server here instead of in __init__,
+        so one that is not running does not hold up hamChat starting.
+        Plugins connect at the same time, except a plugin waits for the plugins in its 'depends_on' to connect first.
+        Give up after timeout seconds (from 'connect_timeout' in your definition), like with socket.settimeout.
+        Do not touch tk widgets or variables here, update them in update_plugin_frame instead.'''
+        pass
+
     def on_payload_recieved(self, data: dict):
         '''This method is called by the main application when a data frame is received from the selected transport.
 
@@ -105,7 +132,12 @@ class hamChatPlugin:
         If you use "ALL" in your handlers, you may recieve nonstandard data, containing only a payload.
 
         When it gets here, it will be a dictionary like this:
-        {'header': b'SENDER:PLUGINNAME:PLUGINVERSION:RECIPENTS:BEGIN:', 'payload': b'<DATA>'}
+        {'header': b'SENDER:PLUGINNAME:PLUGINVERSION:RECIPENTS', 'payload': b'<DATA>', 'frame': Frame}
+        'frame' is the hamChatFrame.Frame the host already parsed (None for nonstandard data).
+        Use its sender, handler, version, recipients and fields instead of splitting the header again.
+
+        This is called on the plugin's own dispatch thread, not the main thread, and not the receive thread,
+        so taking a while here only delays your own plugin. See 'queue_policy' in the definition.
         '''
         pass
     
@@ -130,13 +162,15 @@ class hamChatPlugin:
     
     def on_key_transmitter(self):
         '''This method is called when a transport wants to key the transmitter.
-        Plugins that control radios should implement this method.
+        Plugins that control radios should implement this method, and set 'rig_control': True in their definition.
+        Rig control plugins are called on the transport's own thread, the moment it asks for PTT,
+        so key the radio and return, ARDOP only waits about 50ms. Other plugins are told a moment later.
         Plugins that want to key the transmitter should call this method in their application code.'''
         pass
     
     def on_unkey_transmitter(self):
         '''This method is called when a transport wants to unkey the transmitter.
-        Plugins that control radios should implement this method.
+        Plugins that control radios should implement this method, see on_key_transmitter.
         Plugins that want to unkey the transmitter should call this method in their application code.'''
         pass
     
@@ -149,7 +183,17 @@ class hamChatPlugin:
         '''This method is called regularly by the main application to update the transport state, as a
         convenience feature if they don't want to implement their own thread task to do so.
         This is not on the main thread, and cannot be used to update the UI elements or it will
-        trigger a RuntimeError because of a limitation of Tkinter.'''
+        trigger a RuntimeError because of a limitation of Tkinter.
+        Transports that are told about changes by their TNC should only ask it for their state here
+        when they have not heard from it in a while, this is called several times a second.'''
+        pass
+
+    def on_transport_state_changed(self, transport, changes: dict):
+        '''This method is called when part of a transport's state changes, like its TNC starting to send
+        or its buffer emptying. transport is the transport plugin, and changes maps each thing that changed
+        to its new value, see the transport for which keys it reports (ARDOPCF sends 'state', 'buffer' and 'ptt').
+        Called on its own thread in the order the changes happened, so it cannot update UI elements directly.
+        Transport plugins should call self.host_interface.plugMgr.on_transport_state_changed(self, changes) to announce changes.'''
         pass
 
     def append_bytes_to_buffer(self, data: bytes):
@@ -159,6 +203,13 @@ class hamChatPlugin:
         '''
         pass
 
+    def estimate_airtime(self, datalen: int) -> float:
+        '''Transport plugins can implement this to return how many seconds it would take to send
+        datalen bytes with the current settings, or None if they cannot tell.
+        Count everything that keeps the channel busy (preambles, repeats, IDs), not just the data rate.
+        hamChat uses it to decide whether compressing a payload is worth it.'''
+        pass
+
     def on_ui_transport_status_frame(self, tkParent):
         '''This method is called when the main application wants to display the transport status.
         This is where you would create a frame to display the status of your transport plugin,
@@ -173,6 +224,8 @@ class hamChatPlugin:
     def on_get_data(self) -> bytes:
         '''This method is called when the plugin is asked to return data from the buffer.
         Plugins providing a transport must implement this method.
+        It is called in a loop on the host's listener thread, so it is best to wait a moment
+        for data to arrive (like with queue.Queue.get(timeout=...)) rather than returning None right away.
         The return value is expected to be bytes, absent any length
         or modem-specific headers, like FECFEC for ARDOP.'''
         pass
@@ -183,6 +236,19 @@ class hamChatPlugin:
         The return value is expected to be a boolean, True if the plugin is ready to send data, False if it is not.'''
         pass
     
+    def wait_until_sent(self, timeout: float) -> bool:
+        '''Transport plugins can implement this to block until what was last handed to on_transmit_buffer
+        has gone out, or until timeout seconds have passed, returning True if it was sent.
+        The transmit scheduler waits on it before starting the next transmission.
+        If it is not implemented, the scheduler waits for estimate_airtime instead.'''
+        pass
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        '''Transport plugins can implement this to block until they are ready to send and receive,
+        or until timeout seconds have passed, returning is_ready(). threading.Event.wait does exactly this.
+        If it is not implemented, hamChat polls is_ready instead.'''
+        pass
+
     def on_shutdown(self):  
         '''This method is called when the program is being shut down.
         Plugins should always implement this method to clean up any resources they have allocated,
@@ -0,0 +1,168 @@
+import time
+import json
+import threading
+import platform
+from contextlib import contextmanager
+
+"""
+Built in profiling for hamChat, turned on with `python main.py --profile`.
+
+Startup steps are timed once each, and hot paths like receiving a frame are sampled
+every time they run. When hamChat shuts down, everything is written to a JSON report,
+so runs on different releases or machines can be compared.
+With --cprofile, a cProfile dump of the main (UI) thread is written as well,
+open it with `python -m pstats FILE` or snakeviz.
+
+When profiling is off, timer() and sample() do nothing, so they can stay in the code.
+LatencyHistogram is for the few things that must always be measured, like how quickly PTT keys the radio.
+"""
+
+REPORT_VERSION = 1
+# hot paths keep at most this many samples, the oldest are overwritten after that
+MAX_SAMPLES = 10000
+
+
+class Profiler:
+    def __init__(self, enabled: bool = False, report_path: str = 'hamchat_profile.json', cprofile_path: str = None):
+        self.enabled = enabled
+        self.report_path = report_path
+        self.cprofile_path = cprofile_path
+        self.started = time.perf_counter()
+        # startup steps, {name: seconds}
+        self.timings = {} # type: dict[str, float]
+        # hot paths, {name: [seconds, ...]}, with how many samples were seen in total
+        self.samples = {} # type: dict[str, list[float]]
+        self.sample_counts = {} # type: dict[str, int]
+        self.lock = threading.Lock()
+        self.cprofile = None
+        if enabled and cprofile_path:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    @contextmanager
+    def timer(self, name: str):
+        '''Time a startup step: with profiler.timer('create_widgets'): ...'''
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def mark(self, name: str):
+        '''Record how long after the profiler was created something happened'''
+        self.record(name, time.perf_counter() - self.started)
+
+    def sample(self, name: str, seconds: float):
+        '''Add one measurement of a hot path'''
+        if not self.enabled:
+            return
+        with self.lock:
+            samples = self.samples.setdefault(name, [])
+            count = self.sample_counts.get(name, 0)
+            if len(samples) < MAX_SAMPLES:
+                samples.append(seconds)
+            else:
+                samples[count % MAX_SAMPLES] = seconds
+            self.sample_counts[name] = count + 1
+
+    def summarize(self, samples: list) -> dict:
+        ordered = sorted(samples)
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+        return {
+            'count': len(ordered),
+            'mean': sum(ordered) / len(ordered),
+            'min': ordered[0],
+            'p50': percentile(0.50),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': ordered[-1],
+        }
+
+    def report(self, extra: dict = None) -> dict:
+        '''All times are in seconds'''
+        with self.lock:
+            hot_paths = {}
+            for name, samples in self.samples.items():
+                if samples:
+                    hot_paths[name] = self.summarize(samples)
+                    hot_paths[name]['seen'] = self.sample_counts[name]
+            report = {
+                'version': REPORT_VERSION,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'machine': platform.machine(),
+                'uptime': time.perf_counter() - self.started,
+                'startup': dict(self.timings),
+                'hot_paths': hot_paths,
+            }
+        if extra:
+            report.update(extra)
+        return report
+
+    def write_report(self, extra: dict = None):
+        if not self.enabled:
+            return
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_path)
+            print(f"cProfile dump written to {self.cprofile_path}")
+        with open(self.report_path, 'w') as f:
+            json.dump(self.report(extra), f, indent=1, default=str)
+        print(f"Profile report written to {self.report_path}")
+
+
+# upper edges of the LatencyHistogram buckets in seconds, anything slower lands in the last, open ended bucket
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.010, 0.020, 0.050, 0.100, 0.200, 0.500)
+
+
+class LatencyHistogram:
+    def __init__(self, name: str, budget: float = None):
+        '''Counts how long something took in fixed buckets. Unlike Profiler this is always on,
+        recording is a few comparisons, and it never grows, so it can run for the whole session.
+        budget is in seconds, anything over it is counted separately.'''
+        self.name = name
+        self.budget = budget
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.over_budget = 0
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if self.budget is not None and seconds > self.budget:
+                self.over_budget += 1
+
+    def snapshot(self) -> dict:
+        '''Bucket names are the upper edge in milliseconds, times are in seconds'''
+        with self.lock:
+            buckets = {f"<={edge * 1000:g}ms": count for edge, count in zip(LATENCY_BUCKETS, self.counts)}
+            buckets[f">{LATENCY_BUCKETS[-1] * 1000:g}ms"] = self.counts[-1]
+            return {
+                'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'budget': self.budget,
+                'over_budget': self.over_budget,
+                'buckets': buckets,
+            }
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+from collections import deque
+from hamChatFrame import parse_frame
+
+"""
+Everything hamChat sends goes through one TransmitScheduler, which is the only thing that
+loads the selected transport's buffer and tells it to transmit. Plugins hand it their frames
+with host_interface.transmit(data, priority).
+
+Each frame is in one of four priority classes, and the scheduler always sends from the most urgent
+class that has anything waiting, oldest first within a class:
+    'ack'    acknowledgements, someone is waiting on these
+    'chat'   chat lines typed by the operator
+    'beacon' beacons and other automatic announcements
+    'bulk'   files and anything else big
+
+Bulk payloads are split into 'frag' frames of about BULK_CHUNK_AIRTIME seconds on air each, sized from
+the transport's estimate_airtime for the mode it is in (BULK_CHUNK_SIZE bytes if it has none), which are sent one
+transmission at a time, so a chat line or an ACK queued during a file transfer goes out after the
+chunk on air now, not after the whole file. Receivers put the fragments back together with
+FragmentReassembler before handing the original frame to the plugins.
+A frame too big to hold in memory, like a big file, can be submitted as a stream with submit_stream,
+it is read a chunk at a time as its fragments go out.
+"""
+
+PRIORITY_ACK = 'ack'
+PRIORITY_CHAT = 'chat'
+PRIORITY_BEACON = 'beacon'
+PRIORITY_BULK = 'bulk'
+# most urgent first
+PRIORITIES = (PRIORITY_ACK, PRIORITY_CHAT, PRIORITY_BEACON, PRIORITY_BULK)
+
+# seconds on air we aim for with each transmission of a bulk payload
+BULK_CHUNK_AIRTIME = 25
+# bytes of a bulk payload sent in each transmission, for transports that cannot estimate airtime
+BULK_CHUNK_SIZE = 2048
+# what a chunk is kept between, whatever the estimate says
+MIN_BULK_CHUNK_SIZE = 64
+MAX_BULK_CHUNK_SIZE = 32768
+FRAGMENT_HANDLER = 'frag'
+FRAGMENT_VERSION = '0.1'
+# seconds we keep the fragments of a payload that stopped arriving
+FRAGMENT_TIMEOUT = 600
+# seconds to wait on a transport to finish sending, on top of its own airtime estimate
+SEND_TIMEOUT = 30
+
+
+class TransmitScheduler:
+    def __init__(self, host_interface, chunk_size: int = BULK_CHUNK_SIZE):
+        '''Owns the transmit side of the selected transport, see the top of this file.
+        Sending happens on the scheduler's own thread, so submit never waits on the radio.'''
+        self.host_interface = host_interface
+        self.chunk_size = chunk_size
+        # bulk also holds the generators of streamed fragments, see submit_stream
+        self.queues = {priority: deque() for priority in PRIORITIES} # type: dict[str, deque[bytes]]
+        self.condition = threading.Condition()
+        self.running = True
+        self.sent = {priority: 0 for priority in PRIORITIES}
+        self.worker = threading.Thread(target=self.__work, name='transmit scheduler', daemon=True)
+        self.worker.start()
+
+    def submit(self, data: bytes, priority: str = PRIORITY_CHAT):
+        '''Queue one or more complete hamChat frames to be sent'''
+        if not data:
+            return
+        if priority not in self.queues:
+            print(f"Unknown transmit priority '{priority}', sending as {PRIORITY_BULK}")
+            priority = PRIORITY_BULK
+        if priority == PRIORITY_BULK and len(data) > self.bulk_chunk_size():
+            items = self.fragment(data)
+        else:
+            items = [data]
+        with self.condition:
+            self.queues[priority].extend(items)
+            self.condition.notify_all()
+
+    def submit_stream(self, chunks, length: int, recipients: str):
+        '''Queue one complete hamChat frame that is too big to hold in memory, as bulk.
+        chunks is an iterable of bytes that adds up to length bytes, it is read on the scheduler's thread
+        as the fragments go out. recipients is who the fragments go to, like the frame's own recipients.'''
+        if length <= 0:
+            return
+        with self.condition:
+            self.queues[PRIORITY_BULK].append(self.__stream_fragments(chunks, length, recipients))
+            self.condition.notify_all()
+
+    def bulk_chunk_size(self) -> int:
+        '''The most bytes the transport sends in about BULK_CHUNK_AIRTIME seconds, in the mode it is in now'''
+        airtime = getattr(self.host_interface.transport, 'estimate_airtime', None)
+        if airtime is None or not airtime(MIN_BULK_CHUNK_SIZE):
+            return self.chunk_size
+        # airtime grows with the size, but in steps of whole frames plus the leader and trailer,
+        # so search for it rather than scaling from a rate
+        low, high = MIN_BULK_CHUNK_SIZE, MAX_BULK_CHUNK_SIZE
+        while low < high:
+            size = (low + high + 1) // 2
+            if airtime(size) <= BULK_CHUNK_AIRTIME:
+                low = size
+            else:
+                high = size - 1
+        return low
+
+    def fragment(self, data: bytes) -> list:
+        '''Split data into 'frag' frames, to the same recipients'''
+        frame = parse_frame(data)
+        recipients = ','.join(frame.recipients) if frame is not None else 'ALL'
+        message_id = os.urandom(3).hex()
+        chunk_size = self.bulk_chunk_size()
+        count = -(-len(data) // chunk_size)
+        fragments = []
+        for index in range(count):
+            chunk = data[index * chunk_size:(index + 1) * chunk_size]
+            fragments.append(self.__fragment_frame(recipients, message_id, index, count, chunk))
+        return fragments
+
+    def __fragment_frame(self, recipients: str, message_id: str, index: int, count: int, chunk: bytes) -> bytes:
+        return self.host_interface.build_frame(FRAGMENT_HANDLER, FRAGMENT_VERSION, chunk,
+                                               recipients=recipients, fields=(message_id, index, count))
+
+    def __stream_fragments(self, chunks, length: int, recipients: str):
+        # the same fragments fragment would make, built one at a time from whatever sizes chunks comes in.
+        # this runs once the first fragment is due, so they are sized for the mode the transport is in then
+        message_id = os.urandom(3).hex()
+        chunk_size = self.bulk_chunk_size()
+        count = -(-length // chunk_size)
+        chunks = iter(chunks)
+        buffer = bytearray()
+        try:
+            for index in range(count):
+                size = min(chunk_size, length - index * chunk_size)
+                while len(buffer) < size:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        # the receiver gives up on the fragments it has after FRAGMENT_TIMEOUT
+                        print(f"Stream ended {length - index * chunk_size - len(buffer)} bytes short, the rest of it is not sent")
+                        return
+                    buffer += chunk
+                yield self.__fragment_frame(recipients, message_id, index, count, bytes(buffer[:size]))
+                del buffer[:size]
+        finally:
+            # sent, failed or cleared, a generator reading a file closes it now
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    def pending(self) -> dict:
+        '''How many transmissions are waiting in each class, a stream counts as one'''
+        with self.condition:
+            return {priority: len(items) for priority, items in self.queues.items()}
+
+    def clear(self):
+        '''Forget everything not sent yet, like when the operator stops the transport'''
+        with self.condition:
+            for items in self.queues.values():
+                for item in items:
+                    if not isinstance(item, bytes):
+                        # a stream, let go of the file it reads from now
+                        item.close()
+                items.clear()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def __next_transmission(self):
+        # everything small that is waiting goes together, it all has to wait for the radio anyway.
+        # a bulk chunk only goes when nothing more urgent is waiting, so it is never held up for long
+        data = []
+        for priority in PRIORITIES[:-1]:
+            while self.queues[priority]:
+                data.append(self.queues[priority].popleft())
+                self.sent[priority] += 1
+        if not data:
+            chunk = self.__next_bulk()
+            if chunk:
+                data.append(chunk)
+                self.sent[PRIORITY_BULK] += 1
+        return b''.join(data)
+
+    def __next_bulk(self) -> bytes:
+        # a streamed frame stays at the front of the queue until its last fragment is out
+        queue = self.queues[PRIORITY_BULK]
+        while queue:
+            if isinstance(queue[0], bytes):
+                return queue.popleft()
+            try:
+                fragment = next(queue[0], None)
+            except Exception as e:
+                print(f"Transmit scheduler could not read a stream, dropping the rest of it: {e}")
+                fragment = None
+            if fragment is not None:
+                return fragment
+            queue.popleft()
+        return b''
+
+    def __work(self):
+        while True:
+            with self.condition:
+                while self.running and not any(self.queues.values()):
+                    self.condition.wait()
+                if not self.running:
+                    return
+                data = self.__next_transmission()
+            if not data:
+                # a stream that ended without another fragment
+                continue
+            try:
+                self.__send(data)
+            except Exception as e:
+                print(f"Transmit scheduler error: {e}")
+
+    def __send(self, data: bytes):
+        transport = self.host_interface.transport
+        if transport is None:
+            return
+        transport.append_bytes_to_buffer(data)
+        transport.on_transmit_buffer()
+        # hold the next transmission back until this one is on air and done,
+        # otherwise everything would pile up in the transport's buffer and nothing could go ahead of it
+        airtime = getattr(transport, 'estimate_airtime', None)
+        seconds = airtime(len(data)) if airtime else None
+        if transport.wait_until_sent((seconds or 0) * 2 + SEND_TIMEOUT) is None and seconds:
+            # the transport cannot tell us, so go by its estimate
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running, seconds)
+
+
+class FragmentReassembler:
+    def __init__(self):
+        '''Puts the 'frag' frames made by TransmitScheduler back together'''
+        # {(sender, message id): {'count': n, 'chunks': {index: bytes}, 'updated': time.time()}}
+        self.partial = {} # type: dict[tuple[str, str], dict]
+        self.lock = threading.Lock()
+
+    def add(self, frame) -> bytes:
+        '''Returns the original data once every fragment of it has arrived, otherwise None'''
+        try:
+            message_id, index, count = frame.fields[0], int(frame.fields[1]), int(frame.fields[2])
+        except (IndexError, ValueError):
+            print(f"Malformed fragment from {frame.sender}: {frame.fields}")
+            return None
+        if not 0 <= index < count:
+            return None
+        now = time.time()
+        key = (frame.sender, message_id)
+        with self.lock:
+            for stale in [old for old, entry in self.partial.items() if now - entry['updated'] > FRAGMENT_TIMEOUT]:
+                del self.partial[stale]
+            entry = self.partial.setdefault(key, {'count': count, 'chunks': {}, 'updated': now})
+            # a repeated fragment just replaces the copy we have
+            entry['chunks'][index] = frame.payload_bytes
+            entry['updated'] = now
+            if len(entry['chunks']) < entry['count']:
+                return None
+            del self.partial[key]
+        return b''.join(entry['chunks'][index] for index in range(entry['count']))
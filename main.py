@@ -8,8 +8,12 @@ import time
 import json
 from PluginManager import PluginManager
 from hamChatPlugin import hamChatPlugin
+from hamChatFrame import parse_frame, build_frame, frame_envelope, split_frames, is_callsign
+from hamChatProfiler import Profiler
+from hamChatScheduler import TransmitScheduler, FragmentReassembler, FRAGMENT_HANDLER, PRIORITY_CHAT
 import sys
 import socket
+import argparse
 
 info = """
 hamChat is a chat and file transfer application for amateur radio operators.
@@ -20,11 +24,12 @@ and needs a rewrite with better direction.
 Standard hamChat header format:
 0       1    2      3        4          5         6 (-1)
 N0CALL:chat:0.1:RECIPIENTS:BEGIN:Hello, YOURCALL!:END:
+A compact binary header is also understood, see hamChatFrame.
 """
 
 
 class HamChat(tk.Tk):
-    def __init__(self):
+    def __init__(self, profiler: Profiler = None):
         """
         This is the main application window for the ARDOP Chat application.
         all incoming and outgoing messages will be prefixed with a flexible header.
@@ -39,8 +44,12 @@ class HamChat(tk.Tk):
         Index 5: Payload (can be anything)
         Index -1: END Footer
         All other indexes until ":BEGIN:" are reserved for a plugin to use as it sees fit.
+        The same fields can be sent in a compact binary header instead, see hamChatFrame.
         """
-        tk.Tk.__init__(self)
+        # does nothing unless started with --profile
+        self.profiler = profiler or Profiler()
+        with self.profiler.timer('tk_init'):
+            tk.Tk.__init__(self)
         self.protocol("WM_DELETE_WINDOW", self.shutdown)
         self.version = '0.1'
         our_hostname = socket.gethostname()
@@ -52,11 +61,19 @@ class HamChat(tk.Tk):
             'recipients': 'ALL',
             'gridsquare': 'AA00AA',
             'selected_transport': 'ARDOP',
-            'use_message_history': 1
+            'use_message_history': 1,
+            # text: always send the classic text header
+            # binary: always send the compact binary header
+            # auto: send binary only to stations we know can read it, and tell everyone in our text frames that we can
+            'frame_format': 'auto',
+            # plugins (by name) that are not imported at startup, see PluginManager
+            'disabled_plugins': [],
         }
         self._load_settings_from_file()
         self.message_history = []
         self.plugin_preload_messages = []
+        # stations that sent us a binary frame, or a text frame saying they can read them, upper case
+        self.binary_capable_stations = set()
 
         self.die = threading.Event()
         self.ui_ready = threading.Event()
@@ -68,13 +85,25 @@ class HamChat(tk.Tk):
 
         # there is a race condition between the plugins needing to access to the ui and the ui being created
         self.plugMgr = PluginManager(host_interface=self)
-        self.plugMgr.load_plugins('plugins')
+        # everything we send goes through here, see transmit. It only uses the transport once there is something to send
+        self.transport = None
+        self.scheduler = TransmitScheduler(host_interface=self)
+        self.fragments = FragmentReassembler()
+        # each plugin's import and __init__ time is in plugMgr.load_times
+        with self.profiler.timer('load_plugins'):
+            self.plugMgr.load_plugins('plugins')
+        # modems and rigs connect in the background, the window does not wait for them
+        self.plugMgr.connect_plugins()
         self.transport = self.get_selected_transport()
         # avoid any issues with transports having a buffer that might interfere with messages
         self.plugMgr.on_clear_buffer()
         
-        self.create_widgets()
+        with self.profiler.timer('create_widgets'):
+            self.create_widgets()
         self.ui_ready.set()
+        self.profiler.mark('window_ready')
+        # the first time the event loop gets to us, the window is actually on screen
+        self.after_idle(self.profiler.mark, 'mainloop_idle')
 
         # list of last heard stations, a list of lists (may move to sqlite later)
         # [callsign, time, freq, mode, signal_strength, signal_quality] (callsign + time required, others if available)
@@ -250,7 +279,8 @@ class HamChat(tk.Tk):
         self.message_box.see(tk.END)
         self.message_box.pack(fill=tk.BOTH, expand=True)
         self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self._put_message_history_in_message_box()
+        with self.profiler.timer('_put_message_history_in_message_box'):
+            self._put_message_history_in_message_box()
 
         tk.Label(self.chat_entry_area_frame, text="Enter Message:").pack()
         self.chat_entry = tk.Entry(self.chat_entry_area_frame, width=60)
@@ -361,15 +391,12 @@ class HamChat(tk.Tk):
         sender = self.settings['callsign']
         recipients = self.get_recipients()
         # might move this into Core hamChatPlugin
-        # If this was in a plugin, this format would be the same except for any
+        # If this was in a plugin, this would be the same except for any
         # additional fields that the plugin would need to add to the header.
-        # the next three lines would be basically the same.
-        data = f"{sender}:chat:{self.version}:{recipients}:BEGIN:{message}:END:"
+        data = self.build_frame('chat', self.version, message.encode(), recipients=recipients)
         if self.debug.get():
             print(f"Sending data: {data}")
-        self.transport.append_bytes_to_buffer(data.encode())
-        # do plugins want the data that we are sending? Probably not, for now.
-        self.plugMgr.on_transmit_buffer()
+        self.transmit(data, PRIORITY_CHAT)
 
         self.chat_entry.delete(0, tk.END)
         # for our message box
@@ -378,56 +405,74 @@ class HamChat(tk.Tk):
         self.send_button['state'] = 'disabled'
         self.save_message_history()
 
+    def transmit(self, data: bytes, priority: str = PRIORITY_CHAT):
+        '''Send one or more hamChat frames on the selected transport. priority is 'ack', 'chat', 'beacon' or 'bulk',
+        see hamChatScheduler. Plugins should send through this, rather than loading the transport's buffer themselves.'''
+        self.scheduler.submit(data, priority)
+
+    def transmit_stream(self, handler: str, version: str, chunks, length: int, recipients: str = None, fields=()):
+        '''Send a payload too big to hold in memory, like a big file, as one bulk frame.
+        chunks is an iterable of bytes adding up to length bytes, it is read on the transmit scheduler's thread
+        a piece at a time as the frame goes out. The payload is sent as it is, it is not compressed.'''
+        if recipients is None:
+            recipients = self.get_recipients()
+        head, tail = frame_envelope(self.settings['callsign'], handler, version, recipients, length, fields=fields,
+                                    binary=self.use_binary_frames(recipients),
+                                    advertise_binary=self.settings.get('frame_format') == 'auto')
+
+        def framed():
+            # closing this closes chunks too, see TransmitScheduler.clear
+            yield head
+            yield from chunks
+            yield tail
+        self.scheduler.submit_stream(framed(), len(head) + length + len(tail), recipients)
+
+    def use_binary_frames(self, recipients: str) -> bool:
+        frame_format = self.settings.get('frame_format')
+        if frame_format == 'binary':
+            return True
+        if frame_format != 'auto':
+            return False
+        # everyone who might be listening has to be able to read it, so broadcasts stay text
+        # packed callsigns come back upper case, so compare them that way
+        recipients = [recipient.strip().upper() for recipient in recipients.split(',') if recipient.strip()]
+        if not recipients or 'ALL' in recipients:
+            return False
+        return all(recipient in self.binary_capable_stations for recipient in recipients)
+
+    def build_frame(self, handler: str, version: str, payload: bytes, recipients: str = None, fields=()) -> bytes:
+        '''Build a hamChat frame from our callsign, in whichever header format the recipients can read.
+        Plugins should use this rather than formatting headers themselves.'''
+        if recipients is None:
+            recipients = self.get_recipients()
+        # chat is ours, other handlers opt in to compression in their plugin definition
+        compress = handler == 'chat' or handler in self.plugMgr.compressed_handlers
+        # the transport knows what a byte costs on air, so it gets to judge if compressing is worth it
+        airtime = getattr(self.transport, 'estimate_airtime', None)
+        return build_frame(self.settings['callsign'], handler, version, recipients, payload,
+                           fields=fields, binary=self.use_binary_frames(recipients),
+                           compress=compress, airtime=airtime,
+                           advertise_binary=self.settings.get('frame_format') == 'auto')
+
     def is_callsign(self, callsign: str) -> bool:
         # callsigns are 4-9 characters, plus an optional SSID which may be a - followed by a two digit number
-        # minimum length is 4, maximum is 9
         callsign_in_header = callsign.split(':')[0]
-        callsign_length = len(callsign_in_header)
-        if callsign_length < 4 or callsign_length > 9:
-            return False
-        else:
-            return True
-    
+        return is_callsign(callsign_in_header)
 
     def has_hamChat_header(self, data: bytes) -> bool:
         # a hamChat header is a string that looks like this:
         # {sender}:{handler}:{version}:{recepients}:{optional multiple handler fields}:BEGIN:{data}:END:
         # example: N0CALL:chat:0.1:RECIPIENTS:BEGIN:Hello, YOURCALL!:END:
         # or for FileXfr: N0CALL:FileXfr:0.1:RECIPIENTS:FILENAME:FILESIZE:BEGIN:DATA:END:
-        # the first four fields are always the same.
+        # the first four fields are always the same. See hamChatFrame.parse_frame for the checks.
+        # binary frames, with their base 40 packed callsigns, are recognized as well.
         if self.debug.get():
             print(f"Checking data for hamChat header: {data}")
+        return parse_frame(data) is not None
 
-        # split the header by the : character, and decode it to a string
-        data_elements = data.decode().split(':')
-        # is there a callsign in the first field?
-        if not self.is_callsign(data_elements[0]):
-            print(f"Invalid callsign: {data_elements[0]}")
-            return False
-        # does a second field exist with a string that is not empty?
-        if not data_elements[1]:
-            print(f"Invalid handler: {data_elements[1]}")
-            return False
-        # is the third field a single decimal point float version number?
-        if not data_elements[2].split('.')[0].isdigit() or not data_elements[2].split('.')[1].isdigit():
-            print(f"Invalid version: {data_elements[2]}")
-            return False
-        # is the fourth field a callsign or ALL?
-        if not self.is_callsign(data_elements[3]) and data_elements[3] != "ALL":
-            print(f"Invalid recipients: {data_elements[3]}")
-            return False
-        # Is there a BEGIN field?
-        if not "BEGIN" in data_elements:
-            print(f"No BEGIN field: {data_elements}")
-            return False
-        # Is there an END field?
-        if not "END" in data_elements:
-            print(f"No END field: {data_elements}")
-            return False
-        return True
-        
     def listen_for_data(self):
         # this is run on its own thread
+        profiling = self.profiler.enabled
         while not self.die.is_set():
             try:
                 # an annoying issue is if we start hamChat, and for example, ardop was already running and decoded some
@@ -435,7 +480,9 @@ class HamChat(tk.Tk):
                 if self.transport.is_ready():
                     data: bytes = self.transport.on_get_data()
                 else:
-                    time.sleep(0.325)
+                    # transports that can tell us when they are ready save us polling
+                    if self.transport.wait_until_ready(1.0) is None:
+                        time.sleep(0.325)
                     continue
             except OSError:
                 # we are shutting down
@@ -443,43 +490,77 @@ class HamChat(tk.Tk):
             # sometimes there is a timeout and we get a NoneType.
             if not data:
                 continue
-            if not self.has_hamChat_header(data):
-                print(f"Nonstandard data: {data}")
+            if profiling:
+                received = time.perf_counter()
+            # a transmission may carry several queued messages back to back
+            frames, leftover = split_frames(data)
+            if profiling:
+                self.profiler.sample('split_frames', time.perf_counter() - received)
+            # reading a tk variable from this thread is not free, so only do it once per read
+            debug = self.debug.get()
+            for frame_data in frames:
+                if profiling:
+                    start = time.perf_counter()
+                self.handle_received_frame(frame_data, debug)
+                if profiling:
+                    # how long this frame took to get through to the plugin queues
+                    self.profiler.sample('handle_received_frame', time.perf_counter() - start)
+            if profiling:
+                # from the transport handing us the data, to every frame in it being handled
+                self.profiler.sample('receive_pipeline', time.perf_counter() - received)
+            if leftover:
+                print(f"Nonstandard data: {leftover}")
                 # this is nonstandard data, we will send it to the plugins to see if they can handle it
                 # hopefully they can without crashing.
-                self.plugMgr.on_payload_recieved(header=None, payload=data)
-                continue
-
-            # we have a hamChat header, let's parse it
-            if self.debug.get():
-                print(f"Received hamChat data: {data}")
-            header = data.split(b':BEGIN:')[0]
-            # log the contact in recent contacts
-            sender = header.split(b":")[0].decode()
-            timestamp = time.strftime("%H:%M:%S")
-            # try to get frequency and mode from IPC
-            # currently hardcoded to hamlib, but may change to a more generic rig control plugin (I am unaware of any other rig controls)
-            # I don't like how there is both IPC and specially named hooks. This may be confusing to plugin developers,
-            # because you can implement the same thing in two different ways. If plugins are to work with each other, they
-            # should use IPC, not hooks. Hooks are for the main application to use, and maybe it should be the only one to use them.
-            # I will think on this :^)
-            freq: dict = self.plugMgr.IPC(target_plugin="Hamlib", from_plugin="hamChat", command="get_radio_frequency")
-            mode: dict = self.plugMgr.IPC(target_plugin="Hamlib", from_plugin="hamChat", command="get_radio_mode")
-            self.log_recently_heard(sender, timestamp, freq=freq.get('radio_frequency'), mode=mode.get('radio_mode'))
-            # get everyting between :BEGIN: and :END:
-            payload = data.split(b':BEGIN:')[1].split(b':END:')[0]
-
-            # might move this block into Core hamChatPlugin
-            # we handle chat in the main application, not in a plugin because the chat is integral to the program
-            if b":chat:" in header:
-                recipents = header.split(b":")[3].decode()
-                message = f"{sender}->{recipents}: {payload.decode()}"
-                self.print_to_chatwindow(message, save=True)
-        
-            self.plugMgr.on_payload_recieved(header=header, payload=payload)
-            self.save_message_history()
+                self.plugMgr.on_payload_recieved(frame=None, payload=leftover)
         print("hamChat Data Listener Thread Exiting...")
 
+    def handle_received_frame(self, data: bytes, debug: bool = False):
+        # the frame is parsed once here, and shared with every plugin that handles it
+        frame = parse_frame(data)
+        if frame is None:
+            print(f"Nonstandard data: {data}")
+            self.plugMgr.on_payload_recieved(frame=None, payload=data)
+            return
+
+        if debug:
+            print(f"Received hamChat data: {frame}")
+        if frame.binary_capable:
+            self.binary_capable_stations.add(frame.sender.upper())
+        # log the contact in recent contacts
+        timestamp = time.strftime("%H:%M:%S")
+        # try to get frequency and mode from IPC
+        # currently hardcoded to hamlib, but may change to a more generic rig control plugin (I am unaware of any other rig controls)
+        # I don't like how there is both IPC and specially named hooks. This may be confusing to plugin developers,
+        # because you can implement the same thing in two different ways. If plugins are to work with each other, they
+        # should use IPC, not hooks. Hooks are for the main application to use, and maybe it should be the only one to use them.
+        # I will think on this :^)
+        freq: dict = self.plugMgr.IPC(target_plugin="Hamlib", from_plugin="hamChat", command="get_radio_frequency") or {}
+        mode: dict = self.plugMgr.IPC(target_plugin="Hamlib", from_plugin="hamChat", command="get_radio_mode") or {}
+        self.log_recently_heard(frame.sender, timestamp, freq=freq.get('radio_frequency'), mode=mode.get('radio_mode'))
+
+        # a piece of something big, the plugins only see it once it is all here
+        if frame.handler == FRAGMENT_HANDLER:
+            data = self.fragments.add(frame)
+            if data is not None:
+                frames, leftover = split_frames(data)
+                for frame_data in frames:
+                    self.handle_received_frame(frame_data, debug)
+            return
+
+        # might move this block into Core hamChatPlugin
+        # we handle chat in the main application, not in a plugin because the chat is integral to the program
+        if frame.handler == 'chat':
+            message = f"{frame.sender}->{','.join(frame.recipients)}: {frame.payload_bytes.decode(errors='replace')}"
+            self.print_to_chatwindow(message, save=True)
+            # an autoACK means what we sent got through, the transport may use that to pick how it sends next time
+            if frame.payload_bytes[:10] == b"autoACKed " and frame.is_addressed_to(self.settings['callsign']):
+                self.plugMgr.IPC(target_plugin=self.transport.definition['name'], from_plugin="hamChat",
+                                 command="acknowledged", data=frame.sender.encode())
+
+        self.plugMgr.on_payload_recieved(frame=frame)
+        self.save_message_history()
+
     def update_ui_transport_state(self):
         # tell the currently selected transport to create or update its status frame.
         # the reason for this jankiness, is if the user switches to another transport,
@@ -499,7 +580,7 @@ class HamChat(tk.Tk):
     def create_settings_menu(self):
         self.settings_menu = tk.Toplevel(self)
         self.settings_menu.title("Settings")
-        self.settings_menu.geometry("300x300")
+        self.settings_menu.geometry("450x300")
 
         # central frame for the two side-by-side columns
         # might be able to simplify later
@@ -526,6 +607,22 @@ class HamChat(tk.Tk):
         self.save_message_history_checkbutton = tk.Checkbutton(self.usersettings_frame, text="Save Message History", variable=self.save_message_history_var)
         self.save_message_history_checkbutton.pack()
 
+        self.frame_format_label = tk.Label(self.usersettings_frame, text="Header Format")
+        self.frame_format_label.pack()
+        self.frame_format_var = tk.StringVar()
+        self.frame_format_var.set(self.settings['frame_format'])
+        self.frame_format_menu = tk.OptionMenu(self.usersettings_frame, self.frame_format_var, 'auto', 'text', 'binary')
+        self.frame_format_menu.pack()
+
+        # right side frame for turning plugins on and off
+        self.pluginsettings_frame = tk.Frame(self.settings_frame)
+        self.enabled_plugins_label = tk.Label(self.pluginsettings_frame, text="Enabled Plugins")
+        self.enabled_plugins_label.pack()
+        self.enabled_plugin_vars = {} # type: dict[str, tk.BooleanVar]
+        for name, enabled in self.plugMgr.get_available_plugins():
+            self.enabled_plugin_vars[name] = tk.BooleanVar(value=enabled)
+            tk.Checkbutton(self.pluginsettings_frame, text=name, variable=self.enabled_plugin_vars[name]).pack(anchor=tk.W)
+
         # button box frame
         self.settingsbuttons_frame = tk.Frame(self.settings_menu)
         self.save_button = tk.Button(self.settingsbuttons_frame, text="Save", command=self.save_settings)
@@ -535,6 +632,7 @@ class HamChat(tk.Tk):
 
         self.settings_frame.pack()
         self.usersettings_frame.pack(side=tk.LEFT)
+        self.pluginsettings_frame.pack(side=tk.LEFT, padx=10)
         # plugins will have their own settings menus and saving/loading them.
         # it's up to them to give themselves a button to open up their settings menu
         # if their settings can't fit in their plugin frame entry.
@@ -545,18 +643,41 @@ class HamChat(tk.Tk):
         self.settings['gridsquare'] = self.gridsquare_entry.get()
         self.settings['use_message_history'] = self.save_message_history_var.get()
         self.settings['recipients'] = self.recipients_entry.get()
+        self.settings['frame_format'] = self.frame_format_var.get()
+        self.update_enabled_plugins()
         self._save_settings_to_file()
         self.print_to_chatwindow(f"Client Settings Updated" )
         self.settings_menu.destroy()
         # tell transports/plugins that we have new settings
         self.plugMgr.on_settings_update()
 
+    def update_enabled_plugins(self):
+        disabled = [name for name, var in self.enabled_plugin_vars.items() if not var.get()]
+        for name in set(disabled) - set(self.settings['disabled_plugins']):
+            self.print_to_chatwindow(f"{name} will not be loaded the next time hamChat starts")
+        # plugins that were just enabled can be started right away
+        for name in set(self.settings['disabled_plugins']) - set(disabled):
+            plugin = self.plugMgr.load_plugin(name)
+            if plugin:
+                plugin.create_plugin_frame(self.plugins_frame)
+                self.print_to_chatwindow(f"Loaded plugin {name}")
+        self.settings['disabled_plugins'] = disabled
+
     def shutdown(self):
         print("Shutting Down...")
+        self.scheduler.stop()
         self.plugMgr.on_clear_buffer()
         self.plugMgr.on_unkey_transmitter()
         self.die.set()
+        # the queues are gone once the plugins shut down
+        dispatch_metrics = self.plugMgr.get_dispatch_metrics()
         self.plugMgr.on_shutdown() 
+        self.profiler.write_report({
+            'plugin_load_times': self.plugMgr.load_times,
+            'plugin_connect_times': self.plugMgr.connect_times,
+            'plugin_dispatch_queues': dispatch_metrics,
+            'ptt_latency': self.plugMgr.get_ptt_latency(),
+        })
         sys.exit()
 
 class EntryWithPlaceholder(tk.Entry):
@@ -575,5 +696,14 @@ class EntryWithPlaceholder(tk.Entry):
         self.insert(0, text)
 
 if __name__ == '__main__':
-    hamChatUI = HamChat()
+    parser = argparse.ArgumentParser(description="hamChat, chat and file transfer for amateur radio")
+    parser.add_argument('--profile', action='store_true',
+                        help="time startup and the receive path, and write a JSON report on exit")
+    parser.add_argument('--profile-output', default='hamchat_profile.json', metavar='FILE',
+                        help="where to write the --profile report (default: %(default)s)")
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help="with --profile, also write a cProfile dump of the UI thread to FILE")
+    args = parser.parse_args()
+    profiler = Profiler(enabled=args.profile, report_path=args.profile_output, cprofile_path=args.cprofile)
+    hamChatUI = HamChat(profiler=profiler)
     hamChatUI.mainloop()
@@ -1,12 +1,19 @@
 import socket
-import time
+import select
+import selectors
+import queue
 import threading
 import tkinter as tk
 from tkinter import ttk
 import json
 import os
+import time
 #type help
 from hamChatPlugin import hamChatPlugin
+from hamChatFrame import split_frames, parse_frame
+from _ardop_host import CommandLineReader, FrameReader, FECModeSelector, apply_response, response_verb, NOTIFICATIONS
+from _ardop_host import BufferLoader, ARQSession, StateWatcher, BUFFER_QUERY_INTERVAL
+from _ardop_host import RATE_TABLE, FRAME_DATA_BYTES, estimate_fec_airtime, cw_id_seconds
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from main import HamChat
@@ -20,6 +27,10 @@ mycall my_plugin version yourcalls BEGIN my_message_or_data END
 N0CALL:chat:0.1:RECIPIENTS:BEGIN:Hello, YOURCALL!:END:
 """
 
+# seconds between attempts to reconnect to ardopcf, doubling each time it fails
+RECONNECT_DELAY_MIN = 0.5
+RECONNECT_DELAY_MAX = 10
+
 class ARDOPCF(hamChatPlugin):
     def __init__(self, host_interface: HamChat):
         self.info = """
@@ -36,21 +47,55 @@ class ARDOPCF(hamChatPlugin):
             'transport': 'ARDOP',
             'handlers': [],
             'protocol_fields': [],
+            # seconds to wait for ardopcf to accept the connection
+            'connect_timeout': 5,
             'depends_on': [{'plugin': 'Core', 'version': '0.1'}],
         }
         self.sock_cmd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock_data = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         self.stop_event = threading.Event()
+        # set while we are connected to ardopcf. self.ready mirrors it for tk, on the main thread
+        self.connected = threading.Event()
         self.data_transfer_complete = threading.Event()
-        self.command_response_history = []
-        self.pending_buffers = []
+        # every line ardopcf sends on the command socket goes through here, see run_io_loop
+        self.command_reader = CommandLineReader()
+        # notifications like NEWSTATE go out first, then every line updates our copy of the TNC state
+        self.command_reader.subscribe(self.handle_notification)
+        self.command_reader.subscribe(self.handle_command_response)
+        # PTT skips all of that, it has to reach the radio within about 50ms
+        self.command_reader.set_ptt_handler(self.handle_ptt)
+        # puts data socket frames together into hamChat messages, keeping what is not complete yet
+        self.frame_reader = FrameReader()
+        # streams outgoing data into the TNC as fast as it sends it, see _load_buffer
+        self.buffer_loader = BufferLoader(self.write_data_chunk, lambda: self.cmd_response(command='BUFFER'))
+        # follows STATE, BUFFER and PTT from what ardopcf tells us, so we hardly ever have to ask
+        self.state_watcher = StateWatcher(self.on_tnc_state_changed)
+        # complete messages, waiting for on_get_data
+        self.received_messages = queue.Queue() # type: queue.Queue[bytes]
+        # writing to this wakes the io loop up, to stop or to reconnect
+        self.wake_receiver, self.wake_sender = socket.socketpair()
+        self.wake_receiver.setblocking(False)
+        # frames appended since the last on_transmit_buffer, they go out in one transmission
+        self.pending_buffers = [] # type: list[bytes]
+        self.pending_lock = threading.Lock()
+        # cleared when we are told to transmit, and set again once all of it has gone out, see check_sent
+        self.transmit_done = threading.Event()
+        self.transmit_done.set()
+        # all of the transmission is loaded, it is done once ardopcf's buffer is empty
+        self.awaiting_drain = False
+        # the station we last pinged, PINGACK does not say who answered
+        self.pinged_station = None
+        # initialize_arq has sent our ARQ settings since we last connected or changed them
+        self.arq_initialized = False
         self.host_interface = host_interface
         
         self.ready = tk.StringVar()
-        self.ardop_status_label = tk.Label()
+        # the widgets are made when the host shows us, see create_plugin_frame and on_ui_transport_status_frame,
+        # so the plugin can run without a window, like in tools/emulator_smoke_test.py
+        self.ardop_status_label = None # type: tk.Label
         self.transport_status_frame_text = tk.StringVar()
-        self.status_frame = tk.Frame()
+        self.status_frame = None # type: tk.Frame
 
         self.fec_modes = [
             '4FSK.200.50S',
@@ -73,30 +118,8 @@ class ARDOPCF(hamChatPlugin):
             '4FSK.2000.600S'
         ]
 
-        self.rate_table = {
-            # everything that's 0 is not in the datasheet.
-            '4FSK.200.50S': 310,
-            '4PSK.200.100S': 436,
-            '4PSK.200.100': 756,
-            '8PSK.200.100': 1286,
-            '16QAM.200.100': 1512,
-
-            '4FSK.500.100S': 0, 
-            '4FSK.500.100': 0,
-            '4PSK.500.100': 1509,
-            '8PSK.500.100': 2566,
-            '16QAM.500.100': 3024,
-
-            '4PSK.1000.100': 3018,
-            '8PSK.1000.100': 5133,
-            '16QAM.1000.100': 6036,
-
-            '4PSK.2000.100': 6144,
-            '8PSK.2000.100': 10386,
-            '16QAM.2000.100': 12072,
-            '4FSK.2000.600': 0,
-            '4FSK.2000.600S': 0
-        }
+        # bytes per minute for each FEC mode, see _ardop_host.RATE_TABLE
+        self.rate_table = dict(RATE_TABLE)
 
         self.arq_bw_modes = [
             '2000MAX',
@@ -142,14 +165,23 @@ class ARDOPCF(hamChatPlugin):
             'protocol_mode': 'FEC',
             'fec_repeats': 0,
             'fecid': False,
+            # pick fec_mode for every transmission from the link to the recipients, see FECModeSelector
+            'fec_auto': False,
             # ARQ mode states
             'arq_dialing_quantity': 2, # 2-15
             'arqbw': '1000MAX',
             'arqtimeout': 30, # 30-240
+            # seconds an idle ARQ link is kept up for the next message before we disconnect it, see ARQSession
+            'arq_idle_timeout': 25, # 0-240
             'autobreak': True,
             'busyblock': True,
             'callbw': self.arq_bw_modes[2],
         }
+        # compares modes by how long they would keep the channel busy
+        self.fec_selector = FECModeSelector(self.fec_modes, self.rate_table, self.estimate_airtime)
+        # the mode fec_auto picked for the last transmission, None while ardopcf is on state['fec_mode'].
+        # kept apart so the mode picked in the settings is what gets saved
+        self.selected_fec_mode = None # type: str
         
 
         # on protocolchange, we query ardopcf for these settings
@@ -178,6 +210,10 @@ class ARDOPCF(hamChatPlugin):
             'version',
         ]
         self._load_settings_from_file()
+        # keeps the ARQ link up between messages to the same station
+        self.arq_session = ARQSession(lambda command: self.cmd_response(command=command), self.arq_call,
+                                      self.buffer_loader.wait_until_empty, self.on_arq_link_lost,
+                                      self.state['arq_idle_timeout'])
         self.ardop_host_var = tk.StringVar()
         self.ardop_host_var.set(self.state.get('host'))
         self.ardop_port_var = tk.IntVar()
@@ -234,12 +270,16 @@ class ARDOPCF(hamChatPlugin):
         self.protocol_mode_var.set(self.state.get('protocol_mode'))
         self.fec_repeats_var = tk.IntVar()
         self.fec_repeats_var.set(self.state.get('fec_repeats'))
+        self.fec_auto_var = tk.BooleanVar()
+        self.fec_auto_var.set(self.state.get('fec_auto'))
         self.arq_dialing_quantity_var = tk.IntVar()
         self.arq_dialing_quantity_var.set(self.state.get('arq_dialing_quantity'))
         self.arqbw_var = tk.StringVar()
         self.arqbw_var.set(self.state.get('arqbw'))
         self.arqtimeout_var = tk.IntVar()
         self.arqtimeout_var.set(self.state.get('arqtimeout'))
+        self.arq_idle_timeout_var = tk.IntVar()
+        self.arq_idle_timeout_var.set(self.state.get('arq_idle_timeout'))
         self.autobreak_var = tk.BooleanVar()
         self.autobreak_var.set(self.state.get('autobreak'))
         self.busyblock_var = tk.BooleanVar()
@@ -248,22 +288,51 @@ class ARDOPCF(hamChatPlugin):
         self.callbw_var.set(self.state.get('callbw'))
 
         self.record_command_response = False
-        # initialize the ARDOPC client
-        self.connect_to_ardopcf()
-        #self.init_tnc() # we end up doing this in listen_for_command_responses
+        # we connect to the ARDOPC client in on_connect, in the background
+        # what is shown in self.ready, so update_plugin_frame only touches tk when it changes
+        self.shown_ready = None
+        self.io_thread = threading.Thread(target=self.run_io_loop, name="ARDOPCF io")
 
-        self.command_listen = threading.Thread(target=self.listen_for_command_responses)
-        self.command_listen.start()
+    def on_connect(self, timeout: float):
+        # this is on a background thread, so a TNC that is not running does not hold up the window
+        self.connect_to_ardopcf(timeout)
+        # the io loop keeps trying to reconnect if we could not connect yet
+        self.io_thread.start()
 
+    def wait_until_ready(self, timeout: float) -> bool:
+        return(self.connected.wait(timeout))
+
+    def wake_io_loop(self):
+        try:
+            self.wake_sender.send(b'\0')
+        except OSError:
+            pass
+
+    def update_plugin_frame(self):
+        # we connect and disconnect on other threads, tk only hears about it here on the main thread
+        ready = self.is_ready()
+        if ready == self.shown_ready or self.ardop_status_label is None:
+            return
+        self.shown_ready = ready
+        if ready:
+            self.ready.set("Ready")
+            self.ardop_status_label.config(fg='green')
+        else:
+            self.ready.set("Not Ready")
+            self.ardop_status_label.config(fg='red')
         
-    def arq_call(self):
-        callsign = self.host_interface.get_recipients().split(',')[0]
-        self.initialize_arq()
+    def arq_call(self, callsign: str = None):
+        if callsign is None:
+            callsign = self.host_interface.get_recipients().split(',')[0]
+        # the settings only need sending again if they changed, or ardopcf was restarted
+        if not self.arq_initialized or self.state.get('protocol_mode') != 'ARQ':
+            self.initialize_arq()
         self.cmd_response(command=f'ARQCALL {callsign} {self.state.get("arq_dialing_quantity")}')
 
     def ping(self):
         # to ping we need mode to be arq, listen to be true, and to have a call sign to ping
         callsign = self.host_interface.get_recipients().split(',')[0]
+        self.pinged_station = callsign
         self.cmd_response(command='PROTOCOLMODE ARQ')
         self.cmd_response(command=f'LISTEN {str(self.state.get("listen"))}')
         self.cmd_response(command=f'PING {callsign} {self.state.get("ping_count")}')
@@ -284,12 +353,10 @@ class ARDOPCF(hamChatPlugin):
         self.cmd_response(command=f'LISTEN {str(self.state.get("listen"))}')
         self.cmd_response(command=f'ENABLEPINGACK {str(self.state.get("enablepingack"))}')
         self.cmd_response(command=f'USE600MODES {str(self.state.get("use600modes"))}')
+        self.arq_initialized = True
 
     def is_ready(self):
-        try:
-            return(self.ready.get() == "Ready")
-        except RuntimeError:
-            return(False)
+        return(self.connected.is_set())
 
     def is_socket_connected(self, sock):
         try:
@@ -299,47 +366,48 @@ class ARDOPCF(hamChatPlugin):
         except OSError:
             return False
 
-    def connect_to_ardopcf(self):
-        # this will not stop calling itself until we are in a connected state
-
+    def connect_to_ardopcf(self, timeout: float = None):
+        # the io loop keeps calling this until we are in a connected state
+        # this blocks for up to timeout seconds per socket, never call it on the main thread
+        if timeout is None:
+            timeout = self.definition['connect_timeout']
         try:
+            self.sock_cmd.settimeout(timeout)
             self.sock_cmd.connect((self.state.get('host'), int(self.state.get('port'))))
             self.sock_cmd.setblocking(False)
+            self.command_reader.reset(self.sock_cmd)
+            self.sock_data.settimeout(timeout)
             self.sock_data.connect((self.state.get('host'), int(self.state.get('port'))+1))
             self.sock_data.setblocking(False)
-            time.sleep(0.1)
+            self.frame_reader.reset()
+            # commands are only sent once we are connected
+            self.state_watcher.reset()
+            self.connected.set()
             self.init_tnc_fec()
-            self.ready.set("Ready")
-            self.ardop_status_label.config(fg='green')
         except OSError:
-            if self.is_socket_connected(self.sock_cmd):
-                self.sock_cmd.close()
-            if self.is_socket_connected(self.sock_data):
-                self.sock_data.close()
-            time.sleep(0.1)
-            self.sock_cmd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock_data = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-            try:
-                self.ready.set("Not Ready")
-                self.ardop_status_label.config(fg='red')
-            except RuntimeError:
-                # this is a catch for the case where the plugin is being shut down without being connected
-                pass
-            
+            self.connected.clear()
+            self.reset_ardop_sockets()
+
+    def reset_ardop_sockets(self):
+        # a socket can only connect once, so every attempt starts with new ones
+        self.sock_cmd.close()
+        self.sock_data.close()
+        self.sock_cmd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock_data = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     def init_tnc_fec(self):
         print("ARDOP Initializing TNC in FEC Mode")
+        self.arq_initialized = False
+        # ardopcf works through its commands in order, we do not need to wait for it here
         self.cmd_response(command='INITIALIZE')
         self.cmd_response(command='PROTOCOLMODE FEC')
         self.set_tnc_settings()
-        time.sleep(0.25)
 
     def show_help_window(self):
         help_window = tk.Toplevel()
         help_window.title("ARDOPCF Help")
         help_text = self.info + """Some data rates do not have a corresponding data rate in the datasheet.
-        These will show up at 0.0m in the time to send estimate.
+        These are estimated, so the time to send estimate is rougher for those modes.
         """
         tk.Label(help_window, text=help_text).pack()
 
@@ -361,7 +429,7 @@ class ARDOPCF(hamChatPlugin):
         command = self.command_entry.get()
         self.command_history_text.insert(tk.END, f"Sent: {command}\n")
         self.record_command_response = True
-        self.cmd_response(command=command, wait=False)
+        self.cmd_response(command=command)
         self.command_entry.delete(0, tk.END)
         self.command_history_text.see(tk.END)
 
@@ -373,7 +441,7 @@ class ARDOPCF(hamChatPlugin):
             string += '\r'
             self.sock_cmd.sendall(string.encode())
         except BrokenPipeError or OSError:
-            self.ready.set("Not Ready")
+            self.connected.clear()
             print("Connection to ARDOPCF lost.")
             return
 
@@ -398,11 +466,14 @@ class ARDOPCF(hamChatPlugin):
         if self.state['host'] != self.ardop_host_var.get() or self.state['port'] != self.ardop_port_var.get():
             self.state['host'] = self.ardop_host_var.get()
             self.state['port'] = self.ardop_port_var.get()
-            self.ready.set("Not Ready")
-            self.ardop_status_label.config(fg='red')
-            self.connect_to_ardopcf()
+            # the io loop reconnects in the background once the old sockets are gone
+            self.connected.clear()
+            self.sock_cmd.close()
+            self.sock_data.close()
+            self.wake_io_loop()
         
         self.update_state_from_settings()
+        self.arq_initialized = False
         
         self._save_settings_to_file()
         # If the host application change their settings, 
@@ -410,21 +481,22 @@ class ARDOPCF(hamChatPlugin):
             self.settings_window.destroy()
         if not self.is_ready():
             return
-        self.cmd_response(command=f'MYCALL {self.state["mycall"]}', wait=False)
-        self.cmd_response(command=f'GRIDSQUARE {self.state["gridsquare"]}', wait=False)
-        self.cmd_response(command=f'FECMODE {self.state["fec_mode"]}', wait=False)
-        self.cmd_response(command=f'FECREPEATS {self.state["fec_repeats"]}', wait=False)
+        self.cmd_response(command=f'MYCALL {self.state["mycall"]}')
+        self.cmd_response(command=f'GRIDSQUARE {self.state["gridsquare"]}')
+        self.selected_fec_mode = None
+        self.cmd_response(command=f'FECMODE {self.state["fec_mode"]}')
+        self.cmd_response(command=f'FECREPEATS {self.state["fec_repeats"]}')
 
     def set_tnc_settings(self):
         for command in self.info_commands:
             if command == 'state' or command == 'buffer':
                 continue # these are read only
             command = command + ' ' + str(self.state.get(command))
-            self.cmd_response(command=command, wait=False)
+            self.cmd_response(command=command)
 
     def query_tnc_settings(self):
         for command in self.info_commands:
-            self.cmd_response(command=command, wait=False)
+            self.cmd_response(command=command)
         self.update_state_from_settings()
 
     def create_settings_tab_general(self, general_tab):
@@ -526,6 +598,9 @@ class ARDOPCF(hamChatPlugin):
         self.fec_repeats_var.set(self.state['fec_repeats'])
         self.fec_repeats_scale.pack()
 
+        self.fec_auto_check = ttk.Checkbutton(fec_tab, text="Pick FEC Mode From Link Quality", variable=self.fec_auto_var)
+        self.fec_auto_check.pack()
+
     def create_settings_tab_arq(self, arq_tab):
         # ARQ Dialing Quantity
         ttk.Label(arq_tab, text="Dialing Attempts:").grid(row=0, column=0, sticky=tk.W, padx=5, pady=5)
@@ -543,6 +618,11 @@ class ARDOPCF(hamChatPlugin):
         self.arqtimeout_entry = ttk.Spinbox(arq_tab, from_=30, to=240, width=20, textvariable=self.arqtimeout_var)
         self.arqtimeout_entry.grid(row=2, column=1, sticky=tk.EW, padx=5, pady=5)
 
+        # Idle Disconnect
+        ttk.Label(arq_tab, text="Idle Disconnect (s):").grid(row=6, column=0, sticky=tk.W, padx=5, pady=5)
+        self.arq_idle_timeout_entry = ttk.Spinbox(arq_tab, from_=0, to=240, width=20, textvariable=self.arq_idle_timeout_var)
+        self.arq_idle_timeout_entry.grid(row=6, column=1, sticky=tk.EW, padx=5, pady=5)
+
         # Auto Break
         #self.autobreak_check = ttk.Checkbutton(arq_tab, text="Auto Break", variable=self.autobreak_var)
         #self.autobreak_check.grid(row=3, column=0, sticky=tk.W, padx=5, pady=5)
@@ -623,9 +703,8 @@ class ARDOPCF(hamChatPlugin):
         ardop_label.pack(side=tk.LEFT)
         self.ardop_status_label = tk.Label(statusframe, textvariable=self.ready)
         self.ardop_status_label.pack(side=tk.RIGHT)
-        if self.is_ready():
-            self.ready.set("Ready")
-            self.ardop_status_label.config(fg='green')
+        self.shown_ready = None
+        self.update_plugin_frame()
         protocol_label = tk.Label(ardop_frame, text="Protocol Mode")
         protocol_label.pack()
         protocolmode_selector = tk.OptionMenu(ardop_frame, self.protocolmode_var, 'FEC', 'ARQ', 'RXO', command=self.on_protocol_mode_change)
@@ -634,15 +713,17 @@ class ARDOPCF(hamChatPlugin):
         ping_button.pack()
         ardop_button = tk.Button(ardop_frame, text="Configure", command=self.create_settings_menu)
         ardop_button.pack(side=tk.BOTTOM)
-        self.clear_buffer_button = tk.Button(ardop_frame, text="Stop/Clear Buffer", command=self.on_clear_buffer)
+        self.clear_buffer_button = tk.Button(ardop_frame, text="Stop/Clear Buffer", command=self.stop_transmitting)
         self.clear_buffer_button.pack(side=tk.BOTTOM)
         ardop_frame.pack()
 
     def on_ui_transport_status_frame(self, tkParent: tk.Frame):
         status_text = self.state.get('state')
         status_text += f" | BUFFER:{self.state.get('buffer')}"
+        if self.pending_buffers:
+            status_text += f" (+{sum(len(data) for data in self.pending_buffers)} queued)"
         status_text += f" | TTS: {self.estimate_time_to_send()}m "
-        status_text += f"@ {self.state.get('fec_mode')}"
+        status_text += f"@ {self.current_fec_mode()}"
 
         if not self.is_ready():
             status_text = "Not Connected"
@@ -664,11 +745,30 @@ class ARDOPCF(hamChatPlugin):
             self.status_frame.pack()
 
     def on_transport_state_update(self):
-        # logic to bug tnc for state updates
-        self.cmd_response(command='STATE', wait=False)
-        self.cmd_response(command='BUFFER', wait=False)
+        # ardopcf tells us itself when its state, buffer or PTT change, see handle_command_response.
+        # Asking every time we are called would keep the command socket busy for nothing,
+        # so we only ask when it has been quiet for a while, in case we missed something.
+        if not self.is_ready() or not self.state_watcher.poll_due(self.state):
+            return
+        self.cmd_response(command='STATE')
+        self.cmd_response(command='BUFFER')
+
+    def on_tnc_state_changed(self, changes: dict):
+        # on the io loop's thread, plugins are told on their own, see PluginManager.on_transport_state_changed
+        if self.host_interface.debug.get():
+            print(f"ARDOPCF state changed: {changes}")
+        self.host_interface.plugMgr.on_transport_state_changed(self, changes)
 
     def append_bytes_to_buffer(self, data : bytes):
+        # frames are queued here, and loaded into the TNC together by on_transmit_buffer.
+        # Every transmission pays for the ARDOP leader, trailer and PTT turnaround, so the
+        # scheduler hands us everything that is waiting before asking for one.
+        if not data:
+            return
+        with self.pending_lock:
+            self.pending_buffers.append(data)
+
+    def _load_buffer(self, source, start=None) -> int:
         # ARDOPCF is a single-threaded application, and it spends most of
         # its time processing incoming audio to decode for frames.
         # Because of this, it doesn't immediately intake new data or commands from their sockets,
@@ -677,80 +777,241 @@ class ARDOPCF(hamChatPlugin):
         # another plugin may send data to the buffer, and the TNC will not have processed
         # the first data before the second data is loaded. A message may sit in the
         # outgoing buffer until a new message is loaded and sent.
-        
-        # you CANNOT sleep in any loops here.
 
+        # BufferLoader paces the loading by the BUFFER reports ardopcf sends us (see handle_command_response),
+        # keeping its buffer between the watermarks instead of guessing how long to wait.
+        # source can be bytes, a binary file or an iterable of bytes, only one chunk of it is held at a time.
+        # start is called once ardopcf has the first of it, to tell it to send.
+        # This blocks until all of source is loaded, so never call it from the io loop, the reports come from there.
         if not self.is_ready():
-            return
-        if not data:
-            return
-    
-
-        # if the data is too long, we can't send it without splitting it up
-        # 1000 byte chunks seems comfortable. Every 1000 bytes seem to take about 200ms to load
-        est_rate = (len(data) / 1000) * 1.5
-        reasonable_timeout_value = int(est_rate) if int(est_rate) > 2 else 2
-        for i in range(0, len(data), 1000):
-            data_chunk = data[i:i+1000]
-            # data format is <2 bytes for length><data>
-            # data should already come here with the hamChat standard header
-            data_length = len(data_chunk).to_bytes(2, 'big')
-            data_chunk = data_length + data_chunk
-            self.sock_data.sendall(data_chunk)
-
-        # wait until the TNC reports the buffer size that we tried to load
-        load_timeout = 0
-        while self.state.get('buffer') < len(data):
-            time.sleep(0.2)
-            load_timeout += 1
-            buff_report = self.cmd_response(command='BUFFER', wait=True) # Warning: this has possibility to make us miss a PTT command
-            if len(buff_report.split(' ')) > 1:
-                try:
-                    self.state['buffer'] = int(buff_report.split(' ')[1])
-                except ValueError:
-                    pass # we keep competing for time with the socket. Need to find a better way.
-            
-            if load_timeout > reasonable_timeout_value:
-                print(f"ARDOP Buffer Load Timeout (tried loading {len(data)} bytes, got {self.state.get('buffer')} bytes)")
-                break
-
+            return(0)
+        try:
+            written = self.buffer_loader.stream(source, start)
+        except (OSError, ValueError) as e:
+            # the data socket broke or was closed under us, the io loop reconnects
+            print(f"ARDOP Buffer Load failed: {e}")
+            return(0)
         if self.host_interface.debug.get():
-            print(f"ARDOP Buffer Ready: {self.state.get('buffer')} bytes.")
+            print(f"ARDOP Buffer Ready: loaded {written} bytes, {self.state.get('buffer')} bytes in the TNC.")
+        return(written)
+
+    def write_data_chunk(self, chunk: bytes):
+        # data format is <2 bytes for length><data>
+        # data should already come here with the hamChat standard header
+        view = memoryview(len(chunk).to_bytes(2, 'big') + chunk)
+        # the data socket is non-blocking for the io loop, so wait for room instead of failing
+        while view:
+            select.select([], [self.sock_data], [], BUFFER_QUERY_INTERVAL)
+            try:
+                sent = self.sock_data.send(view)
+            except BlockingIOError:
+                continue
+            view = view[sent:]
 
-    def on_transmit_buffer(self):
+    def start_sending(self):
+        # tell ardopcf to send what is in its buffer
         if self.state['protocol_mode'] == 'ARQ':
-            self.arq_call()
+            self.arq_session.open(self.default_arq_peer())
         elif self.state['protocol_mode'] == 'FEC':
-            self.cmd_response(command='FECSEND TRUE', wait=False)
-        else:
-            pass
+            self.cmd_response(command='FECSEND TRUE')
+
+    def on_transmit_buffer(self):
+        with self.pending_lock:
+            data = b''.join(self.pending_buffers)
+            self.pending_buffers = []
+            self.awaiting_drain = False
+            if data:
+                self.transmit_done.clear()
+        if not data:
+            self.transmit_done.set()
+            return
+        if self.host_interface.debug.get():
+            print(f"ARDOP sending {len(data)} bytes in one transmission")
+        if not self.is_ready():
+            # nothing will go out, do not keep the scheduler waiting for PTT
+            self.transmit_done.set()
+            return
+        if self.state['protocol_mode'] not in ('ARQ', 'FEC'):
+            # receive only, ardopcf would hold on to it without ever sending
+            self.transmit_done.set()
+            return
+        if self.state['protocol_mode'] == 'ARQ':
+            self.send_arq(data)
+            return
+        recipients = set()
+        if self.state.get('fec_auto'):
+            recipients = self.select_fec_mode(data)
+        elif self.selected_fec_mode is not None:
+            # fec_auto was turned off, go back to the mode from the settings
+            self.selected_fec_mode = None
+            self.cmd_response(command=f'FECMODE {self.state["fec_mode"]}')
+        written = self._load_buffer(data, self.start_sending)
+        if written < len(data) and not self.buffer_loader.cancelled:
+            # not stopped by the user, the recipients did not get all of it
+            for callsign in recipients - {'ALL'}:
+                self.fec_selector.record_failure(callsign)
+        if written < len(data):
+            # stopped, or ardopcf went away, the rest is not going out
+            self.transmit_done.set()
+            return
+        self.finish_when_sent()
+
+    def send_arq(self, data: bytes):
+        # an ARQ link carries everything to one station, so the frames are sent station by station,
+        # over the link that is already up to that station if there is one, see ARQSession
+        # the last group is still in ardopcf's buffer unless its link was lost while we loaded it
+        loaded_last = False
+        for peer, group in self.group_by_arq_peer(data):
+            if not self.arq_session.prepare(peer, self.state.get('arqtimeout')):
+                print(f"ARDOP could not free the ARQ link for {peer}, dropping {len(group)} bytes")
+                break
+            written = self._load_buffer(group, lambda peer=peer: self.arq_session.open(peer))
+            loaded_last = written == len(group)
+            if not written:
+                break
+        if not loaded_last:
+            self.transmit_done.set()
+            return
+        self.finish_when_sent()
+
+    def finish_when_sent(self):
+        # everything is loaded, so the next time ardopcf's buffer is empty, it has all gone out
+        self.awaiting_drain = True
+        self.check_sent()
+
+    def check_sent(self):
+        # called on every BUFFER and PTT report. In FEC the last frame is still on air when the buffer
+        # empties, so it is done when PTT drops too. An ARQ link keys up for every frame and stays up after,
+        # so PTT says nothing there, the buffer only empties once the other station has ACKed all of it
+        if not self.awaiting_drain or self.buffer_loader.level() != 0:
+            return
+        if self.state['protocol_mode'] != 'ARQ' and self.state.get('ptt'):
+            return
+        self.awaiting_drain = False
+        self.transmit_done.set()
+
+    def on_arq_link_lost(self, peer: str, failed: bool):
+        # whatever is still in the buffer was for the station that is gone,
+        # it must not go out to the next station we connect to
+        if failed:
+            # they never answered, or the link dropped with data still to go
+            self.fec_selector.record_failure(peer)
+        self.buffer_loader.cancel()
+        self.cmd_response(command='PURGEBUFFER')
+        if self.awaiting_drain:
+            # nothing more of it is going out. While we are still loading, send_arq goes on to the next station
+            self.awaiting_drain = False
+            self.transmit_done.set()
+
+    def default_arq_peer(self) -> str:
+        # who frames for everyone go to, there is only ever one station on the other end of a link
+        return(self.arq_session.peer or self.host_interface.get_recipients().split(',')[0])
+
+    def group_by_arq_peer(self, data: bytes) -> list:
+        # [(station, data), ...] in the order each station first comes up
+        groups = {} # type: dict[str, list[bytes]]
+        frames, leftover = split_frames(data)
+        for raw in frames:
+            frame = parse_frame(raw)
+            if frame is None or frame.recipients[0] == 'ALL':
+                peer = self.default_arq_peer()
+            else:
+                peer = frame.recipients[0]
+            groups.setdefault(peer, []).append(bytes(raw))
+        if leftover:
+            groups.setdefault(self.default_arq_peer(), []).append(bytes(leftover))
+        return([(peer, b''.join(group)) for peer, group in groups.items()])
+
+    def select_fec_mode(self, data: bytes) -> set:
+        # everyone the frames are addressed to has to be able to decode them, returns who they are
+        recipients = set()
+        frames, leftover = split_frames(data)
+        for raw in frames:
+            frame = parse_frame(raw)
+            if frame is not None:
+                recipients.update(frame.recipients)
+        mode = self.fec_selector.select(recipients, len(data), self.state.get('use600modes'))
+        if mode != self.current_fec_mode():
+            if self.host_interface.debug.get():
+                print(f"ARDOP switching to {mode} for {len(data)} bytes to {', '.join(sorted(recipients))}")
+            self.cmd_response(command=f'FECMODE {mode}')
+        self.selected_fec_mode = mode
+        self.fec_selector.record_sent(recipients, self.estimate_airtime(len(data), mode))
+        return(recipients)
+
+    def current_fec_mode(self) -> str:
+        # what ardopcf is sending FEC in right now
+        return(self.selected_fec_mode or self.state.get('fec_mode'))
 
     def on_clear_buffer(self):
-        self.cmd_response(command='PURGEBUFFER', wait=False)
+        with self.pending_lock:
+            self.pending_buffers = []
+            self.awaiting_drain = False
+        # stop loading whatever is streaming in, then throw away what ardopcf already has
+        self.buffer_loader.cancel()
+        self.cmd_response(command='PURGEBUFFER')
+        self.transmit_done.set()
+
+    def stop_transmitting(self):
+        # the Stop button, nothing that is waiting to be sent should go out either
+        self.host_interface.scheduler.clear()
+        self.on_clear_buffer()
+
+    def wait_until_sent(self, timeout: float) -> bool:
+        return(self.transmit_done.wait(timeout))
+
+    def estimate_airtime(self, datalen: int, mode: str = None) -> float:
+        # seconds the channel is busy sending datalen bytes in one transmission in mode
+        # (the current FEC mode by default), with our leader, trailer, repeats, extra delay and ID settings.
+        # returns None for modes we know nothing about
+        if mode is None:
+            mode = self.current_fec_mode()
+        data_rate = self.rate_table.get(mode)
+        frame_bytes = FRAME_DATA_BYTES.get(mode)
+        if not data_rate or not frame_bytes:
+            return(None)
+        cw_id = 0.0
+        if str(self.state.get('cwid')).upper() != 'FALSE':
+            cw_id = cw_id_seconds(self.state.get('mycall', ''))
+        return(estimate_fec_airtime(datalen, data_rate, frame_bytes,
+                                    leader_ms=int(self.state.get('leader', 0)),
+                                    trailer_ms=int(self.state.get('trailer', 0)),
+                                    repeats=int(self.state.get('fec_repeats', 0)),
+                                    extradelay_ms=int(self.state.get('extradelay', 0)),
+                                    cw_id=cw_id,
+                                    id_frame=bool(self.state.get('fecid'))))
 
     def estimate_time_to_send(self, datalen: int = 0) -> float:
-        # this is a helper function to estimate the time it will take to send a message
-        # this is a rough estimate, and will not be accurate for messages that are not
-        # a multiple of 1000 bytes
+        # this is a helper function to estimate the time it will take to send a message, in minutes
+        # see estimate_airtime for what is counted
         if not datalen:
             datalen = int(self.state.get("buffer"))
         if not self.is_ready():
             return(0.0)
-        current_mode = self.state.get('fec_mode')
-        data_rate = self.rate_table.get(current_mode)
-        if not data_rate:
+        seconds = self.estimate_airtime(datalen)
+        if seconds is None:
             return(0.0)
         # round to one decimal place
-        result = round((datalen / data_rate), 1)
+        result = round((seconds / 60), 1)
         
         return(result)
 
     def on_get_data(self) -> bytes:
-        # This is blocking, and should run in its own thread or migrate everything to asyncio
+        # This blocks for a moment if nothing has been received, it runs on the host's listener thread.
 
-        # This will return ONE set of frames from the TNC, marked by the :END: footer
-        # or until we see another FEC/ARQ/ERR prefix, which means we have another data packet,
+        # This will return ONE set of frames from the TNC, ending with a complete hamChat frame,
+        # marked by the :END: footer, or by the length in a binary hamChat header.
+        # It may hold more than one hamChat frame, the host application splits them.
+        # The io loop does the reading, see read_data_socket.
+        if not self.is_ready():
+            return(None)
+        try:
+            # the timeout is only so the host can notice it is shutting down
+            return(self.received_messages.get(timeout=0.5))
+        except queue.Empty:
+            return(None)
 
+    def read_data_socket(self):
         # the smallest data frame 4FSK.200.50S will encode just 16 data bytes
         # chances are that we will not receive a full frame in one go unless 
         # we are using a high data rate
@@ -760,109 +1021,44 @@ class ARDOPCF(hamChatPlugin):
         # 2 bytes for the length of the frame
         # 3 bytes for the prefix if not the first frame of a series of frames
 
-        # we can detect if the message is over by checking if the end of the message is ':END:'
-        # or if we simply stop getting data from the socket.
+        # we can detect if the message is over by the length in a binary hamChat header, or by
+        # an ':END:' that ends what we have received, or is followed by the next message.
+        # anything that is not a hamChat message is passed on as it is, see FrameReader
 
         # example received data: b'K7OTR-1:chat:0.1:K7OTR:BEGIN:A much longer message, here it i\x00CFECs, here it is here it is, multiple farames fefjensfnrsribghilerb\x00\x0eFECrghbgr:END:'
 
         # possibly an ARDOP bug here that thinks frames are duplicate when they're not: https://vscode.dev/github/Dinsmoor/ardopcf/blob/develop/ARDOPC/FEC.c#L363
-
-        if not self.is_ready():
-            return(None)
-        data = b''
-        while not self.stop_event.is_set():
-            try:
-                # The first two bytes should be the length of the individually decoded frame
-                # this may break if our buffer has an incomplete frame for us, or the
-                # sending station has an incomplete frame in their buffer.
-                length = self.sock_data.recv(2)
-                if not length:
-                    # if we get nothing, we can break
-                    break
-                length = int.from_bytes(length, 'big')
-                # get the rest of this data frame
-                this_frame = self.sock_data.recv(length) # https://github.com/Dinsmoor/ardopcf/blob/eab1f3165a30a0a40221a20b54f5fa1d099c2482/src/common/TCPHostInterface.c#L253-L254
-                if self.host_interface.debug.get():
-                    print(f"ARDOPCF: Incoming Frame: len:{length} data:{this_frame}")
-                # remove the prefix if it exists (we don't need it yet in this application)
-                
-                if this_frame[:3] == b'FEC':
-                    this_frame = this_frame[3:]
-                elif this_frame[:3] == b'ARQ':
-                    this_frame = this_frame[3:]
-                elif this_frame[:3] == b'ERR':
-                    # discard error frames, we don't use them yet
-                    if self.host_interface.debug.get():
-                        print(f"ARDOPCF: Error Frame: {this_frame}")
-                    this_frame = b''
-                    continue
-                
-                if self.host_interface.debug.get():
-                    print(f"ARDOPCF: Frame: {this_frame}")
-                data += this_frame
-                # if we encounter the end of the message, we can break,
-                # and save the rest for another iteration (ardop may group messages into one frame)
-                if b':END:' in data[-5:]:
-                    break
-            except BlockingIOError:
-                # This will happen if we try to read from the socket and there is no data
-                # Completely normal behavior, we just need to wait a moment if there is any additional data
-                time.sleep(0.2)
-                continue
-            except OSError:
-                # we may have a broken pipe, or a timeout
-                # either way, we need to reconnect to the TNC
-                # before trying again.
-                time.sleep(0.1)
-                break
-            except Exception as e:
-                print(f"ARDOPCF: Unexpected Error: {e}")
-                break
-        return(data)
+        # The first two bytes should be the length of the individually decoded frame
+        # https://github.com/Dinsmoor/ardopcf/blob/eab1f3165a30a0a40221a20b54f5fa1d099c2482/src/common/TCPHostInterface.c#L253-L254
+        # FrameReader collects partial reads until it has exact-length frames, strips the FEC/ARQ prefix,
+        # and hands back each hamChat message once it is complete. Anything after it waits for the next read.
+        self.frame_reader.recv_from(self.sock_data)
+        # the other station is sending to us over the link
+        self.arq_session.touch()
+        self.deliver_messages(self.frame_reader.messages(self.host_interface.debug.get()))
+
+    def deliver_messages(self, messages):
+        # complete messages, and anything that is not a message, for on_get_data
+        for message in messages:
+            self.received_messages.put(message)
 
     def abort(self):
         # abort actually sucks and doesn't work immediately
         # it's better to clear the buffer with PURGEBUFFER,
         # this makes the TNC stop transmitting, much better than ABORT
-        self.cmd_response(command="ABORT", wait=False)
+        self.cmd_response(command="ABORT")
 
-    def cmd_response(self, command=None, wait=False) -> str:
-        # this does not play nice with anything.
-        # If I were smarter, I would have done this a different way.
+    def cmd_response(self, command=None):
         # The main limitation is PTT control from ardop being time sensitive. (<50ms)
-        # If it weren't for that, everything would be so much easier.
+        # Only run_io_loop reads the command socket, so nothing here waits on a response.
+        # Responses come back to handle_command_response, which keeps self.state up to date from them.
         if not self.is_ready():
             return(None)
-
         if command:
             #if self.host_interface.debug.get():
             #    print(f"ARDOP CMD: {command}")
             self.__send_cmd(command)
-            
-        if not wait:
-            return(None)
-
-        line = b''
-        while not self.stop_event.is_set():
-            try:
-                part = self.sock_cmd.recv(1)
-                if part != b"\r":
-                    line+=part
-                elif part == b"\r":
-                    break
-            except BlockingIOError as e:
-                # this is normal, since we set the socket to non-blocking
-                # mode to be able to terminate upon stop_event
-                # we wait a short time to not hog the CPU if there's no data to read
-                time.sleep(0.01)
-                continue
-            except OSError as e:
-                # might be a broken pipe, or a timeout
-                # either way, we need to reconnect
-                return(None)
-            # if we get here, we should be reading as fast as possible
-        return line.decode()
-    
+        return(None)
 
     def update_state_from_settings(self):
         self.state['host'] = self.ardop_host_var.get()
@@ -888,9 +1084,13 @@ class ARDOPCF(hamChatPlugin):
         #self.state['version'] = self.version_var.get()
         self.state['fec_mode'] = self.fec_mode_var.get()
         self.state['fec_repeats'] = self.fec_repeats_var.get()
+        self.state['fec_auto'] = self.fec_auto_var.get()
         self.state['arq_dialing_quantity'] = self.arq_dialing_quantity_var.get()
         self.state['arqbw'] = self.arqbw_var.get()
         self.state['arqtimeout'] = self.arqtimeout_var.get()
+        self.state['arq_idle_timeout'] = self.arq_idle_timeout_var.get()
+        if hasattr(self, 'arq_session'):
+            self.arq_session.idle_timeout = self.state['arq_idle_timeout']
         self.state['autobreak'] = self.autobreak_var.get()
         self.state['busyblock'] = self.busyblock_var.get()
         self.state['callbw'] = self.callbw_var.get()
@@ -918,150 +1118,166 @@ class ARDOPCF(hamChatPlugin):
         self.version_var.set(self.state['version'])
         self.fec_mode_var.set(self.state['fec_mode'])
         self.fec_repeats_var.set(self.state['fec_repeats'])
+        self.fec_auto_var.set(self.state['fec_auto'])
         self.arq_dialing_quantity_var.set(self.state['arq_dialing_quantity'])
         self.arqbw_var.set(self.state['arqbw'])
         self.arqtimeout_var.set(self.state['arqtimeout'])
+        self.arq_idle_timeout_var.set(self.state['arq_idle_timeout'])
         self.autobreak_var.set(self.state['autobreak'])
         self.busyblock_var.set(self.state['busyblock'])
         self.callbw_var.set(self.state['callbw'])
 
 
-    def listen_for_command_responses(self):
-        # this is our main event loop for handling command responses from the TNC
-        # wherever we send a command in this code, here is were we will asynchronously
-        # parse and handle the response.
+    def run_io_loop(self):
+        # this is our main event loop. It waits on both ardopcf sockets at once, and wakes up
+        # the moment either has something for us, or when wake_io_loop is called.
+        # This is the only place the sockets are read. Command lines go to handle_notification
+        # and handle_command_response, complete messages are queued for on_get_data.
+        selector = selectors.DefaultSelector()
+        selector.register(self.wake_receiver, selectors.EVENT_READ, 'wake')
+        registered = False
+        reconnect_delay = RECONNECT_DELAY_MIN
         while not self.stop_event.is_set():
-            debug = self.host_interface.debug.get()
             if not self.is_ready():
-                if debug:
+                if registered:
+                    self.unregister_ardop_sockets(selector)
+                    registered = False
+                if self.host_interface.debug.get():
                     print("ARDOP Not ready, reconnecting.")
                 # try to reconnect to the TNC
+                self.reset_ardop_sockets()
                 self.connect_to_ardopcf()
-                continue
-            response = self.cmd_response(wait=True)
-            self.command_response_history.append(response)
-
-            try:
-                for entry in self.command_response_history:
-                    if ('PTT TRUE' in entry):
-                        self.state['ptt'] = True
-                        self.host_interface.plugMgr.on_key_transmitter()
-                    elif ('PTT FALSE' in entry):
-                        self.state['ptt'] = False
-                        self.host_interface.plugMgr.on_unkey_transmitter()
-                    elif entry.startswith('MYCALL'):
-                        self.state['mycall'] = entry.split()[-1]
-                    elif entry.startswith('MYAUX'):
-                        if len(entry.split()) > 1:
-                            self.state['myaux'] = entry.split()[-1]
-                    elif entry.startswith('PURGEBUFFER'):
-                        pass
-                    elif entry.startswith('GRIDSQUARE'):
-                        self.state['gridsquare'] = entry.split()[-1]
-                    elif entry.startswith('BUFFER'):
-                        self.state['buffer'] = int(entry.split()[-1])
-                    elif entry.startswith('STATE'):
-                        self.state['state'] = entry.split()[-1]
-                    elif entry.startswith('FECSEND'):
-                        pass
-                    elif entry.startswith('PROTOCOLMODE'):
-                        self.state['protocol_mode'] = entry.split()[-1]
-                    elif entry.startswith('PING'):
-                        self.host_interface.print_to_chatwindow(entry)
-                    elif entry.startswith('PINGACK'):
-                        self.host_interface.print_to_chatwindow(entry)
-                    elif entry.startswith('FECMODE'):
-                        self.state['fec_mode'] = entry.split()[-1]
-                    elif entry.startswith('FECREPEATS'):
-                        self.state['fec_repeats'] = int(entry.split()[-1])
-                    elif entry.startswith('LISTEN'):
-                        self.state['listen'] = entry.split()[-1]
-                    elif entry.startswith('ENABLEPINGACK'):
-                        self.state['enablepingack'] = entry.split()[-1]
-                    elif entry.startswith('USE600MODES'):
-                        #FIXME this does not properly set the use600modes variable
-                        if entry.split()[-1] == 'FALSE':
-                            self.state['use600modes'] = False
-                        else:
-                            self.state['use600modes'] = True
-                    elif entry.startswith('VERSION'):
-                        self.state['version'] = entry.split()[-1]
-                    elif entry.startswith('LOGLEVEL'):
-                        self.state['loglevel'] = int(entry.split()[-1])
-                    elif entry.startswith('MONITOR'):
-                        self.state['monitor'] = entry.split()[-1]
-                    elif entry.startswith('CAPTURE'):
-                        self.state['capture'] = entry.split()[-1]
-                    elif entry.startswith('PLAYBACK'):
-                        self.state['playback'] = entry.split()[-1]
-                    elif entry.startswith('SQUELCH'):
-                        self.state['squelch'] = int(entry.split()[-1])
-                    elif entry.startswith('TRAILER'):
-                        self.state['trailer'] = int(entry.split()[-1])
-                    elif entry.startswith('TUNINGRANGE'):
-                        self.state['tuningrange'] = int(entry.split()[-1])
-                    elif entry.startswith('EXTRADELAY'):
-                        self.state['extradelay'] = int(entry.split()[-1])
-                    elif entry.startswith('LEADER'):
-                        self.state['leader'] = int(entry.split()[-1])
-                    elif entry.startswith('BUSYDET'):
-                        self.state['busydet'] = entry.split()[-1]
-                    elif entry.startswith('DRIVELEVEL'):
-                        self.state['drivelevel'] = entry.split()[-1]
-                    elif entry.startswith('CWID'):
-                        self.state['cwid'] = entry.split()[-1]
-                    elif entry.startswith('ARQBW'):
-                        self.state['arqbw'] = entry.split()[-1]
-                    elif entry.startswith('ARQTIMEOUT'):
-                        self.state['arqtimeout'] = int(entry.split()[-1])
-                    elif entry.startswith('AUTOBREAK'):
-                        self.state['autobreak'] = entry.split()[-1]
-                    elif entry.startswith('BUSYBLOCK'):
-                        self.state['busyblock'] = entry.split()[-1]
-                    elif entry.startswith('CALLBW'):
-                        self.state['callbw'] = entry.split()[-1]
-                    elif entry.startswith('INITIALIZE'):
-                        pass
+                if not self.is_ready():
+                    # wait a little longer each time, stop_event still wakes us right away
+                    self.stop_event.wait(reconnect_delay)
+                    reconnect_delay = min(reconnect_delay * 2, RECONNECT_DELAY_MAX)
+                    continue
+                reconnect_delay = RECONNECT_DELAY_MIN
+            if not registered:
+                selector.register(self.sock_cmd, selectors.EVENT_READ, 'command')
+                selector.register(self.sock_data, selectors.EVENT_READ, 'data')
+                registered = True
+            # wake up in time to hand on a message the frame reader was holding, see FrameReader.expire
+            deadline = self.frame_reader.next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            events = selector.select(timeout)
+            self.deliver_messages(self.frame_reader.expire())
+            # the command socket first, PTT should not wait behind a data frame
+            for key, _ in sorted(events, key=lambda event: event[0].data != 'command'):
+                try:
+                    if key.data == 'command':
+                        for entry in self.command_reader.read_available():
+                            self.command_reader.publish(entry)
+                    elif key.data == 'data':
+                        self.read_data_socket()
                     else:
-                        pass
-                        #self.host_interface.print_to_chatwindow(entry)
-                    if debug:
-                        if not entry.startswith('BUFFER'):
-                            if not entry.startswith('STATE'):
-                                print(f"ARDOPCF: {entry}")
-                    try:
-                        if hasattr(self, 'command_history_text') and self.command_history_text.winfo_exists():
-                            if self.record_command_response:
-                                self.command_history_text.insert(tk.END, f"{entry}\n")
-                                self.record_command_response = False
-                    except RuntimeError:
-                        # this is a catch for the case where the command_history_text is None
-                        # usually at program termination
-                        pass
-                    self.command_response_history.remove(entry)
-                    # plugins might really interfere with this thread, it may be better
-                    # to spawn a thread when this is called. Will test and change as needed.
-                    #self.host_interface.plugMgr.on_command_received(entry)
-            except TypeError:
-                # this is a catch for the case where the command_response_history is None
-                # usually at program termination or on timeout
-                pass
-        print('ARDOPCF Command Response Thread Exiting')
+                        self.wake_receiver.recv(64)
+                except BlockingIOError:
+                    continue
+                except (OSError, ValueError) as e:
+                    # ardopcf went away, or the socket was closed under us
+                    self.connected.clear()
+                    self.transmit_done.set()
+                    self.buffer_loader.cancel()
+                    break
+        selector.close()
+        print('ARDOPCF IO Thread Exiting')
+
+    def unregister_ardop_sockets(self, selector: selectors.BaseSelector):
+        # the sockets may be closed already, so go by file descriptor
+        for key in list(selector.get_map().values()):
+            if key.data != 'wake':
+                selector.unregister(key.fd)
+
+    def handle_notification(self, entry: str):
+        # things ardopcf tells us without being asked, see _ardop_host.NOTIFICATIONS
+        # PTT is not handled here, see handle_ptt
+        if response_verb(entry) not in NOTIFICATIONS:
+            return
+        if entry.startswith('NEWSTATE'):
+            self.state['state'] = entry.split()[-1]
+        if (entry in ('BUSY FALSE', 'NEWSTATE DISC') and self.arq_session.peer is None) or entry.startswith('DISCONNECTED'):
+            # nothing more of what we were hearing is coming, a message still missing its end never will have it.
+            # complete messages are handed on as they arrive, they never wait for this
+            self.frame_reader.transmission_ended()
+        if entry.startswith(('CONNECTED', 'DISCONNECTED', 'REJECTED', 'NEWSTATE')):
+            self.arq_session.on_notification(entry)
+        elif entry.startswith('PING'):
+            # PING, PINGACK and PINGREPLY
+            self.host_interface.print_to_chatwindow(entry)
+            self.record_link_quality(entry)
+
+    def record_link_quality(self, entry: str):
+        # PINGACK SNdB Quality, the answer to our ping
+        # PING CALLER>TARGET SNdB Quality, someone pinging, we take their signal as a guide to the link back
+        words = entry.split()
+        try:
+            if words[0] == 'PINGACK' and self.pinged_station:
+                self.fec_selector.record_link_quality(self.pinged_station, float(words[1]), int(words[2]))
+            elif words[0] == 'PING' and '>' in words[1]:
+                self.fec_selector.record_link_quality(words[1].split('>')[0], float(words[2]), int(words[3]))
+        except (IndexError, ValueError):
+            pass
+
+    def handle_ptt(self, keyed: bool, requested_at: float):
+        # called straight from the command reader, the rig control plugin keys the radio
+        # before this returns, see PluginManager.on_key_transmitter
+        self.state['ptt'] = keyed
+        if keyed:
+            self.host_interface.plugMgr.on_key_transmitter(requested_at)
+        else:
+            self.host_interface.plugMgr.on_unkey_transmitter(requested_at)
+            self.check_sent()
+
+    def handle_command_response(self, entry: str):
+        # every line goes through here to keep self.state in step with the TNC
+        # see _ardop_host.RESPONSE_FIELDS for which response fills in which setting
+        verb = apply_response(self.state, entry)
+        if verb == 'BUFFER' and isinstance(self.state.get('buffer'), int):
+            # what paces _load_buffer
+            self.buffer_loader.on_buffer_report(self.state['buffer'])
+            self.arq_session.on_buffer_report(self.state['buffer'])
+            self.check_sent()
+        self.state_watcher.heard(self.state)
+        if self.host_interface.debug.get():
+            # these come all the time while sending, they would drown out everything else
+            if verb not in ('BUFFER', 'STATE'):
+                print(f"ARDOPCF: {entry}")
+        try:
+            if hasattr(self, 'command_history_text') and self.command_history_text.winfo_exists():
+                if self.record_command_response:
+                    self.command_history_text.insert(tk.END, f"{entry}\n")
+                    self.record_command_response = False
+        except RuntimeError:
+            # this is a catch for the case where the command_history_text is None
+            # usually at program termination
+            pass
+        # plugins might really interfere with this thread, it may be better
+        # to spawn a thread when this is called. Will test and change as needed.
+        #self.host_interface.plugMgr.on_command_received(entry)
 
     def IPC(self, target_plugin: str, from_plugin: str, command: str, data: bytes = None) -> dict:
         if target_plugin != self.definition['name']:
             return({})
         if command == 'send':
-            self.append_bytes_to_buffer(data)
-            self.on_transmit_buffer()
+            # loading waits on ardopcf, so it goes through the scheduler's thread, not the caller's
+            self.host_interface.transmit(data, 'chat')
+        elif command == 'estimate_airtime':
+            # data is b'<bytes>' or b'<bytes> <mode>', like b'1200 8PSK.500.100'
+            words = data.decode().split()
+            mode = words[1] if len(words) > 1 else None
+            return({'airtime': self.estimate_airtime(int(words[0]), mode)})
+        elif command == 'acknowledged':
+            # data is the callsign of a station that autoACKed what we sent, sent by the host application
+            self.fec_selector.record_acknowledged(data.decode())
 
 
     def on_shutdown(self):
         self.stop_event.set()
-        # this is a hack to get the command_response thread to exit
-        # (it's blocking on a recv call until it gets a response from the TNC)
+        self.buffer_loader.cancel()
+        self.wake_io_loop()
         if self.is_ready():
-            self.cmd_response(command='ABORT', wait=False)
-            self.cmd_response(command='STATE', wait=False)
+            self.cmd_response(command='ABORT')
+            self.cmd_response(command='STATE')
             self.sock_cmd.close()
             self.sock_data.close()
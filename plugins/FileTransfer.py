@@ -1,5 +1,6 @@
 # inherits from hamChatPlugin
 from hamChatPlugin import hamChatPlugin
+import os
 import tkinter as tk
 from tkinter import filedialog
 
@@ -9,6 +10,12 @@ Standard hamChat header format:
 N0CALL:chat:0.1:RECIPIENTS:BEGIN:Hello, YOURCALL!:END:
 """
 
+# files up to this size are read whole when they are sent, so they can be compressed.
+# Bigger ones are read from disk a piece at a time as they go out, uncompressed, see transmit_stream
+IN_MEMORY_MAX_SIZE = 64 * 1024
+# bytes read from a streamed file at a time
+READ_SIZE = 16 * 1024
+
 class SimpleFileTransfer(hamChatPlugin):
     def __init__(self, host_interface: object):
         super().__init__(host_interface)
@@ -25,18 +32,26 @@ class SimpleFileTransfer(hamChatPlugin):
             'description': self.info,
             'transport': '',
             'handlers': [self.header_id],
+            # files are often text, and compress well
+            'compress': True,
+            # losing a chunk means losing the file, so hold up the receiver rather than dropping anything
+            'queue_policy': 'block',
             'depends_on': [{'plugin': 'Core', 'version': '0.1'}],
         }
+        # files added with Add File, sent together with Send File, as (path, size)
+        self.pending_files = [] # type: list[tuple[str, int]]
     
     def on_payload_recieved(self, data : dict) -> bytes:
         '''data should be a dictionary with a header and a payload both of type bytes'''
-        # example data: {'header': b'SENDER:FileXfr:0.1:RECIPIENTS:FILENAME:FILESIZE:BEGIN:', 'payload': b'<DATA>'}
+        # example data: {'header': b'SENDER:FileXfr:0.1:RECIPIENTS:FILENAME:FILESIZE', 'payload': b'<DATA>', 'frame': Frame}
 
         #                                 0       1     2     3        4        5        6
         # expected header for FileXfr: SENDER:FileXfr:0.1:RECIPIENTS:FILENAME:FILESIZE:BEGIN:
-        suggested_filename = data['header'].split(b':')[4]
+        # the parsed frame keeps the fields after the recipients, so FILENAME is fields[0]
+        frame = data['frame']
+        suggested_filename = frame.fields[0]
 
-        if len(data['payload']) != data['header'].split(b':')[5]:
+        if len(frame.payload) != int(frame.fields[1]):
             self.host_interface.print_to_chatwindow(f"File transfer error: file size mismatch. Saving anyway." )
         self._save_file_to_disk(data['payload'], suggested_filename)
     
@@ -46,7 +61,7 @@ class SimpleFileTransfer(hamChatPlugin):
         self.plugin_label.pack(side=tk.TOP)
         self.add_file_button = tk.Button(button_frame, text="Add File", command=self._select_file)
         self.add_file_button.pack(side=tk.LEFT)
-        self.send_file_button = tk.Button(button_frame, text="Send File", command=self.host_interface.plugMgr.on_transmit_buffer)
+        self.send_file_button = tk.Button(button_frame, text="Send File", command=self._send_files)
         self.send_file_button.pack(side=tk.LEFT)
         button_frame.pack()
         
@@ -55,12 +70,7 @@ class SimpleFileTransfer(hamChatPlugin):
         # handle if user presses cancel
         if not filename:
             return
-        # filename only, not the full path
-        filename_nopath = filename.split('/')[-1]
         self._load_file_to_buffer(filename)
-        file_length = len(open(filename, 'rb').read())
-        
-        self.host_interface.print_to_chatwindow(f"{filename_nopath} added to buffer, {file_length} bytes" )
     
     def _save_file_to_disk(self, data: bytes, suggested_filename: str = None):
         filename = filedialog.asksaveasfilename(initialfile=suggested_filename,)
@@ -72,18 +82,45 @@ class SimpleFileTransfer(hamChatPlugin):
         self.host_interface.print_to_chatwindow(f"File saved to {filename}" )
     
     def _load_file_to_buffer(self, filename):
+        # the file is not read until it is sent, so it is never held in memory while it waits
+        try:
+            filesize = os.path.getsize(filename)
+        except OSError as e:
+            self.host_interface.print_to_chatwindow(f"Could not add {filename}: {e}")
+            return
+        self.pending_files.append((filename, filesize))
+        self.host_interface.print_to_chatwindow(f"{filename} added to buffer, {filesize} bytes" )
+
+    def _send_files(self):
         # Don't forget that we need to comply with the expected header format
-        # first four fields, and BEGIN/END are required by hamchat to get you your data, the rest are up to you
-        # SENDER:FileXfr:0.1:RECIPIENTS:{your fields here}BEGIN:
-        callsign = self.host_interface.settings['callsign']
-        recipients = self.host_interface.get_recipients()
+        # first four fields are required by hamchat to get you your data, the rest are up to you
+        # SENDER:FileXfr:0.1:RECIPIENTS:{your fields here}
+        # build_frame and transmit_stream take care of the rest, and pick the header format the recipients can read
         version = self.definition['version']
-        with open(filename, 'rb') as f:
-            file = f.read()
-            filesize = len(file)
+        # files go out a piece at a time, so chat and ACKs can still get through while they are sent
+        for filename, filesize in self.pending_files:
             filename_nopath = filename.split('/')[-1]
-            header = f"{callsign}:{self.header_id}:{version}:{recipients}:{filename_nopath}:{filesize}:BEGIN:".encode()
-            footer = b":END:"
-            data = header + file + footer
-            self.host_interface.transport.append_bytes_to_buffer(data)
-        self.host_interface.print_to_chatwindow(f"{filename} added to buffer, {filesize} bytes" )
\ No newline at end of file
+            fields = (filename_nopath, filesize)
+            if filesize > IN_MEMORY_MAX_SIZE:
+                self.host_interface.transmit_stream(self.header_id, version, self._read_file(filename, filesize), filesize, fields=fields)
+                continue
+            try:
+                with open(filename, 'rb') as f:
+                    file = f.read(filesize)
+            except OSError as e:
+                self.host_interface.print_to_chatwindow(f"Could not send {filename}: {e}")
+                continue
+            data = self.host_interface.build_frame(self.header_id, version, file, fields=fields)
+            self.host_interface.transmit(data, 'bulk')
+        self.pending_files = []
+
+    def _read_file(self, filename: str, filesize: int):
+        # runs on the transmit scheduler's thread, as the file goes out.
+        # No more than filesize is sent, that is what the header says, a file that shrank since is cut short
+        with open(filename, 'rb') as f:
+            while filesize > 0:
+                chunk = f.read(min(READ_SIZE, filesize))
+                if not chunk:
+                    return
+                filesize -= len(chunk)
+                yield chunk
\ No newline at end of file
@@ -0,0 +1,948 @@
+import socket
+import threading
+import time
+from collections import deque
+from hamChatFrame import BINARY_MAGIC, BEGIN_MARKER, END_MARKER, MAX_HEADER_LENGTH, frame_length, frame_start, next_frame_start
+
+"""
+Helpers for talking to the ardopcf host interface, shared by the ARDOPCF plugin.
+Files starting with _ in the plugins folder are not loaded as plugins.
+
+ardopcf sends command responses and notifications (like PTT TRUE) on the command socket
+as text lines ending in a carriage return. CommandLineReader turns the socket into lines,
+and NOTIFICATIONS tells the ones ardopcf sends on its own apart from responses to our commands.
+FrameReader does the same for the data socket, turning its frames into hamChat messages.
+BufferLoader goes the other way, streaming outgoing data into the TNC as its buffer empties,
+and ARQSession keeps an ARQ link up between messages to the same station.
+StateWatcher follows the TNC state from ardopcf's own notifications, and says when polling is still worth it.
+apply_response keeps our copy of the TNC's settings up to date from its responses.
+FECModeSelector picks the FEC mode for each transmission from what we know about the link,
+and estimate_fec_airtime works out how long a transmission keeps the channel busy.
+"""
+
+# how much we ask the socket for at once, command responses are short, so this is usually everything waiting
+READ_CHUNK_SIZE = 4096
+# a line longer than this is not something ardopcf would send, drop it rather than grow forever
+MAX_LINE_LENGTH = 65536
+
+
+class CommandLineReader:
+    def __init__(self, sock: socket.socket = None):
+        '''Reads whole lines from the ardopcf command socket, and hands each one to every subscriber.
+        Only one thread should call read_available, everyone else subscribes.'''
+        self.sock = sock
+        self.buffer = bytearray()
+        self.subscribers = [] # type: list[callable]
+        self.lock = threading.Lock()
+        self.ptt_handler = None
+
+    def set_ptt_handler(self, callback):
+        '''callback(keyed: bool, requested_at: float) is called for PTT TRUE and PTT FALSE as soon as
+        the line is read, before any line is published, even the ones that came before it.
+        requested_at is the time.perf_counter() when the line arrived.'''
+        self.ptt_handler = callback
+
+    def reset(self, sock: socket.socket):
+        '''Start reading from a new socket, after reconnecting. A partial line from the old one is dropped.'''
+        self.sock = sock
+        self.buffer.clear()
+
+    def subscribe(self, callback):
+        '''callback(line: str) is called on the reader's thread for every line, so it should be quick.'''
+        with self.lock:
+            self.subscribers = self.subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if subscriber is not callback]
+
+    def read_available(self) -> list:
+        '''Return every complete line received, without the \\r, once a selector says the socket is readable.
+        Raises ConnectionError if ardopcf closed the connection, or OSError if the socket broke.'''
+        try:
+            chunk = self.sock.recv(READ_CHUNK_SIZE)
+        except BlockingIOError:
+            # select can wake us up without anything to read
+            return []
+        received_at = time.perf_counter()
+        if not chunk:
+            raise ConnectionResetError("ardopcf closed the command connection")
+        self.buffer += chunk
+        if b'\r' not in chunk:
+            if len(self.buffer) > MAX_LINE_LENGTH:
+                self.buffer.clear()
+            return []
+        *lines, rest = self.buffer.split(b'\r')
+        self.buffer = bytearray(rest)
+        if self.ptt_handler is not None:
+            for line in lines:
+                if line.startswith(b'PTT '):
+                    try:
+                        self.ptt_handler(line == b'PTT TRUE', received_at)
+                    except Exception as e:
+                        print(f"ARDOPCF: error handling '{line.decode(errors='replace')}': {e}")
+        return [line.decode(errors='replace') for line in lines if line]
+
+    def publish(self, line: str):
+        # a subscriber that breaks must not stop the others from hearing about PTT
+        for subscriber in self.subscribers:
+            try:
+                subscriber(line)
+            except Exception as e:
+                print(f"ARDOPCF: error handling '{line}': {e}")
+
+
+# lines ardopcf sends on its own, not in reply to a command, see ARDOPCF.handle_notification.
+# Some share a name with a command, like PING, and are handled the same whether we asked or not.
+NOTIFICATIONS = {
+    'PTT',
+    'PING',
+    'PINGACK',
+    'PINGREPLY',
+    'NEWSTATE',
+    'BUSY',
+    'CONNECTED',
+    'DISCONNECTED',
+    'TARGET',
+    'PENDING',
+    'CANCELPENDING',
+    'REJECTEDBW',
+    'REJECTEDBUSY',
+    'STATUS',
+}
+
+
+def response_verb(line: str) -> str:
+    '''The first word of a command or response, BUFFER for "BUFFER 1234"'''
+    return line.split(' ', 1)[0].upper()
+
+
+# ardopcf puts one of these in front of every decoded frame on the data socket
+DATA_PREFIXES = (b'FEC', b'ARQ', b'ERR')
+# size of the data socket receive buffer to start with, it grows if a frame ever needs more
+DATA_BUFFER_SIZE = 65536
+# seconds without a frame before an unfinished message is given up on, and handed on as it is
+PARTIAL_MESSAGE_TIMEOUT = 60.0
+# seconds after ardopcf says a transmission ended before we act on it, its last frame may still be on the way
+END_OF_TRANSMISSION_GRACE = 0.5
+
+
+class FrameReader:
+    def __init__(self, capacity: int = DATA_BUFFER_SIZE):
+        '''Turns what ardopcf sends on the data socket into complete hamChat messages.
+
+        The data socket carries frames of <2 byte length><3 byte prefix><data>, and a message
+        usually spans several frames, while a frame may end one message and start the next.
+        Reads go straight into one reused buffer with recv_into. Whatever is left unread is moved
+        back to the front when the end is reached, so nothing is copied per read, and exact-length
+        frames are sliced out of it in place. Frame data is gathered into a bytearray,
+        and each hamChat message is cut off the front of it as soon as it is complete.
+
+        A text message is complete at an :END: that ends everything received so far, or that is
+        followed by the start of another message. An :END: in the payload followed by more of it
+        in the same read is skipped. Bytes that cannot be the start of a message are handed on as they are,
+        up to where the next message starts, so one bad header never holds up the messages after it.
+        An ERR frame means part of a message was lost, so the message it was in is dropped.
+        A message still short of its end when the transmission is over (see transmission_ended),
+        or after PARTIAL_MESSAGE_TIMEOUT without a frame, lost a frame on the way, and is given up on.
+        Call expire when next_deadline comes.'''
+        self.buffer = bytearray(capacity)
+        self.head = 0 # first byte not yet made into a frame
+        self.tail = 0 # end of what has been received
+        self.message = bytearray()
+        # where to continue looking for a text frame's :END:, so a long message is not searched again from the start
+        self.scanned = 0
+        self.last_frame_at = 0.0
+        # when ardopcf told us the transmission ended
+        self.ended_at = None # type: float
+
+    def reset(self):
+        '''Forget anything partly received, like after reconnecting'''
+        self.head = 0
+        self.tail = 0
+        self.message.clear()
+        self.scanned = 0
+        self.ended_at = None
+
+    def recv_from(self, sock: socket.socket):
+        '''Read whatever the socket has for us. Raises ConnectionError if ardopcf closed it.'''
+        if self.tail == len(self.buffer):
+            self.__make_room()
+        received = sock.recv_into(memoryview(self.buffer)[self.tail:])
+        if not received:
+            raise ConnectionResetError("ardopcf closed the data connection")
+        self.tail += received
+
+    def __make_room(self):
+        unread = self.tail - self.head
+        if self.head:
+            # move the unread bytes back to the front
+            self.buffer[:unread] = self.buffer[self.head:self.tail]
+            self.head, self.tail = 0, unread
+        else:
+            # a single frame bigger than the buffer, ardopcf frames are far smaller, but just in case
+            self.buffer.extend(bytes(len(self.buffer)))
+
+    def frames(self):
+        '''Yield (prefix, data) for every complete frame received so far. data is a memoryview
+        into the receive buffer, only good until the next recv_from.'''
+        view = memoryview(self.buffer)
+        while self.tail - self.head >= 2:
+            length = int.from_bytes(view[self.head:self.head + 2], 'big')
+            if self.tail - self.head < 2 + length:
+                # the rest of this frame has not arrived yet
+                break
+            start = self.head + 2
+            self.head = start + length
+            frame = view[start:self.head]
+            prefix = bytes(frame[:3])
+            if prefix in DATA_PREFIXES:
+                yield prefix, frame[3:]
+            else:
+                yield b'', frame
+        if self.head == self.tail:
+            # everything is used up, start at the front again without copying anything
+            self.head = self.tail = 0
+
+    def messages(self, debug: bool = False):
+        '''Yield every hamChat message completed by the frames received so far, as bytes.
+        Anything after the last complete message is kept for the next one.
+        Bytes that are not a hamChat message are yielded too, for the host to treat as nonstandard data.'''
+        for prefix, data in self.frames():
+            if debug:
+                print(f"ARDOPCF: Incoming Frame: {prefix.decode()} len:{len(data)} data:{bytes(data)}")
+            if prefix == b'ERR':
+                # part of whatever was arriving is lost, it cannot be put back together now
+                self.__drop_partial(debug)
+                continue
+            self.last_frame_at = time.monotonic()
+            # still going after all
+            self.ended_at = None
+            self.message += data
+            yield from self.__complete_messages()
+
+    def transmission_ended(self):
+        '''ardopcf says the sending station stopped, like BUSY FALSE after an FEC transmission.
+        Unless another frame arrives within END_OF_TRANSMISSION_GRACE, a message still short of its end
+        lost a frame on the way, and is given up on. Complete messages never wait for this.'''
+        if self.message:
+            self.ended_at = time.monotonic()
+
+    def expire(self, now: float = None):
+        '''Yield what has waited long enough, see transmission_ended and PARTIAL_MESSAGE_TIMEOUT'''
+        now = now or time.monotonic()
+        if self.ended_at is not None and now >= self.ended_at + END_OF_TRANSMISSION_GRACE:
+            self.ended_at = None
+            yield from self.__give_up()
+        if self.message and now - self.last_frame_at >= PARTIAL_MESSAGE_TIMEOUT:
+            yield from self.__give_up()
+
+    def next_deadline(self):
+        '''When expire next has something to do, in time.monotonic() seconds, or None'''
+        if not self.message:
+            return None
+        if self.ended_at is not None:
+            return self.ended_at + END_OF_TRANSMISSION_GRACE
+        return self.last_frame_at + PARTIAL_MESSAGE_TIMEOUT
+
+    def __drop_partial(self, debug: bool):
+        if self.message:
+            if debug:
+                print(f"ARDOPCF: dropping {len(self.message)} bytes of a message with a frame missing")
+            self.message.clear()
+            self.scanned = 0
+
+    def __give_up(self):
+        # the message at the front is not going to be finished. It may have swallowed the ones after it,
+        # so only what comes before the next whole header is handed on as it is, and the rest is read again.
+        while self.message:
+            end = next_frame_start(self.message, 1, whole_header=True)
+            yield from self.__cut(len(self.message) if end is None else end)
+            yield from self.__complete_messages()
+
+    def __cut(self, end: int):
+        message = bytes(self.message[:end])
+        del self.message[:end]
+        self.scanned = 0
+        yield message
+
+    def __complete_messages(self):
+        while self.message:
+            start = frame_start(self.message)
+            if start is None:
+                # the start of a header, the rest of it is still on its way
+                return
+            if start is False:
+                # not a message we can read, pass it on up to where the next one might start
+                end = next_frame_start(self.message, 1)
+                yield from self.__cut(len(self.message) if end is None else end)
+                continue
+            if self.message[0] == BINARY_MAGIC:
+                # binary frames tell us how long they are
+                end = frame_length(bytes(self.message[:MAX_HEADER_LENGTH]))
+                if end > len(self.message):
+                    return
+            else:
+                end = self.__text_message_end()
+                if end is None:
+                    return
+            yield from self.__cut(end)
+
+    def __text_message_end(self):
+        # text frames end with an :END: that ends what we have so far, or is followed by the start of another frame.
+        # One followed by what might be the start of a frame is looked at again when the rest of it arrives.
+        begin = self.message.find(BEGIN_MARKER)
+        pos = max(self.scanned, begin + len(BEGIN_MARKER))
+        end = self.message.find(END_MARKER, pos)
+        while end >= 0:
+            after = end + len(END_MARKER)
+            if after == len(self.message):
+                # nothing follows, delivered now rather than held for a frame that may never come
+                return after
+            following = frame_start(self.message, after)
+            if following:
+                return after
+            if following is None:
+                # look at this :END: again when more arrives
+                self.scanned = end
+                return None
+            end = self.message.find(END_MARKER, end + 1)
+        # next time, only look at what is new, and the few bytes that might be the start of an :END:
+        self.scanned = max(pos, len(self.message) - len(END_MARKER) + 1)
+        return None
+
+
+# the TNC's outgoing buffer is kept between these while streaming, in bytes, see BufferLoader.
+# Below the low mark ardopcf still has several seconds of data to send even in the fastest modes,
+# so it never runs dry while we refill it, and above the high mark we would only be holding memory in the TNC.
+BUFFER_LOW_WATERMARK = 2000
+BUFFER_HIGH_WATERMARK = 8000
+# bytes in each data socket write, ardopcf takes in about 1000 bytes every 200ms
+LOAD_CHUNK_SIZE = 1000
+# seconds without a BUFFER report before we ask for one, ardopcf does not always tell us as it sends
+BUFFER_QUERY_INTERVAL = 1.0
+
+
+def iter_chunks(source, chunk_size: int = LOAD_CHUNK_SIZE):
+    '''Yield source in pieces of at most chunk_size bytes, only ever holding one piece.
+    source can be bytes, a file opened in binary mode (anything with read), or an iterable of bytes.'''
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source)
+        for pos in range(0, len(view), chunk_size):
+            yield bytes(view[pos:pos + chunk_size])
+        return
+    if hasattr(source, 'read'):
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    pending = bytearray()
+    for piece in source:
+        pending += piece
+        while len(pending) >= chunk_size:
+            yield bytes(pending[:chunk_size])
+            del pending[:chunk_size]
+    if pending:
+        yield bytes(pending)
+
+
+class BufferLoader:
+    def __init__(self, write, query_buffer, low_watermark: int = BUFFER_LOW_WATERMARK,
+                 high_watermark: int = BUFFER_HIGH_WATERMARK, chunk_size: int = LOAD_CHUNK_SIZE):
+        '''Streams data into ardopcf's outgoing buffer, keeping it between the low and high watermark.
+
+        write(chunk) sends one chunk on the data socket, and query_buffer() asks ardopcf for BUFFER.
+        Every BUFFER line should be passed to on_buffer_report, those are what pace the loading:
+        the buffer is filled to the high watermark, then nothing more is written until ardopcf
+        reports it has sent enough to be down to the low watermark. Only one chunk of the source
+        is in memory at a time, however big it is.
+
+        ardopcf answers each chunk it takes in with a BUFFER report, in order, so each report
+        accounts for the oldest chunk it has not answered yet. A report after a quiet spell,
+        when ardopcf has had time to take in everything, accounts for all of them.'''
+        self.write = write
+        self.query_buffer = query_buffer
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.chunk_size = chunk_size
+        self.condition = threading.Condition()
+        self.reported = 0 # the last BUFFER ardopcf reported
+        self.reports = 0 # how many reports we have had, to notice a new one
+        self.in_flight = deque() # sizes of the chunks ardopcf has not reported on yet
+        self.unreported = 0 # their total
+        self.settled = False # the next report covers everything written, see __wait_for
+        self.settled_reports = 0
+        self.ran_dry = False # ardopcf reported an empty buffer since we last started it sending
+        self.cancelled = False
+        # one stream at a time, a second one waits for the first to be loaded
+        self.stream_lock = threading.Lock()
+
+    def on_buffer_report(self, size: int):
+        with self.condition:
+            self.reported = size
+            if self.settled:
+                self.in_flight.clear()
+                self.unreported = 0
+                self.settled = False
+                self.settled_reports += 1
+            elif self.in_flight:
+                self.unreported -= self.in_flight.popleft()
+            self.reports += 1
+            if size == 0:
+                # whatever it was sending is finished, more data needs another start
+                self.ran_dry = True
+            self.condition.notify_all()
+
+    def level(self) -> int:
+        '''How many bytes we think are waiting in ardopcf, counting what it has not reported on yet'''
+        return self.reported + self.unreported
+
+    def cancel(self):
+        '''Stop the stream being loaded now, like when the buffer is purged or ardopcf goes away'''
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def wait_until_empty(self) -> bool:
+        '''Block until ardopcf reports it has sent everything in its buffer. Returns False if cancelled.'''
+        with self.stream_lock:
+            with self.condition:
+                self.cancelled = False
+            return self.__wait_for(lambda: self.level() == 0)
+
+    def stream(self, source, start=None) -> int:
+        '''Load all of source (see iter_chunks) into ardopcf, returning how many bytes were written.
+        This returns once the last of it is in ardopcf's buffer, not once it has been sent.
+        start() is called when the first fill is in the buffer, so ardopcf can be told to send it,
+        and again if ardopcf sent everything while the source was slow to give us more.
+        Returns early, with what was written so far, if cancel is called.'''
+        with self.stream_lock:
+            with self.condition:
+                self.cancelled = False
+            written = 0
+            sending = False
+            chunks = iter_chunks(source, self.chunk_size)
+            chunk = next(chunks, None)
+            while chunk is not None:
+                while chunk is not None and self.level() < self.high_watermark:
+                    self.write(chunk)
+                    with self.condition:
+                        self.in_flight.append(len(chunk))
+                        self.unreported += len(chunk)
+                        self.settled = False
+                    written += len(chunk)
+                    chunk = next(chunks, None)
+                if not sending or self.ran_dry:
+                    # ardopcf has to have the data before it is told to send it, or it sends nothing,
+                    # so wait until it has reported on everything we wrote. If it ran dry while we were
+                    # writing, what we wrote may have gone out anyway, then only a settled report shows it is empty.
+                    settled = self.settled_reports
+                    if not self.__wait_for(lambda: self.unreported == 0 and
+                                           (self.reported > 0 or self.settled_reports != settled)):
+                        return written
+                    with self.condition:
+                        self.ran_dry = False
+                        sending = self.reported > 0
+                    if sending and start:
+                        start()
+                if chunk is None:
+                    break
+                if not self.__wait_for(lambda: self.level() <= self.low_watermark):
+                    return written
+            return written
+
+    def __wait_for(self, predicate) -> bool:
+        '''Wait on BUFFER reports until predicate() is true, asking ardopcf for one when it goes quiet.
+        Returns False if cancelled.'''
+        while True:
+            with self.condition:
+                reports = self.reports
+                self.condition.wait_for(lambda: self.cancelled or predicate() or self.reports != reports,
+                                        BUFFER_QUERY_INTERVAL)
+                if self.cancelled:
+                    return False
+                if predicate():
+                    return True
+                quiet = self.reports == reports
+                # nothing is written while we wait, so after this long ardopcf has everything
+                self.settled = quiet
+            if quiet:
+                self.query_buffer()
+
+
+# seconds an ARQ link with nothing to send is kept up for the next message, before we DISCONNECT it.
+# ardopcf drops a quiet link by itself after its ARQTIMEOUT, so this only matters when it is shorter than that.
+ARQ_IDLE_TIMEOUT = 25
+
+
+class ARQSession:
+    def __init__(self, command, call, wait_until_empty, on_link_lost, idle_timeout: float = ARQ_IDLE_TIMEOUT):
+        '''Keeps an ARQ link to a station open across messages, instead of calling it for every one.
+
+        ardopcf holds one ARQ connection at a time, and setting one up takes several frames each way.
+        While the link to a station is up, anything more for it is just loaded into the buffer and goes
+        over the same link. The link is closed with DISCONNECT once it has been idle for idle_timeout seconds,
+        or when there is something for a different station, after what is left for this one has gone.
+
+        command(str) sends a command to ardopcf without waiting, call(station) sends the ARQCALL,
+        and wait_until_empty() blocks until ardopcf has sent everything in its buffer, returning False
+        if that was given up on. on_link_lost(station, failed) is called when a link or a call ends, anything still
+        waiting to go over it will not. failed is True if the call was never answered, or data was left in the buffer. CONNECTED, DISCONNECTED, NEWSTATE and REJECTED notifications
+        go to on_notification, and anything that shows the link is in use, like data coming in, to touch. BUFFER reports go to on_buffer_report.'''
+        self.command = command
+        self.call = call
+        self.wait_until_empty = wait_until_empty
+        self.on_link_lost = on_link_lost
+        self.idle_timeout = idle_timeout
+        self.peer = None # the station the link is with, or that we are calling
+        self.connected = False
+        self.last_activity = time.monotonic()
+        self.buffered = 0 # what ardopcf last said is left in its buffer
+        self.idle_timer = None # type: threading.Timer
+        self.condition = threading.Condition()
+
+    def prepare(self, peer: str, timeout: float) -> bool:
+        '''Call before loading data for peer. If the link is to someone else, waits for their data to go,
+        then disconnects. Returns False if we could not get the link free within timeout seconds.'''
+        with self.condition:
+            current = self.peer
+        if current is None or current == peer:
+            return True
+        # ardopcf sends whatever is in its buffer to whoever the link is with
+        if not self.wait_until_empty() and self.peer is not None:
+            # given up on, like with the Stop button
+            return False
+        self.disconnect()
+        with self.condition:
+            if self.condition.wait_for(lambda: self.peer is None, timeout):
+                return True
+        # the other station is not answering, drop the link without them
+        self.command('ABORT')
+        with self.condition:
+            return self.condition.wait_for(lambda: self.peer is None, timeout)
+
+    def open(self, peer: str):
+        '''Make sure there is a link to peer, once its data is in ardopcf's buffer'''
+        with self.condition:
+            self.last_activity = time.monotonic()
+            if self.peer == peer:
+                # already connected, or still calling, it goes over that link
+                return
+            self.peer = peer
+            self.connected = False
+        self.call(peer)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    def on_buffer_report(self, size: int):
+        # a link with data still going over it is not idle
+        self.buffered = size
+        if size:
+            self.touch()
+
+    def disconnect(self):
+        with self.condition:
+            if self.peer is None:
+                return
+            self.__cancel_idle_timer()
+        self.command('DISCONNECT')
+
+    def on_notification(self, line: str):
+        words = line.split()
+        if not words:
+            return
+        lost = None
+        with self.condition:
+            if words[0] == 'CONNECTED' and len(words) > 1:
+                # CONNECTED STATION BANDWIDTH, whether we called them or they called us
+                self.peer = words[1]
+                self.connected = True
+                self.last_activity = time.monotonic()
+                self.__arm_idle_timer(self.idle_timeout)
+            elif words[0] in ('DISCONNECTED', 'REJECTEDBW', 'REJECTEDBUSY') or line == 'NEWSTATE DISC':
+                # hung up, timed out, or the call failed
+                if self.peer is not None:
+                    lost = (self.peer, not self.connected or self.buffered > 0)
+                self.peer = None
+                self.connected = False
+                self.__cancel_idle_timer()
+            self.condition.notify_all()
+        if lost:
+            self.on_link_lost(*lost)
+
+    def __arm_idle_timer(self, delay: float):
+        self.__cancel_idle_timer()
+        self.idle_timer = threading.Timer(delay, self.__check_idle)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def __cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def __check_idle(self):
+        # activity only moves last_activity, the timer is re-armed here for whatever time is left
+        with self.condition:
+            self.idle_timer = None
+            if not self.connected:
+                return
+            remaining = self.last_activity + self.idle_timeout - time.monotonic()
+            if self.buffered:
+                # still sending, look again later
+                remaining = max(remaining, self.idle_timeout, 1)
+            if remaining > 0:
+                self.__arm_idle_timer(remaining)
+                return
+        self.disconnect()
+
+
+# the parts of the TNC state that are shown in the UI and announced to plugins when they change
+WATCHED_STATE = ('state', 'buffer', 'ptt')
+# NEWSTATE values for when the TNC is sending, or has a link that can start sending any moment
+BUSY_STATES = {'FECSend', 'ISS', 'IRS', 'IRStoISS'}
+# seconds without hearing anything from ardopcf before we ask for STATE and BUFFER ourselves.
+# ardopcf tells us about every change on its own, so the polling only catches what we missed.
+STATE_POLL_BUSY = 2.0
+STATE_POLL_IDLE = 60.0
+
+
+class StateWatcher:
+    def __init__(self, on_change, busy_interval: float = STATE_POLL_BUSY, idle_interval: float = STATE_POLL_IDLE):
+        '''Keeps track of the TNC state from what ardopcf sends on its own (NEWSTATE, BUFFER and PTT),
+        rather than asking for it all the time. on_change(changes: dict) is called on the reader's thread
+        with the new value of each WATCHED_STATE key that changed, so it should return quickly.
+        poll_due says when it is worth asking anyway: every busy_interval seconds of silence while sending,
+        and every idle_interval seconds of silence otherwise.'''
+        self.on_change = on_change
+        self.busy_interval = busy_interval
+        self.idle_interval = idle_interval
+        self.lock = threading.Lock()
+        self.published = {} # type: dict[str, object]
+        self.last_heard = 0.0
+        self.last_polled = 0.0
+
+    def heard(self, state: dict):
+        '''Call with the state after every line from ardopcf has been applied to it'''
+        self.last_heard = time.monotonic()
+        with self.lock:
+            changes = {key: state.get(key) for key in WATCHED_STATE if key not in self.published or state.get(key) != self.published[key]}
+            self.published.update(changes)
+        if changes:
+            self.on_change(changes)
+
+    def is_busy(self, state: dict) -> bool:
+        buffered = state.get('buffer')
+        return bool(state.get('ptt')) or state.get('state') in BUSY_STATES or (isinstance(buffered, int) and buffered > 0)
+
+    def interval(self, state: dict) -> float:
+        return self.busy_interval if self.is_busy(state) else self.idle_interval
+
+    def poll_due(self, state: dict) -> bool:
+        '''True if it has been quiet long enough that we should ask for the state, and counts it as asked'''
+        now = time.monotonic()
+        if now - max(self.last_heard, self.last_polled) < self.interval(state):
+            return False
+        self.last_polled = now
+        return True
+
+    def reset(self):
+        '''Forget what we know, like after reconnecting, so the next poll_due is True and every key is announced again'''
+        with self.lock:
+            self.published.clear()
+        self.last_heard = 0.0
+        self.last_polled = 0.0
+
+
+def parse_text(value: str) -> str:
+    return value
+
+
+def parse_int(value: str) -> int:
+    return int(value)
+
+
+def parse_flag(value: str) -> bool:
+    # ardopcf answers TRUE or FALSE
+    return value.upper() != 'FALSE'
+
+
+# what ardopcf's answer to each query means for our copy of its settings,
+# {verb: (state key, parser)}, the parser is given the last word of the response.
+# FECMODE is left out, ardopcf only echoes what we set, and state['fec_mode'] is the mode picked in the
+# settings, which has to survive the modes ARDOPCF.select_fec_mode switches to
+RESPONSE_FIELDS = {
+    'MYCALL': ('mycall', parse_text),
+    'MYAUX': ('myaux', parse_text),
+    'GRIDSQUARE': ('gridsquare', parse_text),
+    'BUFFER': ('buffer', parse_int),
+    'STATE': ('state', parse_text),
+    'PROTOCOLMODE': ('protocol_mode', parse_text),
+    'FECREPEATS': ('fec_repeats', parse_int),
+    'LISTEN': ('listen', parse_text),
+    'ENABLEPINGACK': ('enablepingack', parse_text),
+    'USE600MODES': ('use600modes', parse_flag),
+    'VERSION': ('version', parse_text),
+    'LOGLEVEL': ('loglevel', parse_int),
+    'MONITOR': ('monitor', parse_text),
+    'CAPTURE': ('capture', parse_text),
+    'PLAYBACK': ('playback', parse_text),
+    'SQUELCH': ('squelch', parse_int),
+    'TRAILER': ('trailer', parse_int),
+    'TUNINGRANGE': ('tuningrange', parse_int),
+    'EXTRADELAY': ('extradelay', parse_int),
+    'LEADER': ('leader', parse_int),
+    'BUSYDET': ('busydet', parse_text),
+    'DRIVELEVEL': ('drivelevel', parse_text),
+    'CWID': ('cwid', parse_text),
+    'ARQBW': ('arqbw', parse_text),
+    'ARQTIMEOUT': ('arqtimeout', parse_int),
+    'AUTOBREAK': ('autobreak', parse_text),
+    'BUSYBLOCK': ('busyblock', parse_text),
+    'CALLBW': ('callbw', parse_text),
+}
+
+
+def apply_response(state: dict, line: str) -> str:
+    '''Store what a response line tells us in state, and return its verb.
+    One dictionary lookup per line, lines that carry no setting (PURGEBUFFER, FECSEND, notifications) change nothing.'''
+    words = line.split()
+    if not words:
+        return ''
+    verb = words[0].upper()
+    field = RESPONSE_FIELDS.get(verb)
+    # "MYAUX" on its own means there is no aux call set, keep what we had
+    if field is None or len(words) < 2:
+        return verb
+    key, parser = field
+    try:
+        state[key] = parser(words[-1])
+    except ValueError:
+        print(f"ARDOPCF: could not understand '{line}'")
+    return verb
+
+
+# roughly the SNR in dB (3kHz bandwidth, as PINGACK reports it) each FEC mode needs to decode most of the time.
+# These are estimates from on-air use and the shape of the ARDOP spec's curves, not measured values,
+# adjust them if a mode keeps failing on links that should carry it.
+MODE_MIN_SNR = {
+    '4FSK.200.50S': -5,
+    '4PSK.200.100S': -1,
+    '4PSK.200.100': 2,
+    '8PSK.200.100': 6,
+    '16QAM.200.100': 10,
+    '4FSK.500.100S': 0,
+    '4FSK.500.100': 3,
+    '4PSK.500.100': 5,
+    '8PSK.500.100': 9,
+    '16QAM.500.100': 13,
+    '4PSK.1000.100': 8,
+    '8PSK.1000.100': 12,
+    '16QAM.1000.100': 16,
+    '4PSK.2000.100': 11,
+    '8PSK.2000.100': 15,
+    '16QAM.2000.100': 19,
+    '4FSK.2000.600': 6,
+    '4FSK.2000.600S': 3,
+}
+# headroom on top of MODE_MIN_SNR, band conditions change between a ping and the next transmission
+SNR_MARGIN = 3
+# every failed or unacknowledged send to a station counts as this many dB less SNR, until it is acknowledged again
+STEP_DOWN_DB = 3
+# link reports older than this many seconds say little about the band now
+LINK_REPORT_MAX_AGE = 1800
+# a faster mode has to save at least this many seconds of airtime before we give up the most robust one
+MIN_AIRTIME_SAVING = 30
+# seconds to wait for an ACK after the transmission should have finished
+ACK_TIMEOUT = 30
+
+
+class FECModeSelector:
+    def __init__(self, modes: list, rate_table: dict, airtime=None):
+        '''Picks the FEC mode for each transmission, from what we know about the link to each recipient.
+
+        Link quality comes from PINGACK (and PINGs we hear from others), and is kept per station.
+        A failed or unacknowledged send steps that station down, an acknowledged one steps it back up.
+        The fastest mode the worst recipient should decode is used, unless it would save so little airtime
+        that the most robust mode costs nothing, like for a line of chat. With no link report for a recipient,
+        or for a broadcast to ALL, the most robust mode is used.
+        airtime(datalen, mode) gives seconds on air, like ARDOPCF.estimate_airtime, otherwise rate_table alone is used.'''
+        self.modes = modes
+        self.rate_table = rate_table
+        self.estimate_airtime = airtime
+        # {callsign: {'snr': dB, 'quality': 0-100, 'updated': time.time(), 'failures': n, 'acknowledges': bool}}
+        self.stations = {} # type: dict[str, dict]
+        # sends waiting for an ACK, [(deadline, set of callsigns)]
+        self.awaiting_ack = [] # type: list[tuple[float, set]]
+        self.lock = threading.Lock()
+
+    def __station(self, callsign: str) -> dict:
+        # callsigns come back upper case from binary frames, whatever case we sent them in
+        return self.stations.setdefault(callsign.upper(), {'snr': None, 'quality': None, 'updated': 0, 'failures': 0, 'acknowledges': False})
+
+    def record_link_quality(self, callsign: str, snr: float, quality: int = None):
+        with self.lock:
+            station = self.__station(callsign)
+            station['snr'] = snr
+            station['quality'] = quality
+            station['updated'] = time.time()
+
+    def record_failure(self, callsign: str):
+        with self.lock:
+            self.__station(callsign)['failures'] += 1
+
+    def record_acknowledged(self, callsign: str):
+        with self.lock:
+            station = self.__station(callsign)
+            station['acknowledges'] = True
+            station['failures'] = max(0, station['failures'] - 1)
+            for deadline, callsigns in self.awaiting_ack:
+                callsigns.discard(callsign.upper())
+
+    def record_sent(self, callsigns, airtime: float):
+        '''Expect an ACK from every recipient that has acknowledged us before. Stations that never
+        do (no autoACK) are not held against the link.'''
+        with self.lock:
+            expecting = {callsign.upper() for callsign in callsigns if self.stations.get(callsign.upper(), {}).get('acknowledges')}
+            if expecting:
+                self.awaiting_ack.append((time.time() + (airtime or 0) + ACK_TIMEOUT, expecting))
+
+    def __expire_acks(self, now: float):
+        # anyone who did not answer in time counts as a failure
+        waiting = []
+        for deadline, callsigns in self.awaiting_ack:
+            if deadline > now:
+                waiting.append((deadline, callsigns))
+                continue
+            for callsign in callsigns:
+                self.__station(callsign)['failures'] += 1
+        self.awaiting_ack = waiting
+
+    def link_snr(self, callsign: str, now: float = None):
+        '''The SNR we plan with for this station, after stepping down for failures, or None if we do not know'''
+        now = now or time.time()
+        station = self.stations.get(callsign.upper())
+        if not station or station['snr'] is None or now - station['updated'] > LINK_REPORT_MAX_AGE:
+            return None
+        return station['snr'] - station['failures'] * STEP_DOWN_DB
+
+    def airtime(self, mode: str, datalen: int):
+        if self.estimate_airtime is not None:
+            return self.estimate_airtime(datalen, mode)
+        rate = self.rate_table.get(mode)
+        if not rate:
+            return None
+        # rate_table is in bytes per minute
+        return datalen / rate * 60
+
+    def select(self, callsigns, datalen: int, use600modes: bool = True) -> str:
+        '''The mode to send datalen bytes to callsigns in'''
+        usable = [mode for mode in self.modes if self.rate_table.get(mode) and (use600modes or not mode.endswith(('.600', '.600S')))]
+        robust = min(usable, key=lambda mode: self.rate_table[mode])
+        now = time.time()
+        with self.lock:
+            self.__expire_acks(now)
+            callsigns = [callsign for callsign in callsigns if callsign]
+            if not callsigns or 'ALL' in callsigns:
+                return robust
+            snrs = [self.link_snr(callsign, now) for callsign in callsigns]
+        if None in snrs:
+            return robust
+        # everyone has to be able to decode it
+        snr = min(snrs)
+        decodable = [mode for mode in usable if MODE_MIN_SNR.get(mode, float('inf')) + SNR_MARGIN <= snr]
+        if not decodable:
+            return robust
+        fastest = max(decodable, key=lambda mode: self.rate_table[mode])
+        if self.airtime(robust, datalen) - self.airtime(fastest, datalen) < MIN_AIRTIME_SAVING:
+            return robust
+        return fastest
+
+
+# bytes per minute each FEC mode carries. The ones marked estimated are not in the datasheet,
+# they are scaled from the 4FSK.200.50S and 4PSK.200.100S figures by baud rate and frame size.
+RATE_TABLE = {
+    '4FSK.200.50S': 310,
+    '4PSK.200.100S': 436,
+    '4PSK.200.100': 756,
+    '8PSK.200.100': 1286,
+    '16QAM.200.100': 1512,
+
+    '4FSK.500.100S': 360, # estimated
+    '4FSK.500.100': 620, # estimated
+    '4PSK.500.100': 1509,
+    '8PSK.500.100': 2566,
+    '16QAM.500.100': 3024,
+
+    '4PSK.1000.100': 3018,
+    '8PSK.1000.100': 5133,
+    '16QAM.1000.100': 6036,
+
+    '4PSK.2000.100': 6144,
+    '8PSK.2000.100': 10386,
+    '16QAM.2000.100': 12072,
+    '4FSK.2000.600': 3700, # estimated
+    '4FSK.2000.600S': 2150 # estimated
+}
+# data bytes in one frame of each FEC mode, across all its carriers, from the frame table in the ARDOP spec.
+# A payload is sent in whole frames, the last one padded out.
+FRAME_DATA_BYTES = {
+    '4FSK.200.50S': 16,
+    '4PSK.200.100S': 16,
+    '4PSK.200.100': 64,
+    '8PSK.200.100': 108,
+    '16QAM.200.100': 128,
+    '4FSK.500.100S': 32,
+    '4FSK.500.100': 64,
+    '4PSK.500.100': 128,
+    '8PSK.500.100': 216,
+    '16QAM.500.100': 256,
+    '4PSK.1000.100': 256,
+    '8PSK.1000.100': 432,
+    '16QAM.1000.100': 512,
+    '4PSK.2000.100': 512,
+    '8PSK.2000.100': 864,
+    '16QAM.2000.100': 1024,
+    '4FSK.2000.600': 600,
+    '4FSK.2000.600S': 200,
+}
+# the FEC ID frame sent ahead of the data when FECID is on, about one short 4FSK frame (estimated)
+ID_FRAME_SECONDS = 1.5
+# ardopcf sends its CW ID at about 20 WPM, a dit is 1.2 / WPM seconds
+CW_DIT_SECONDS = 0.06
+# the length of each character in dits, including the gaps between its elements, but not the gap after it
+MORSE_DITS = {}
+for _char, _code in zip('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789/-', (
+        '.-', '-...', '-.-.', '-..', '.', '..-.', '--.', '....', '..', '.---', '-.-', '.-..', '--',
+        '-.', '---', '.--.', '--.-', '.-.', '...', '-', '..-', '...-', '.--', '-..-', '-.--', '--..',
+        '-----', '.----', '..---', '...--', '....-', '.....', '-....', '--...', '---..', '----.',
+        '-..-.', '-....-')):
+    MORSE_DITS[_char] = sum(1 if element == '.' else 3 for element in _code) + len(_code) - 1
+
+
+def cw_id_seconds(callsign: str) -> float:
+    '''How long ardopcf takes to send callsign in morse'''
+    dits = [MORSE_DITS[char] for char in callsign.upper() if char in MORSE_DITS]
+    if not dits:
+        return 0.0
+    # three dits between characters
+    return (sum(dits) + 3 * (len(dits) - 1)) * CW_DIT_SECONDS
+
+
+def estimate_fec_airtime(datalen: int, rate: float, frame_bytes: int, leader_ms: int = 0, trailer_ms: int = 0,
+                         repeats: int = 0, extradelay_ms: int = 0, cw_id: float = 0.0, id_frame: bool = False) -> float:
+    '''Seconds the channel is busy sending datalen bytes in one FEC transmission.
+
+    rate is the mode's rate_table entry in bytes per minute, which covers a frame's own symbols.
+    Every frame, including each of the repeats, also gets a leader and a trailer. The extra delay,
+    the ID frame and the CW ID are paid once per transmission.'''
+    if datalen <= 0:
+        return 0.0
+    frames = -(-datalen // frame_bytes) * (1 + repeats)
+    frame_seconds = frame_bytes / rate * 60 + (leader_ms + trailer_ms) / 1000
+    seconds = frames * frame_seconds + extradelay_ms / 1000 + cw_id
+    if id_frame:
+        seconds += ID_FRAME_SECONDS + (leader_ms + trailer_ms) / 1000
+    return seconds
@@ -93,18 +93,19 @@ class ArdopALE:
         If you use "ALL" in your handlers, you may recieve nonstandard data, containing only a payload.
 
         When it gets here, it will be a dictionary like this:
-        {'header': b'SENDER:PLUGINNAME:PLUGINVERSION:RECIPENTS:BEGIN:', 'payload': b'<DATA>'}
+        {'header': b'SENDER:PLUGINNAME:PLUGINVERSION:RECIPENTS', 'payload': b'<DATA>', 'frame': Frame}
         '''
         if not self.ale_listen.get():
             return
-        if self.header_id not in data['header'][1].decode():
+        frame = data['frame']
+        if frame is None or frame.handler != self.header_id:
             return
         # check if we are the recipient, or if it is a broadcast
-        if data['header'][3] == 'ALL' or data['header'][3] == self.host_interface.get_callsign():
-            print(f"ALE handshake received: {data['payload'].decode()}")
-            self.last_heard_station = data['header'][0].decode()
-            self.last_freq = self.host_interface.IPC('Hamlib', self.definition['name'], 'get_radio_frequency')
-            self.ale_handshake(data['header'][0].decode())
+        if frame.is_addressed_to(self.host_interface.settings['callsign']):
+            print(f"ALE handshake received: {frame.payload_bytes.decode()}")
+            self.last_heard_station = frame.sender
+            self.last_freq = self.host_interface.plugMgr.IPC('Hamlib', self.definition['name'], 'get_radio_frequency')
+            self.ale_handshake(frame.sender)
 
     def create_frequency_tuning_schedule(self):
         '''This method creates a list of frequencies to tune to in order to find a station.'''
@@ -152,9 +153,8 @@ class ArdopALE:
         self.ale_handshake(station)
 
     def ale_handshake(self, station: str):
-        sender = self.host_interface.get_callsign()
-        standard_frame = f"{sender}:{self.header_id}:{self.definition['version']}:{station}:BEGIN::END:"
-        self.host_interface.plugMgr.IPC('ARDOPCF', self.definition['name'], command='send', data=standard_frame.encode())
+        standard_frame = self.host_interface.build_frame(self.header_id, self.definition['version'], b'', recipients=station)
+        self.host_interface.plugMgr.IPC('ARDOPCF', self.definition['name'], command='send', data=standard_frame)
 
     def create_plugin_frame(self, tkParent) -> tk.Frame:
         ale_frame = tk.Frame(tkParent)
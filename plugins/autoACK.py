@@ -1,6 +1,5 @@
 import tkinter as tk
 from hamChatPlugin import hamChatPlugin
-import time
 """
 Standard hamChat header format:
 0       1    2      3        4          5         6 (-1)
@@ -43,24 +42,25 @@ class autoACK(hamChatPlugin):
             return
         # we do not want to ACK our own ACKs
         # it'd be an ACK ATTACK!
-        if b"autoACKed " in data['payload'][:10]:
+        frame = data['frame']
+        if frame is None:
+            # nonstandard data, we subscribe to ALL so we get that too
             return
-        recepients = data['header'].split(b':')[3]
-        our_callsign = self.host_interface.settings['callsign'].encode()
+        if frame.payload[:10] == b"autoACKed ":
+            return
+        our_callsign = self.host_interface.settings['callsign']
 
         # spometimes we will get an ack back, sometimes not!
         # right now does not respect SSID
-        if (our_callsign in recepients) or self.reply_to_all.get():
+        if frame.names(our_callsign) or self.reply_to_all.get():
             if self.host_interface.debug.get():
-                print(f"autoACK: Responding to {recepients} with ACK")
+                print(f"autoACK: Responding to {frame.sender} with ACK")
 
-            length_of_data = len(data['payload'])
-            ack = f"{our_callsign.decode()}:chat:0.1:{data['header'].split(b':')[0].decode()}:BEGIN:autoACKed {length_of_data} bytes:END:".encode()
+            length_of_data = len(frame.payload)
+            ack = self.host_interface.build_frame('chat', '0.1', f"autoACKed {length_of_data} bytes".encode(), recipients=frame.sender)
             # up to the transport to determine if the channel is busy or not.
-            self.host_interface.transport.append_bytes_to_buffer(ack)
-            # wait a moment before sending the ACK in return, the data interface may not be ready yet 
-            time.sleep(0.1)
-            self.host_interface.transport.on_transmit_buffer()
+            # ACKs go ahead of everything else waiting to be sent
+            self.host_interface.transmit(ack, 'ack')
 
     def create_plugin_frame(self, tkParent) -> tk.Frame:
         self.autoack_frame = tk.Frame(tkParent)
@@ -47,12 +47,9 @@ class Beacon(hamChatPlugin):
         now = time.time()
         while self.stop_event.is_set() == False:
             if self.enabled.get() and (time.time() - now > self.interval.get()):
-                callsign = self.host_interface.settings['callsign']
-                recipients = self.host_interface.get_recipients()
                 message = self.message.get()
                 print(f"Sending Beacon: {message}")
-                self.host_interface.transport.append_bytes_to_buffer(f"{callsign}:chat:0.1:{recipients}:BEGIN:{message}:END:".encode())
-                self.host_interface.transport.on_transmit_buffer()
+                self.host_interface.transmit(self.host_interface.build_frame('chat', '0.1', message.encode()), 'beacon')
                 now = time.time()
             # this allows us to shut down this thread quickly without wasting resources
             time.sleep(0.5)
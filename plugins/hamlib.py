@@ -3,6 +3,7 @@ from hamChatPlugin import hamChatPlugin
 import tkinter as tk
 import socket
 import time
+import threading
 # help us access the main hamChat class in our editor
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
@@ -32,6 +33,10 @@ class Hamlib(hamChatPlugin):
             'name': 'Hamlib',
             'version': '0.1',
             'description': self.info,
+            # seconds to wait for rigctld to accept the connection
+            'connect_timeout': 3,
+            # we key the radio, PTT comes to us before any other plugin
+            'rig_control': True,
             'depends_on': [{'plugin': 'Core', 'version': '0.1'}],
         }
         self.hamlib_status ={
@@ -41,6 +46,11 @@ class Hamlib(hamChatPlugin):
             'ptt': 'False',
         }
         self.sock_rigctld = None
+        # PTT gets its own connection to rigctld, so keying never waits behind a frequency or mode query
+        self.sock_ptt = None
+        self.ptt_lock = threading.Lock()
+        # set while we are connected to rigctld. self.status mirrors it for tk, on the main thread
+        self.connected = threading.Event()
         self.rigctld_host = 'localhost'
         self.rigctld_port = '4532'
         self.status = tk.StringVar()
@@ -53,20 +63,31 @@ class Hamlib(hamChatPlugin):
         self.freq = tk.StringVar()
         self.mode = tk.StringVar()
         self.ptt = tk.StringVar()
-        self.__open_rigctld_socket()
-        
+        # we connect to rigctld in on_connect, in the background
+
+    def on_connect(self, timeout: float):
+        self.__open_rigctld_socket(timeout)
 
     def on_key_transmitter(self):
-        if self.sock_rigctld is not None:
-            try:
-                self.sock_rigctld.sendall(b'T 1\n')
-            except OSError:
-                pass
+        self.__send_ptt(b'T 1\n')
 
     def on_unkey_transmitter(self):
-        if self.sock_rigctld is not None:
+        self.__send_ptt(b'T 0\n')
+
+    def __send_ptt(self, command: bytes):
+        # this runs on the transport's thread, the moment it asks for PTT
+        with self.ptt_lock:
+            if self.sock_ptt is None:
+                return
             try:
-                self.sock_rigctld.sendall(b'T 0\n')
+                # rigctld answers every T with RPRT 0, throw the old answers away so they never pile up
+                self.sock_ptt.recv(4096)
+            except BlockingIOError:
+                pass
+            except OSError:
+                return
+            try:
+                self.sock_ptt.sendall(command)
             except OSError:
                 pass
 
@@ -74,6 +95,10 @@ class Hamlib(hamChatPlugin):
         if self.sock_rigctld is not None:
             self.on_unkey_transmitter()
             self.sock_rigctld.close()
+        with self.ptt_lock:
+            if self.sock_ptt is not None:
+                self.sock_ptt.close()
+                self.sock_ptt = None
     
     def create_plugin_frame(self, tkParent):
         self.hamlib_frame = tk.Frame(tkParent)
@@ -83,7 +108,7 @@ class Hamlib(hamChatPlugin):
         hamlib_label.pack(side=tk.LEFT)
         self.hamlib_status_label = tk.Label(statusframe, textvariable=self.status)
         self.hamlib_status_label.pack(side=tk.RIGHT)
-        if self.status.get() == "Connected":
+        if self.connected.is_set():
             self.hamlib_status_label.config(fg='green')
         # self.hamlib_freq_label = tk.Label(self.hamlib_frame, textvariable=self.freq)
         # self.hamlib_freq_label.pack()
@@ -96,7 +121,9 @@ class Hamlib(hamChatPlugin):
         self.hamlib_frame.pack()
 
     def update_plugin_frame(self):
-        if self.status.get() == "Connected":
+        # we connect on another thread, tk only hears about it here on the main thread
+        if self.connected.is_set():
+            self.status.set("Connected")
             self.hamlib_status_label.config(fg='green')
             #self.freq.set(f"{self.get_radio_frequency()}Hz")
             #self.mode.set(f"{self.get_radio_mode()}")
@@ -136,7 +163,8 @@ class Hamlib(hamChatPlugin):
             return
         self.rigctld_host = self.rigctld_host_entry.get()
         self.rigctld_port = self.rigctld_port_entry.get()
-        self.__open_rigctld_socket()
+        # connecting can take up to connect_timeout, do not hold up the window
+        threading.Thread(target=self.__open_rigctld_socket, args=(self.definition['connect_timeout'],), daemon=True).start()
         self.hamlib_config_window.destroy()
 
     def __test_rigctld_connection(self):
@@ -237,7 +265,7 @@ class Hamlib(hamChatPlugin):
         elif command == "get_plugin_info":
             return self.definition
         elif command == "get_plugin_status":
-            return {"status": self.status.get()}
+            return {"status": "Connected" if self.connected.is_set() else "Error"}
         else:
             return {"error": "Command not recognized."}
     
@@ -261,25 +289,41 @@ class Hamlib(hamChatPlugin):
             
         
 
-    def __open_rigctld_socket(self):
+    def __open_rigctld_socket(self, timeout: float = None):
+        # this blocks for up to timeout seconds, so it runs on a background thread
         try:
             if self.sock_rigctld is not None:
                 self.sock_rigctld.close()
+            self.connected.clear()
             self.sock_rigctld = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock_rigctld.settimeout(timeout)
             self.sock_rigctld.connect((self.rigctld_host, int(self.rigctld_port)))
             self.sock_rigctld.setblocking(False)
             self.__test_rigctld_connection() # we expect to throw an exception if we can't connect
-            self.status.set("Connected")
-            # make it green
-            self.hamlib_status_label.config(fg='green')
+            self.__open_ptt_socket(timeout)
+            self.connected.set()
             self.configure_menu_error_message = "No error detected."
         except BlockingIOError:
             pass
         except Exception as e:
-            self.status.set("Error")
-            # make it red
-            self.hamlib_status_label.config(fg='red')
+            self.connected.clear()
             error_type = type(e).__name__ 
             if error_type == "gaierror":
                 error_type = "an incorrect hostname or IP address"
-            self.configure_menu_error_message = f"Could not connect to rigctld due to {error_type}.\nPlease configure the plugin."
\ No newline at end of file
+            self.configure_menu_error_message = f"Could not connect to rigctld due to {error_type}.\nPlease configure the plugin."
+
+    def __open_ptt_socket(self, timeout: float = None):
+        sock_ptt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # PTT commands are tiny, send them right away rather than waiting to fill a packet
+        sock_ptt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock_ptt.settimeout(timeout)
+        try:
+            sock_ptt.connect((self.rigctld_host, int(self.rigctld_port)))
+        except OSError:
+            sock_ptt.close()
+            raise
+        sock_ptt.setblocking(False)
+        with self.ptt_lock:
+            if self.sock_ptt is not None:
+                self.sock_ptt.close()
+            self.sock_ptt = sock_ptt
@@ -0,0 +1,544 @@
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+# run from anywhere, the ARDOP tables live in the plugins folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'plugins'))
+from _ardop_host import RATE_TABLE, FRAME_DATA_BYTES
+
+"""
+A stand-in for ardopcf, so hamChat can be run, tested and benchmarked without a radio or a sound card.
+
+Each emulated TNC speaks the ardopcf host protocol on a command port and the data port after it,
+like `ardopcf 8515` does: text commands and responses ending in \\r, BUFFER, STATE, NEWSTATE, PTT and BUSY
+notifications, and <2 byte length><FEC|ARQ|ERR><data> frames for received data.
+All the TNCs share one simulated channel. Frames take as long as the mode's rate in RATE_TABLE says
+(times --speed), only one station is heard at a time, and each frame can be lost or corrupted.
+Lost FEC frames are not heard at all, corrupted ones are passed up as ERR frames, like ardopcf does
+when a frame fails its CRC. ARQ repeats lost and corrupted frames until they get through.
+
+To have two hamChat instances talk to each other, start one TNC for each:
+    python tools/ardopcf_emulator.py --ports 8515 8525 --loss 0.05 --corrupt 0.02
+then point the second instance's ARDOPCF plugin at port 8525.
+Usage: python tools/ardopcf_emulator.py [--ports PORT ...] [--speed X] [--loss P] [--corrupt P] [--rate MODE=BYTES_PER_MINUTE]
+"""
+
+# the ARQ bandwidth settings and the mode the emulated link runs at for each,
+# real ardopcf shifts between modes as conditions change, we stay in the middle of the range
+ARQ_BANDWIDTH_MODES = {
+    '200': '4PSK.200.100',
+    '500': '8PSK.500.100',
+    '1000': '8PSK.1000.100',
+    '2000': '8PSK.2000.100',
+}
+# seconds the ARQ call and answer take, and the ACK after every data frame
+ARQ_CONNECT_SECONDS = 4.0
+ARQ_ACK_SECONDS = 0.5
+# seconds one ping and its answer take
+PING_SECONDS = 2.0
+# what every station reports it hears, PINGACK SNdB Quality
+DEFAULT_SNR = 10
+DEFAULT_QUALITY = 90
+# settings a fresh ardopcf starts with, anything else is remembered as it is set
+DEFAULT_SETTINGS = {
+    'MYCALL': '',
+    'MYAUX': '',
+    'GRIDSQUARE': '',
+    'PROTOCOLMODE': 'FEC',
+    'FECMODE': '4PSK.500.100',
+    'FECREPEATS': '0',
+    'FECID': 'FALSE',
+    'LISTEN': 'TRUE',
+    'ENABLEPINGACK': 'TRUE',
+    'LEADER': '120',
+    'TRAILER': '20',
+    'EXTRADELAY': '0',
+    'ARQBW': '500MAX',
+    'ARQTIMEOUT': '30',
+    'VERSION': 'emulator',
+}
+# commands that do something rather than set something
+ACTIONS = {'INITIALIZE', 'BUFFER', 'STATE', 'PURGEBUFFER', 'FECSEND', 'ABORT', 'ARQCALL', 'DISCONNECT', 'PING', 'CLOSE'}
+
+
+class Channel:
+    def __init__(self, speed: float = 1.0, loss: float = 0.0, corrupt: float = 0.0, rates: dict = None, seed: int = None):
+        '''The air between the emulated TNCs. One station is heard at a time, the others wait for it to be clear,
+        like ardopcf's busy detector makes them. speed makes everything take that many times longer,
+        so 0.1 runs ten times faster than real time.'''
+        self.speed = speed
+        self.loss = loss
+        self.corrupt = corrupt
+        self.rates = dict(RATE_TABLE)
+        self.rates.update(rates or {})
+        self.random = random.Random(seed)
+        self.tncs = [] # type: list[EmulatedTNC]
+        self.condition = threading.Condition()
+        self.keyed = None # the TNC on air
+        self.stats = {'frames': 0, 'lost': 0, 'corrupted': 0, 'delivered_bytes': 0}
+
+    def find(self, callsign: str):
+        for tnc in self.tncs:
+            if tnc.settings['MYCALL'].upper() == callsign.upper():
+                return tnc
+        return None
+
+    def frame_seconds(self, tnc, mode: str, repeats: int = 0) -> float:
+        '''How long one frame of mode keeps the channel busy, with the sender's leader and trailer'''
+        overhead = (int(tnc.settings['LEADER']) + int(tnc.settings['TRAILER'])) / 1000
+        return (FRAME_DATA_BYTES[mode] / self.rates[mode] * 60 + overhead) * (1 + repeats) * self.speed
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds * self.speed)
+
+    def key(self, tnc) -> bool:
+        '''Wait for the channel to be clear, then take it. Returns False if the TNC was told to stop meanwhile.'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.keyed in (None, tnc) or tnc.aborted.is_set())
+            if tnc.aborted.is_set():
+                return False
+            was_clear = self.keyed is None
+            self.keyed = tnc
+        tnc.set_ptt(True)
+        if was_clear:
+            self.busy(tnc, True)
+        return True
+
+    def unkey(self, tnc):
+        tnc.set_ptt(False)
+        with self.condition:
+            cleared = self.keyed is tnc
+            if cleared:
+                self.keyed = None
+            self.condition.notify_all()
+        if cleared:
+            self.busy(tnc, False)
+
+    def busy(self, sender, busy: bool):
+        # what the busy detector of every other TNC tells its host, hamChat takes BUSY FALSE as the end of a transmission
+        for tnc in self.tncs:
+            if tnc is not sender:
+                tnc.send_line('BUSY TRUE' if busy else 'BUSY FALSE')
+
+    def damage(self, copies: int = 1) -> str:
+        '''What happens to a frame sent copies times: None if one got through, 'lost' or 'corrupted' otherwise'''
+        outcome = 'lost'
+        for _ in range(copies):
+            roll = self.random.random()
+            if roll >= self.loss + self.corrupt:
+                return None
+            if roll >= self.loss:
+                outcome = 'corrupted'
+        return outcome
+
+    def broadcast(self, sender, data: bytes, copies: int):
+        '''An FEC frame, everyone else listening may hear it'''
+        self.stats['frames'] += 1
+        for tnc in self.tncs:
+            if tnc is sender or not tnc.listening():
+                continue
+            outcome = self.damage(copies)
+            if outcome == 'lost':
+                self.stats['lost'] += 1
+            elif outcome == 'corrupted':
+                self.stats['corrupted'] += 1
+                tnc.deliver(b'ERR', self.scramble(data))
+            else:
+                self.stats['delivered_bytes'] += len(data)
+                tnc.deliver(b'FEC', data)
+
+    def scramble(self, data: bytes) -> bytes:
+        damaged = bytearray(data)
+        for _ in range(max(1, len(damaged) // 32)):
+            damaged[self.random.randrange(len(damaged))] ^= 1 << self.random.randrange(8)
+        return bytes(damaged)
+
+
+class EmulatedTNC:
+    def __init__(self, channel: Channel, port: int, host: str = '127.0.0.1', verbose: bool = False):
+        '''One ardopcf, serving one hamChat on port (commands) and port + 1 (data)'''
+        self.channel = channel
+        self.port = port
+        self.verbose = verbose
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.state = 'DISC'
+        self.buffer = bytearray()
+        self.lock = threading.RLock()
+        self.has_data = threading.Condition(self.lock)
+        self.aborted = threading.Event()
+        self.sender = None # type: threading.Thread
+        self.link = None # type: ARQLink
+        self.cmd_conn = None # type: socket.socket
+        self.data_conn = None # type: socket.socket
+        self.send_lock = threading.Lock()
+        self.cmd_server = self.__listen(host, port)
+        self.data_server = self.__listen(host, port + 1)
+        channel.tncs.append(self)
+
+    def __listen(self, host: str, port: int) -> socket.socket:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(1)
+        return server
+
+    def start(self):
+        threading.Thread(target=self.__serve, args=(self.cmd_server, self.__read_commands), daemon=True).start()
+        threading.Thread(target=self.__serve, args=(self.data_server, self.__read_data), daemon=True).start()
+
+    def __serve(self, server: socket.socket, reader):
+        # one host at a time, a new connection replaces the old one, like after hamChat reconnects
+        while True:
+            conn, address = server.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=reader, args=(conn,), daemon=True).start()
+
+    def log(self, message: str):
+        if self.verbose:
+            print(f"{self.port} {self.settings['MYCALL'] or '-'}: {message}")
+
+    # host side
+
+    def send_line(self, line: str):
+        conn = self.cmd_conn
+        if conn is None:
+            return
+        self.log(f"<- {line}")
+        try:
+            with self.send_lock:
+                conn.sendall(line.encode() + b'\r')
+        except OSError:
+            pass
+
+    def deliver(self, prefix: bytes, data: bytes):
+        '''Hand a received frame to the host on the data socket'''
+        conn = self.data_conn
+        if conn is None:
+            return
+        frame = prefix + data
+        try:
+            conn.sendall(len(frame).to_bytes(2, 'big') + frame)
+        except OSError:
+            pass
+
+    def set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            self.send_line(f'NEWSTATE {state}')
+
+    def set_ptt(self, keyed: bool):
+        self.send_line('PTT TRUE' if keyed else 'PTT FALSE')
+
+    def listening(self) -> bool:
+        return self.settings['LISTEN'].upper() != 'FALSE' and self.state not in ('FECSend', 'ISS', 'IRS')
+
+    def __read_commands(self, conn: socket.socket):
+        self.cmd_conn = conn
+        pending = b''
+        while True:
+            try:
+                received = conn.recv(4096)
+            except OSError:
+                received = b''
+            if not received:
+                break
+            pending += received
+            *lines, pending = pending.split(b'\r')
+            for line in lines:
+                if line.strip():
+                    self.on_command(line.decode(errors='replace').strip())
+        if self.cmd_conn is conn:
+            self.cmd_conn = None
+
+    def __read_data(self, conn: socket.socket):
+        # <2 byte length><data> for each block the host wants sent
+        self.data_conn = conn
+        pending = bytearray()
+        while True:
+            try:
+                received = conn.recv(65536)
+            except OSError:
+                received = b''
+            if not received:
+                break
+            pending += received
+            while len(pending) >= 2 and len(pending) >= 2 + int.from_bytes(pending[:2], 'big'):
+                length = int.from_bytes(pending[:2], 'big')
+                with self.lock:
+                    self.buffer += pending[2:2 + length]
+                    size = len(self.buffer)
+                    self.has_data.notify_all()
+                del pending[:2 + length]
+                self.send_line(f'BUFFER {size}')
+        if self.data_conn is conn:
+            self.data_conn = None
+
+    def on_command(self, line: str):
+        self.log(f"-> {line}")
+        verb, _, argument = line.partition(' ')
+        verb = verb.upper()
+        argument = argument.strip()
+        if verb not in ACTIONS:
+            if argument:
+                self.settings[verb] = argument
+            self.send_line(f"{verb} {self.settings.get(verb, '')}".rstrip())
+            return
+        if verb == 'INITIALIZE':
+            self.abort()
+            self.send_line('INITIALIZE')
+        elif verb == 'BUFFER':
+            self.send_line(f'BUFFER {len(self.buffer)}')
+        elif verb == 'STATE':
+            self.send_line(f'STATE {self.state}')
+        elif verb == 'PURGEBUFFER':
+            with self.lock:
+                self.buffer.clear()
+            self.send_line('PURGEBUFFER')
+            self.send_line('BUFFER 0')
+        elif verb == 'FECSEND':
+            self.send_line(f'FECSEND {argument}'.rstrip())
+            if argument.upper() == 'TRUE':
+                self.start_fec()
+        elif verb == 'ABORT':
+            self.send_line('ABORT')
+            self.abort()
+        elif verb == 'ARQCALL':
+            self.send_line(line)
+            words = argument.split()
+            if words:
+                self.start_thread(self.arq_call, words[0], int(words[1]) if len(words) > 1 else 2)
+        elif verb == 'DISCONNECT':
+            self.send_line('DISCONNECT')
+            link = self.link
+            if link is not None:
+                link.close()
+        elif verb == 'PING':
+            self.send_line(line)
+            words = argument.split()
+            if words:
+                self.start_thread(self.ping, words[0], int(words[1]) if len(words) > 1 else 1)
+        else:
+            self.send_line(verb)
+
+    def start_thread(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def abort(self):
+        # stop sending now, what is in the buffer stays
+        self.aborted.set()
+        link = self.link
+        if link is not None:
+            link.close(now=True)
+        with self.channel.condition:
+            self.channel.condition.notify_all()
+        with self.lock:
+            self.has_data.notify_all()
+        sender = self.sender
+        if sender is not None and sender is not threading.current_thread():
+            sender.join()
+        self.aborted.clear()
+
+    def take(self, count: int) -> bytes:
+        '''The next count bytes of the buffer, reporting what is left'''
+        with self.lock:
+            data = bytes(self.buffer[:count])
+            del self.buffer[:count]
+            size = len(self.buffer)
+        self.send_line(f'BUFFER {size}')
+        return data
+
+    # FEC
+
+    def start_fec(self):
+        with self.lock:
+            if self.sender is not None and self.sender.is_alive():
+                # already sending, new data just goes along
+                return
+            if not self.buffer or self.settings['PROTOCOLMODE'].upper() != 'FEC':
+                return
+            self.sender = threading.Thread(target=self.send_fec, daemon=True)
+            self.sender.start()
+
+    def send_fec(self):
+        mode = self.settings['FECMODE']
+        if mode not in FRAME_DATA_BYTES or mode not in self.channel.rates:
+            self.send_line(f'FAULT unknown FECMODE {mode}')
+            return
+        repeats = int(self.settings['FECREPEATS'])
+        if not self.channel.key(self):
+            return
+        self.set_state('FECSend')
+        try:
+            # ardopcf keeps going as long as there is data, even data loaded after it started
+            while self.buffer and not self.aborted.is_set():
+                seconds = self.channel.frame_seconds(self, mode, repeats)
+                if self.aborted.wait(seconds):
+                    break
+                data = self.take(FRAME_DATA_BYTES[mode])
+                self.channel.broadcast(self, data, 1 + repeats)
+        finally:
+            self.channel.unkey(self)
+            self.set_state('DISC')
+
+    # ARQ
+
+    def arq_call(self, callsign: str, attempts: int):
+        other = self.channel.find(callsign)
+        self.set_state('ISS')
+        for _ in range(max(1, attempts)):
+            if self.aborted.wait(ARQ_CONNECT_SECONDS / 2 * self.channel.speed):
+                break
+            if other is not None and other.link is None and other.listening() and \
+                    other.settings['PROTOCOLMODE'].upper() == 'ARQ' and self.channel.damage() is None:
+                break
+        else:
+            other = None
+        if other is None or self.aborted.is_set():
+            # nobody answered
+            self.set_state('DISC')
+            return
+        link = ARQLink(self.channel, self, other)
+        link.run()
+
+    def ping(self, callsign: str, count: int):
+        other = self.channel.find(callsign)
+        for _ in range(max(1, count)):
+            if not self.channel.key(self):
+                return
+            self.aborted.wait(PING_SECONDS / 2 * self.channel.speed)
+            self.channel.unkey(self)
+            if other is None or not other.listening() or self.channel.damage() is not None:
+                continue
+            other.send_line(f"PING {self.settings['MYCALL']}>{callsign} {DEFAULT_SNR} {DEFAULT_QUALITY}")
+            if other.settings['ENABLEPINGACK'].upper() != 'FALSE':
+                self.channel.sleep(PING_SECONDS / 2)
+                self.send_line(f'PINGACK {DEFAULT_SNR} {DEFAULT_QUALITY}')
+                return
+
+
+class ARQLink:
+    def __init__(self, channel: Channel, caller: EmulatedTNC, answerer: EmulatedTNC):
+        '''A connection between two TNCs. Whoever is sending (the ISS) sends a frame, the other (the IRS)
+        acknowledges it, and a frame that does not get through is sent again. When the ISS runs out
+        of data and the IRS has some, they swap. The link ends on DISCONNECT, ABORT or ARQTIMEOUT.'''
+        self.channel = channel
+        self.iss = caller
+        self.irs = answerer
+        self.closing = threading.Event()
+        self.closed = False
+        bandwidth = ''.join(char for char in caller.settings['ARQBW'] if char.isdigit())
+        self.bandwidth = bandwidth if bandwidth in ARQ_BANDWIDTH_MODES else '500'
+        self.mode = ARQ_BANDWIDTH_MODES[self.bandwidth]
+        caller.link = self
+        answerer.link = self
+
+    def close(self, now: bool = False):
+        self.closing.set()
+        if now:
+            self.__end()
+        for tnc in (self.iss, self.irs):
+            with tnc.lock:
+                tnc.has_data.notify_all()
+
+    def __end(self):
+        if self.closed:
+            return
+        self.closed = True
+        for tnc in (self.iss, self.irs):
+            tnc.link = None
+            tnc.send_line('DISCONNECTED')
+            tnc.set_state('DISC')
+
+    def run(self):
+        for tnc, other, state in ((self.iss, self.irs, 'ISS'), (self.irs, self.iss, 'IRS')):
+            tnc.send_line(f"CONNECTED {other.settings['MYCALL']} {self.bandwidth}")
+            tnc.set_state(state)
+        idle_since = time.monotonic()
+        timeout = int(self.iss.settings['ARQTIMEOUT']) * self.channel.speed
+        while not self.closing.is_set():
+            if not self.iss.buffer and self.irs.buffer:
+                # the other side has something to say, turn the link around
+                self.iss, self.irs = self.irs, self.iss
+                self.iss.set_state('ISS')
+                self.irs.set_state('IRS')
+            if not self.iss.buffer:
+                with self.iss.lock:
+                    self.iss.has_data.wait(0.1)
+                if time.monotonic() - idle_since > timeout:
+                    break
+                continue
+            idle_since = time.monotonic()
+            self.send_frame()
+        if not self.closed:
+            # a clean disconnect takes a frame each way
+            self.channel.sleep(ARQ_ACK_SECONDS * 2)
+            self.__end()
+
+    def send_frame(self):
+        iss, irs = self.iss, self.irs
+        size = FRAME_DATA_BYTES[self.mode]
+        if not self.channel.key(iss):
+            return
+        self.closing.wait(self.channel.frame_seconds(iss, self.mode))
+        self.channel.unkey(iss)
+        outcome = self.channel.damage()
+        self.channel.stats['frames'] += 1
+        if outcome is not None:
+            # no ACK, the same data goes again
+            self.channel.stats[outcome] += 1
+            self.closing.wait(ARQ_ACK_SECONDS * self.channel.speed)
+            return
+        data = iss.take(size)
+        if not data:
+            return
+        self.channel.stats['delivered_bytes'] += len(data)
+        irs.deliver(b'ARQ', data)
+        if not self.channel.key(irs):
+            return
+        self.closing.wait(ARQ_ACK_SECONDS * self.channel.speed)
+        self.channel.unkey(irs)
+
+
+def parse_rates(values: list) -> dict:
+    rates = {}
+    for value in values or []:
+        mode, _, rate = value.partition('=')
+        if mode not in FRAME_DATA_BYTES or not rate.isdigit():
+            raise SystemExit(f"--rate wants MODE=BYTES_PER_MINUTE with a known FEC mode, not {value}")
+        rates[mode] = int(rate)
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulate ardopcf TNCs on a shared channel, for testing hamChat without a radio.")
+    parser.add_argument('--ports', type=int, nargs='+', default=[8515],
+                        help="command port of each TNC, the data port is the next one (default 8515)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="time scale, 0.1 runs everything ten times faster than on air")
+    parser.add_argument('--loss', type=float, default=0.0, help="chance each frame is not heard at all")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="chance each frame arrives damaged")
+    parser.add_argument('--rate', action='append', metavar='MODE=BYTES_PER_MINUTE',
+                        help="override a mode's rate from RATE_TABLE, can be given more than once")
+    parser.add_argument('--seed', type=int, help="random seed, for repeatable loss and corruption")
+    parser.add_argument('--verbose', action='store_true', help="print every command and response")
+    args = parser.parse_args()
+
+    channel = Channel(args.speed, args.loss, args.corrupt, parse_rates(args.rate), args.seed)
+    for port in args.ports:
+        EmulatedTNC(channel, port, args.host, args.verbose).start()
+        print(f"ardopcf emulator listening on {args.host}:{port} and {port + 1}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(f"channel: {channel.stats}")
+
+
+if __name__ == '__main__':
+    main()
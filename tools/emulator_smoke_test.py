@@ -0,0 +1,199 @@
+"""
+A quick check that two stations can talk through tools/ardopcf_emulator.py, without a radio or a window.
+Two emulated TNCs are started in this process, each with the real ARDOPCF plugin connected to it, driven the
+way hamChat drives its transport: frames go in with append_bytes_to_buffer and on_transmit_buffer, and come
+out of on_get_data on a listener thread, like main.listen_for_data.
+It sends a text and a binary frame over FEC, then switches both to ARQ and sends a frame each way.
+Every frame has to arrive whole, and within DELIVERY_SLACK seconds of its sender saying it was sent.
+The plugin's settings are written to a temporary folder, the ones next to hamChat are not touched.
+Prints what it checked and exits with 1 if anything failed.
+Usage: python tools/emulator_smoke_test.py [--ports PORT PORT] [--speed X] [--seed N]
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import threading
+import tkinter as tk
+# run from anywhere, the plugin and its helpers live in the plugins folder
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'plugins'))
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
+from ARDOPCF import ARDOPCF
+from hamChatFrame import build_frame
+from ardopcf_emulator import Channel, EmulatedTNC
+
+# seconds to wait for each step, in real time
+STEP_TIMEOUT = 30
+# seconds a frame may arrive after its sender is done with it, in real time.
+# the receiver hands a message on as soon as it is complete, it should never wait for the channel to go quiet
+DELIVERY_SLACK = 1.0
+
+
+class Setting:
+    '''Stands in for a tk variable the plugin reads on its own threads, those need tk's main loop running'''
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class NoPlugins:
+    '''The PluginManager hooks ARDOPCF calls, there are no other plugins here to hear them'''
+    def on_key_transmitter(self, requested_at: float = None):
+        pass
+
+    def on_unkey_transmitter(self, requested_at: float = None):
+        pass
+
+    def on_transport_state_changed(self, transport, changes: dict):
+        pass
+
+
+class Host:
+    def __init__(self, callsign: str, recipients: str):
+        '''The parts of main.HamChat the ARDOPCF plugin uses'''
+        self.settings = {'callsign': callsign}
+        self.recipients = recipients
+        self.debug = Setting(False)
+        self.plugMgr = NoPlugins()
+
+    def get_recipients(self) -> str:
+        return self.recipients
+
+    def print_to_chatwindow(self, message: str, save=False):
+        print(f"{self.settings['callsign']}: {message}")
+
+
+class Station:
+    def __init__(self, callsign: str, port: int, peer: str):
+        '''One hamChat station, the ARDOPCF plugin connected to the emulated TNC on port'''
+        # ARDOPCF reads its settings from plugins/ardopcf_settings.json when it starts
+        with open(os.path.join('plugins', 'ardopcf_settings.json'), 'w') as f:
+            json.dump({'host': '127.0.0.1', 'port': port, 'mycall': callsign,
+                       'fec_mode': '4PSK.500.100', 'arq_idle_timeout': 5}, f)
+        self.callsign = callsign
+        self.transport = ARDOPCF(Host(callsign, peer))
+        self.transport.on_connect(STEP_TIMEOUT)
+        self.messages = queue.Queue() # type: queue.Queue[tuple[float, bytes]]
+        self.running = True
+        threading.Thread(target=self.__listen, daemon=True).start()
+
+    def send(self, data: bytes) -> float:
+        '''Send data like TransmitScheduler does, returning when the plugin said it was sent, or None'''
+        self.transport.append_bytes_to_buffer(data)
+        self.transport.on_transmit_buffer()
+        if not self.transport.wait_until_sent(STEP_TIMEOUT):
+            return None
+        return time.monotonic()
+
+    def wait_for_message(self, timeout: float = STEP_TIMEOUT) -> tuple:
+        '''(when it was handed on, data), or (None, None)'''
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+
+    def wait_for_state(self, key: str, value) -> bool:
+        return wait_until(lambda: self.transport.state.get(key) == value)
+
+    def use_protocol_mode(self, mode: str):
+        # what picking it in the plugin's frame does
+        self.transport.protocolmode_var.set(mode)
+        self.transport.on_protocol_mode_change()
+
+    def close(self):
+        self.running = False
+        self.transport.on_shutdown()
+
+    def __listen(self):
+        while self.running:
+            data = self.transport.on_get_data()
+            if data:
+                self.messages.put((time.monotonic(), data))
+            elif not self.transport.is_ready():
+                time.sleep(0.1)
+
+
+def wait_until(condition, timeout: float = STEP_TIMEOUT) -> bool:
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def check(results: list, name: str, passed: bool):
+    results.append(passed)
+    print(f"{'ok  ' if passed else 'FAIL'} {name}")
+
+
+def check_delivery(results: list, name: str, sender: Station, receiver: Station, data: bytes):
+    sent = sender.send(data)
+    check(results, f"{name} sent", sent is not None)
+    received, message = receiver.wait_for_message()
+    check(results, f"{name} received", message == data)
+    if sent is not None and received is not None:
+        delay = received - sent
+        check(results, f"{name} handed on {delay:+.2f}s from being sent", delay <= DELIVERY_SLACK)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that two stations can talk through the ardopcf emulator.")
+    parser.add_argument('--ports', type=int, nargs=2, default=[18515, 18525],
+                        help="command ports of the two TNCs, the data port is the next one")
+    parser.add_argument('--speed', type=float, default=0.05,
+                        help="time scale, the default runs twenty times faster than on air")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # the plugin's tk variables need an interpreter, not a window, so this runs without a display
+    tk._default_root = tk.Tcl()
+    channel = Channel(args.speed, seed=args.seed)
+    for port in args.ports:
+        EmulatedTNC(channel, port).start()
+    workdir = tempfile.TemporaryDirectory()
+    os.chdir(workdir.name)
+    os.mkdir('plugins')
+    a = Station('N0CALL', args.ports[0], 'K7OTR')
+    b = Station('K7OTR', args.ports[1], 'N0CALL')
+    results = []
+    try:
+        check(results, "MYCALL set", a.wait_for_state('mycall', 'N0CALL') and b.wait_for_state('mycall', 'K7OTR'))
+
+        # a text frame spanning several FEC frames
+        text = build_frame('N0CALL', 'chat', '0.1', 'ALL', b'smoke test ' * 60)
+        check_delivery(results, "FEC text frame", a, b, text)
+        binary = build_frame('N0CALL', 'FileXfr', '0.1', 'K7OTR', os.urandom(1500), fields=('smoke.bin', 1500), binary=True)
+        check_delivery(results, "FEC binary frame", a, b, binary)
+
+        for station in (a, b):
+            station.use_protocol_mode('ARQ')
+        check(results, "ARQ mode", a.wait_for_state('protocol_mode', 'ARQ') and b.wait_for_state('protocol_mode', 'ARQ'))
+        call = build_frame('N0CALL', 'FileXfr', '0.1', 'K7OTR', os.urandom(3000), fields=('smoke.bin', 3000), binary=True)
+        check_delivery(results, "ARQ frame", a, b, call)
+        check(results, "ARQ connected", a.transport.arq_session.peer == 'K7OTR')
+        # over the link that is already up
+        reply = build_frame('K7OTR', 'chat', '0.1', 'N0CALL', b'got it')
+        check_delivery(results, "ARQ reply", b, a, reply)
+        # the link is closed once it has been idle for arq_idle_timeout
+        check(results, "ARQ disconnected", wait_until(lambda: a.transport.arq_session.peer is None and b.transport.arq_session.peer is None))
+    finally:
+        a.close()
+        b.close()
+        os.chdir(ROOT)
+        workdir.cleanup()
+    print(f"channel: {channel.stats}")
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()